@@ -0,0 +1,182 @@
+import copy
+import queue
+from collections import OrderedDict
+
+import torch
+import torch.multiprocessing as mp
+
+from algos.data_collector import DataCollector
+from algos.quantized import QuantizedPolicy
+from envs.babyai.utils.buffer import trim_batch
+from utils.inference_server import InferenceServer
+from utils.resources import apply_resources
+from utils.utils import set_seed
+
+
+class SharedPolicyWeights:
+    """
+    A copy of a policy's state dict in shared memory, plus a version counter which is bumped on every publish.
+    The learner publishes its weights here; collector processes pull them whenever the version changes.
+    """
+
+    def __init__(self, policy, ctx):
+        self.state_dict = {k: v.detach().to('cpu', copy=True).share_memory_() for k, v in policy.state_dict().items()}
+        self.version = ctx.Value('l', 0)
+        self.lock = ctx.Lock()
+
+    def publish(self, policy):
+        with self.lock:
+            for k, v in policy.state_dict().items():
+                self.state_dict[k].copy_(v.detach())
+            self.version.value += 1
+
+    def pull(self, policy, current_version):
+        """ Load the shared weights into policy if they are newer than current_version. Returns the new version. """
+        if self.version.value == current_version:
+            return current_version
+        with self.lock:
+            policy.load_state_dict(self.state_dict)
+            return self.version.value
+
+
+def copy_policy(policy, device=None):
+    """
+    Copy of an Agent with its own modules, parameters and buffers (sharing everything else, e.g. its env), so it can
+    act while the original keeps training.
+    :param device: if given, move the copy (and its obs preprocessor) to this device
+    """
+    device = policy.device if device is None else torch.device(device)
+    policy_copy = copy.copy(policy)
+    policy_copy._modules = OrderedDict((name, None if module is None else copy.deepcopy(module).to(device))
+                                       for name, module in policy._modules.items())
+    policy_copy._parameters = OrderedDict((name, None if param is None else torch.nn.Parameter(
+        param.detach().to(device, copy=True), requires_grad=param.requires_grad))
+                                          for name, param in policy._parameters.items())
+    policy_copy._buffers = OrderedDict((name, None if buffer is None else buffer.to(device, copy=True))
+                                       for name, buffer in policy._buffers.items())
+    if device != policy.device:
+        policy_copy.device = device
+        if hasattr(policy.obs_preprocessor, 'for_device'):
+            policy_copy.obs_preprocessor = policy.obs_preprocessor.for_device(device)
+    return policy_copy
+
+
+def cpu_copy(policy):
+    """
+    Copy of an Agent whose modules, device and obs preprocessor are on the CPU, for collector processes: they are
+    forked, so they must not touch CUDA even if the learner uses it.
+    """
+    return copy_policy(policy, 'cpu')
+
+
+def collector_loop(rank, policy, env_fns, args, weights, out_queue, stop_event, collect_kwargs, resources=None):
+    """
+    Body of a collector process: collect with the latest published weights and push batches to the learner until
+    told to stop. Runs in a forked process, so policy is this process's own CPU copy of the collect policy (see
+    cpu_copy), or an InferenceClient if weights is None. Everything here stays on the CPU.
+    With --quantize_collection, the collector acts with an int8 copy of its policy, re-quantized whenever new weights
+    are pulled.
+    """
+    if resources is not None:
+        apply_resources(*resources)
+    set_seed(args.seed + 1000 * (rank + 1))
+    # Each collector is already its own process, so step its envs sequentially rather than spawning more workers.
+    collector_args = copy.copy(args)
+    collector_args.sequential = True
+    quantized_policy = None
+    if weights is not None and getattr(args, 'quantize_collection', False):
+        quantized_policy = QuantizedPolicy(policy)
+    sampler = DataCollector(policy if quantized_policy is None else quantized_policy, env_fns, collector_args,
+                            device='cpu')
+    version = -1
+    while not stop_event.is_set():
+        if weights is not None:
+            new_version = weights.pull(policy, version)
+            if quantized_policy is not None and new_version != version:
+                quantized_policy.refresh()
+            version = new_version
+        samples_data, episode_logs = sampler.collect_experiences(**collect_kwargs)
+        if weights is None:
+            version = policy.version
+        if args.relabel_teacher is None:
+            # Only send what the buffer keeps. (Relabeling happens on the learner and needs the full batch.)
+            samples_data = trim_batch(samples_data)
+        item = (samples_data, episode_logs, version)
+        while not stop_event.is_set():
+            try:
+                out_queue.put(item, timeout=1)
+                break
+            except queue.Full:
+                continue
+
+
+class CollectorPool:
+    """
+    Collector processes for actor-learner training. Each process owns a slice of the env factories and collects
+    continuously with a copy of the collect policy, refreshed from weights the learner publishes with publish().
+    Batches (with the weight version they were collected with) come back through a torch.multiprocessing queue, so
+    their tensors are passed through shared memory.
+    With use_server, the collectors don't hold a policy at all; they act through an InferenceServer in this process,
+    which batches their requests together.
+    """
+
+    def __init__(self, policy, env_fns, args, num_collectors, collect_kwargs, queue_size=4, use_server=False,
+                 server_kwargs=None, resources=None):
+        """ :param resources: optional list of apply_resources args for each collector (see plan_resources) """
+        if use_server and getattr(args, 'quantize_collection', False):
+            raise ValueError("--quantize_collection isn't supported with --inference_server (the server acts in fp32)")
+        ctx = mp.get_context('fork')
+        if use_server:
+            self.server = InferenceServer(policy, ctx=ctx, **(server_kwargs or {}))
+            self.weights = None
+        else:
+            self.server = None
+            self.weights = SharedPolicyWeights(policy, ctx)
+        self.queue = ctx.Queue(maxsize=queue_size)
+        self.stop_event = ctx.Event()
+        self.processes = []
+        num_collectors = min(num_collectors, len(env_fns))
+        for rank in range(num_collectors):
+            # Collectors are forked, so they get CPU copies (or CPU clients) and never touch CUDA
+            collector_policy = cpu_copy(policy) if self.server is None else self.server.client(device='cpu')
+            process = ctx.Process(target=collector_loop,
+                                  args=(rank, collector_policy, env_fns[rank::num_collectors], args, self.weights,
+                                        self.queue, self.stop_event, collect_kwargs,
+                                        None if resources is None else resources[rank]))
+            process.start()
+            self.processes.append(process)
+
+    @property
+    def version(self):
+        return self.weights.version.value if self.server is None else self.server.version
+
+    def publish(self, policy):
+        if self.server is None:
+            self.weights.publish(policy)
+        else:
+            self.server.update(policy)
+
+    def get_batches(self, block=False):
+        """
+        :param block: wait for at least one batch (e.g. while the buffer is still empty)
+        :return: list of (samples_data, episode_logs, version) collected since the last call
+        """
+        batches = []
+        if block:
+            batches.append(self.queue.get())
+        while True:
+            try:
+                batches.append(self.queue.get_nowait())
+            except queue.Empty:
+                return batches
+
+    def close(self):
+        self.stop_event.set()
+        # Drain the queue so collectors blocked on put can exit
+        self.get_batches()
+        for process in self.processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+        if self.server is not None:
+            self.server.close()
@@ -9,7 +9,8 @@ from algos.utils import ImageEmbedding, InstrEmbedding
 from logger import logger
 
 from algos import utils
-from utils.dictlist import merge_dictlists
+from utils.dictlist import merge_dictlists, DictList, TensorBatch
+from envs.babyai.utils.buffer import reconstruct_next_obs
 
 
 class Agent(nn.Module):
@@ -31,10 +32,13 @@ class Agent(nn.Module):
            device = 'cuda' if torch.cuda.is_available() else 'cpu'
         self.device = torch.device(device)
         self.actor_update_frequency = actor_update_frequency
+        # torch.distributed group to average distillation gradients over (see algos/distributed_distill.py)
+        self.distill_group = None
 
         # Create encoders or dummy encoders for each piece of our input
         if args.image_obs:
-            self.state_encoder = ImageEmbedding().to(self.device)
+            self.state_encoder = ImageEmbedding(fused=getattr(args, 'fused_image_embedding', False),
+                                                skip_empty=getattr(args, 'skip_empty_cells', False)).to(self.device)
         else:
             self.state_encoder = None
         if not args.no_instr:
@@ -53,7 +57,7 @@ class Agent(nn.Module):
 
         if args.recon_coef:
             obs = env.reset()
-            obs_dim = 128 if args.image_obs else len(obs['obs'].flatten())
+            obs_dim = 128 if args.image_obs else self.flat_obs_dim(obs)
             act_dim = self.action_dim if args.discrete else 2 * self.action_dim
             out_dim = 2 * self.advice_size
             self.reconstructor = utils.mlp(obs_dim + act_dim, 64, out_dim, 1).to(self.device)
@@ -62,6 +66,10 @@ class Agent(nn.Module):
 
         self.apply(utils.weight_init)
 
+    def flat_obs_dim(self, obs):
+        """ Size of a (non-image) obs as the model sees it, i.e. after the preprocessor has expanded it. """
+        return self.obs_preprocessor([obs], self.teacher, show_instrs=True).obs[0].numel()
+
     def train(self, training=True):
         self.actor.train(training)
         self.critic.train(training)
@@ -93,16 +101,28 @@ class Agent(nn.Module):
             next_obs, _ = self.format_obs(val_batch.next_obs)
             self.update_critic(obs, next_obs, val_batch, train=False)
 
-    def format_obs(self, obs, instr_dropout_prob=0):
-        cutoff = int(instr_dropout_prob * len(obs))
-        without_obs = [] if cutoff == 0 else [self.obs_preprocessor(obs[:cutoff], self.teacher, show_instrs=False)]
-        with_obs = [] if cutoff == len(obs) else [self.obs_preprocessor(obs[cutoff:], self.teacher, show_instrs=True)]
-        obs = without_obs + with_obs
-        obs = merge_dictlists(obs)
+    def encode(self, obs, instr_dropout_prob=0):
+        """ Preprocess obs (unless it already is) and run it through the state and task encoders. """
+        if isinstance(obs, DictList):
+            # Already preprocessed (e.g. by a PrefetchSampler) with instructions shown. Copy it, since the encoders
+            # below overwrite its fields.
+            obs = DictList(obs)
+            cutoff = int(instr_dropout_prob * len(obs.obs))
+            if cutoff > 0 and 'instr' in obs:
+                obs.instr = torch.cat([torch.zeros_like(obs.instr[:cutoff]), obs.instr[cutoff:]])
+        else:
+            cutoff = int(instr_dropout_prob * len(obs))
+            without_obs = [] if cutoff == 0 else [self.obs_preprocessor(obs[:cutoff], self.teacher, show_instrs=False)]
+            with_obs = [] if cutoff == len(obs) else [self.obs_preprocessor(obs[cutoff:], self.teacher, show_instrs=True)]
+            obs = merge_dictlists(without_obs + with_obs)
         if self.state_encoder is not None:
             obs = self.state_encoder(obs)
         if self.task_encoder is not None:
             obs = self.task_encoder(obs)
+        return obs
+
+    def format_obs(self, obs, instr_dropout_prob=0):
+        obs = self.encode(obs, instr_dropout_prob=instr_dropout_prob)
         no_advice_obs = obs.obs.flatten(1).to(self.device)
         unprocessed_advice = obs.advice
         if self.advice_embedding is not None:
@@ -112,13 +132,32 @@ class Agent(nn.Module):
             obs = no_advice_obs
         return obs, (unprocessed_advice, no_advice_obs)
 
+    def preprocess_batch(self, batch):
+        """ Run the obs preprocessor on a sampled batch ahead of time (see PrefetchSampler). """
+        batch.obs = self.obs_preprocessor(batch.obs, self.teacher, show_instrs=True)
+        if 'next_obs' in batch:
+            batch.next_obs = self.obs_preprocessor(batch.next_obs, self.teacher, show_instrs=True)
+        if isinstance(batch, TensorBatch) and self.device.type == 'cuda':
+            # Stage in pinned memory so the copy to the GPU overlaps with the current optimizer step
+            batch = batch.pin_memory()
+        return self.to_device(batch)
+
+    def to_device(self, batch):
+        """ Move every tensor in a sampled or collected batch to the agent's device in one call. """
+        if isinstance(batch, TensorBatch):
+            return batch.to(self.device, non_blocking=True)
+        return batch
+
     def optimize_policy(self, batch, step):
         import time
         t = time.time()
+        batch = self.to_device(batch)
         reward = batch.reward.unsqueeze(1)
-        logger.logkv('train/batch_reward', utils.to_np(reward.mean()))
+        logger.logkv('train/batch_reward', reward.mean())
 
-        next_obs, _ = self.format_obs(batch.next_obs)
+        # Buffer samples come with next_obs; on-policy batches straight from the collector only store terminal obs.
+        next_obs = batch.next_obs if 'next_obs' in batch else reconstruct_next_obs(batch.obs, batch.terminal_obs)
+        next_obs, _ = self.format_obs(next_obs)
         logger.logkv('Time/B_Original_Format_Time', time.time() - t)
         t = time.time()
         critic_time = time.time() - t
@@ -138,10 +177,13 @@ class Agent(nn.Module):
     def update_actor(self, obs, batch, advice=None, no_advice_obs=None):
         raise NotImplementedError('update_actor should be defined in child class')
 
-    def save(self, model_dir, save_name=None):
+    def save(self, model_dir, save_name=None, state_dict=None):
+        """ :param state_dict: snapshot to save instead of the current weights (e.g. for a background checkpoint) """
         if save_name is None:
             save_name = f"{self.teacher}_model.pt"
-        torch.save(self.state_dict(), f'{model_dir}/{save_name}')
+        if state_dict is None:
+            state_dict = self.state_dict()
+        torch.save(state_dict, f'{model_dir}/{save_name}')
 
     def load(self, model_dir):
         self.load_state_dict(torch.load(f'{model_dir}/{self.teacher}_model.pt', map_location=self.device))
@@ -159,27 +201,23 @@ class Agent(nn.Module):
             action_pred = dist.mean
             avg_std = dist.scale.mean()
             avg_mean_dist = torch.abs(action_pred - action_true).mean()
+        # Metrics stay on the device; the logger copies them to the host once per dumpkvs.
+        correct = (action_pred == action_true).float()
         log = {
-            'Loss': float(policy_loss),
-            'Accuracy': float((action_pred == action_true).sum()) / len(action_pred),
+            'Loss': policy_loss.detach(),
+            'Accuracy': correct.sum() / len(action_pred),
         }
         train_str = 'Train' if train else 'Val'
         if self.args.discrete:
-            tokens = torch.unique(action_true)
-            for t in tokens.tolist():
-                locations = action_true == t
-                pred_token = action_pred[locations]
-                true_token = action_true[locations]
-                acc = float((pred_token == true_token).sum()) / len(true_token)
-                logger.logkv(f"Distill/Accz_{t}_{train_str}", acc)
-
-        logger.logkv(f"Distill/Loss_{train_str}", float(policy_loss))
-        logger.logkv(f"Distill/Entropy_{train_str}", float(dist.entropy().mean()))
-        logger.logkv(f"Distill/TotalLoss_{train_str}", float(loss))
-        logger.logkv(f"Distill/Accuracy_{train_str}", float((action_pred == action_true).sum()) / len(action_pred))
-        logger.logkv(f"Distill/Label_Accuracy_{train_str}", float((action_teacher == action_true).sum()) / len(action_pred))
-        logger.logkv(f"Distill/Mean_Dist_{train_str}", float(avg_mean_dist))
-        logger.logkv(f"Distill/Std_{train_str}", float(avg_std))
+            logger.logkv_grouped(f"Distill/Accz_{{}}_{train_str}", action_true, correct, self.action_dim)
+
+        logger.logkv(f"Distill/Loss_{train_str}", policy_loss)
+        logger.logkv(f"Distill/Entropy_{train_str}", dist.entropy().mean())
+        logger.logkv(f"Distill/TotalLoss_{train_str}", loss)
+        logger.logkv(f"Distill/Accuracy_{train_str}", correct.sum() / len(action_pred))
+        logger.logkv(f"Distill/Label_Accuracy_{train_str}", (action_teacher == action_true).float().sum() / len(action_pred))
+        logger.logkv(f"Distill/Mean_Dist_{train_str}", avg_mean_dist)
+        logger.logkv(f"Distill/Std_{train_str}", avg_std)
         return log
 
     def preprocess_distill(self, batch, source):
@@ -194,7 +232,7 @@ class Agent(nn.Module):
             action_true = batch.argmax_action
         if not source == 'agent_probs':
             dtype = torch.long if self.args.discrete else torch.float32
-            action_true = torch.tensor(action_true, device=self.device, dtype=dtype)
+            action_true = torch.as_tensor(action_true, device=self.device, dtype=dtype)
         if hasattr(batch, 'teacher_action'):
             action_teacher = batch.teacher_action
         else:
@@ -225,6 +263,7 @@ class Agent(nn.Module):
 
         # Obtain batch and preprocess
         t = time.time()
+        batch = self.to_device(batch)
         obss, action_true, action_teacher = self.preprocess_distill(batch, source)
         logger.logkv(f"Time/Q_Preprocess", time.time() - t)
         t = time.time()
@@ -260,6 +299,8 @@ class Agent(nn.Module):
         if is_training:
             self.optimizer.zero_grad()
             loss.backward()
+            # No-op unless distillation is data-parallel (see algos/distributed_distill.py)
+            utils.all_reduce_gradients(self.parameters(), group=self.distill_group, num_samples=len(action_true))
             self.optimizer.step()
 
         logger.logkv(f"Time/Q_Update", time.time() - t)
@@ -3,7 +3,8 @@ import torch
 import numpy as np
 
 from algos.utils import to_np
-from utils.dictlist import DictList, merge_dictlists
+from utils.dictlist import TensorBatch
+from envs.babyai.utils.obs_preprocessor import attach_mazes, register_mazes
 from utils.penv import ParallelEnv, SequentialEnv
 from logger import logger
 
@@ -11,10 +12,10 @@ from logger import logger
 class DataCollector(ABC):
     """The collection class."""
 
-    def __init__(self, collect_policy, envs, args, repeated_seed=None):
+    def __init__(self, collect_policy, envs, args, repeated_seed=None, worker_resources=None, device=None):
 
         if not args.sequential:
-            self.env = ParallelEnv(envs, repeated_seed=repeated_seed)
+            self.env = ParallelEnv(envs, repeated_seed=repeated_seed, worker_resources=worker_resources)
         else:
             self.env = SequentialEnv(envs, repeated_seed=repeated_seed)
         self.policy = collect_policy
@@ -22,7 +23,9 @@ class DataCollector(ABC):
 
 
         # Store helpers values
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = torch.device(device)
         self.num_procs = len(envs)
         self.num_frames = self.args.frames_per_proc * self.num_procs
 
@@ -31,14 +34,16 @@ class DataCollector(ABC):
         shape = (self.args.frames_per_proc, self.num_procs)
 
         self.obs = self.env.reset()
+        register_mazes(self.obs)
         self.obss = [None]*(shape[0])
+        self.terminal_obss = [None]*(shape[0])
 
         self.mask = torch.ones(shape[1], device=self.device).float()
         self.masks = torch.zeros(*shape, device=self.device)
         try:
-            action_shape = envs[0].action_space.n
+            action_shape = self.env.action_space.n
         except:  # continuous
-            action_shape = envs[0].action_space.shape[0]
+            action_shape = self.env.action_space.shape[0]
         if self.args.discrete:
             self.actions = torch.zeros(*shape, 1, device=self.device, dtype=torch.int)
             self.teacher_actions = torch.zeros(*shape, 1, device=self.device, dtype=torch.int)
@@ -79,7 +84,7 @@ class DataCollector(ABC):
 
         Returns
         -------
-        exps : DictList
+        exps : TensorBatch
             Contains actions, rewards, advantages etc as attributes.
             Each attribute, e.g. `exps.reward` has a shape
             (self.args.frames_per_proc * num_envs, ...). k-th block
@@ -120,9 +125,13 @@ class DataCollector(ABC):
                 reward = [np.nan for _ in reward]
 
             # Update experiences values
+            # Finished episodes carry their final observation; every other next_obs is recovered from obs[t + 1].
+            self.terminal_obss[i] = [ei.pop('terminal_obs', None) for ei in env_info]
             self.env_infos[i] = env_info
             self.obss[i] = self.obs
             self.obs = obs
+            # D4RL envs only send their maze with the reset obs; keep it so the batch can carry it (see attach_mazes)
+            register_mazes(obs)
             try:
                 self.teacher_actions[i] = torch.FloatTensor(np.stack([ei['teacher_action'] for ei in env_info])).to(self.device)
             except Exception as e:
@@ -140,7 +149,9 @@ class DataCollector(ABC):
                 self.argmax_action[i] = agent_dict['argmax_action']
             if self.args.on_policy:
                 self.values[i] = agent_dict['value'].squeeze(1)
-                if self.args.discrete:
+                if 'log_prob' in agent_dict:  # e.g. from an InferenceClient
+                    self.log_probs[i] = agent_dict['log_prob']
+                elif self.args.discrete:
                     self.log_probs[i] = agent_dict['dist'].log_prob(action[:, 0])
                 else:
                     self.log_probs[i] = agent_dict['dist'].log_prob(action).sum(-1)
@@ -172,10 +183,16 @@ class DataCollector(ABC):
         # Flatten the data correctly, making sure that
         # each episode's data is a continuous chunk
 
-        exps = DictList()
-        exps.obs = [self.obss[i][j]
-                    for j in range(self.num_procs)
-                    for i in range(self.args.frames_per_proc)]
+        exps = TensorBatch()
+        exps.obs = attach_mazes([self.obss[i][j]
+                                 for j in range(self.num_procs)
+                                 for i in range(self.args.frames_per_proc)])
+        # The last step of each process's chunk also ends a segment; its next obs is the current one.
+        self.terminal_obss[-1] = [terminal if terminal is not None else self.obs[j]
+                                  for j, terminal in enumerate(self.terminal_obss[-1])]
+        exps.terminal_obs = [self.terminal_obss[i][j]
+                             for j in range(self.num_procs)
+                             for i in range(self.args.frames_per_proc)]
         keys = list(env_info[0].keys())
         batch = len(env_info)
         timesteps = len(self.env_infos)
@@ -185,11 +202,8 @@ class DataCollector(ABC):
             for b in range(batch):
                 for t in range(timesteps):
                     arr.append(self.env_infos[t][b][k])
-            if k == 'next_obs':
-                exps.next_obs = arr
-            else:
-                env_info_dict[k] = np.stack(arr)
-        env_info_dict = DictList(env_info_dict)
+            env_info_dict[k] = np.stack(arr)
+        env_info_dict = TensorBatch(env_info_dict)
         exps.env_infos = env_info_dict
         # In commments below T is self.args.frames_per_proc, P is self.num_procs,
         # D is the dimensionality
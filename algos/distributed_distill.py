@@ -0,0 +1,130 @@
+import os
+import socket
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from logger import logger
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def shard_sizes(batch_size, world_size):
+    """ Split batch_size rows as evenly as possible between world_size ranks. """
+    return [batch_size // world_size + (1 if rank < batch_size % world_size else 0) for rank in range(world_size)]
+
+
+def sync_parameters(policy):
+    """ Copy rank 0's parameters and buffers to every rank. """
+    for tensor in list(policy.parameters()) + list(policy.buffers()):
+        dist.broadcast(tensor.data, src=0)
+
+
+def sync_buffers(policy):
+    """
+    Average floating point buffers (BatchNorm running stats) across ranks, since each rank only updated them from its
+    own shards.
+    """
+    world_size = dist.get_world_size()
+    for buffer in policy.buffers():
+        if buffer.is_floating_point():
+            dist.all_reduce(buffer)
+            buffer /= world_size
+
+
+def distill_steps(policy, shards, source):
+    """ Distill on each shard in turn, averaging gradients (weighted by shard size) with the other ranks. """
+    policy.distill_group = dist.group.WORLD
+    try:
+        sync_parameters(policy)
+        for shard in shards:
+            policy.distill(shard, is_training=True, source=source)
+        sync_buffers(policy)
+    finally:
+        policy.distill_group = None
+
+
+def worker(rank, world_size, port, policy, requests, num_threads):
+    # Forked once when the pool is created, so the policy and its optimizer state start as copies of the trainer's.
+    # Workers never touch the buffer or CUDA: their shards come from the trainer, and everything runs on the CPU.
+    torch.set_num_threads(num_threads)
+    logger.set_level(logger.DISABLED)
+    if hasattr(policy.obs_preprocessor, 'for_device'):
+        policy.obs_preprocessor = policy.obs_preprocessor.for_device(torch.device('cpu'))
+    dist.init_process_group('gloo', init_method=f'tcp://127.0.0.1:{port}', rank=rank, world_size=world_size)
+    try:
+        while True:
+            job = requests.get()
+            if job is None:
+                break
+            num_steps, source = job
+            distill_steps(policy, (requests.get() for _ in range(num_steps)), source)
+    finally:
+        dist.destroy_process_group()
+    # Skip atexit handlers (e.g. flushing the logger's files), which belong to the parent
+    os._exit(0)
+
+
+class DistillPool:
+    """
+    Data-parallel distillation over world_size CPU processes with the gloo backend.
+    The trainer process is rank 0 and trains policy itself. Ranks 1... are forked once, when the pool is created, and
+    live until close(). Each step, the trainer samples the whole batch from the buffer and sends every other rank its
+    shard, so workers never take the buffer's lock (which a background sampler or relabeler thread may hold when the
+    pool is forked).
+    Gradients are averaged across ranks weighted by shard size before every step, so all ranks apply the update the
+    full batch would give and policy stays identical across ranks. BatchNorm running stats are averaged across ranks
+    at the end of each distill() call.
+    """
+
+    def __init__(self, policy, world_size):
+        if policy.device.type != 'cpu':
+            raise ValueError("Data-parallel distillation runs on CPU processes; use --distill_procs 1 with a GPU")
+        self.policy = policy
+        self.world_size = world_size
+        port = free_port()
+        num_threads = max(1, torch.get_num_threads() // world_size)
+        ctx = mp.get_context('fork')
+        self.requests = []
+        self.processes = []
+        for rank in range(1, world_size):
+            self.requests.append(ctx.Queue())
+            process = ctx.Process(target=worker, args=(rank, world_size, port, policy, self.requests[-1], num_threads),
+                                  daemon=True)
+            process.start()
+            self.processes.append(process)
+        self.num_threads = num_threads
+        dist.init_process_group('gloo', init_method=f'tcp://127.0.0.1:{port}', rank=0, world_size=world_size)
+
+    def shards(self, buffer, num_steps, batch_size, source):
+        """ Sample num_steps batches, send the other ranks their shards and yield this rank's. """
+        sizes = shard_sizes(batch_size, self.world_size)
+        for _ in range(num_steps):
+            batch = buffer.sample(total_num_samples=batch_size, split='train')
+            start = sizes[0]
+            for requests, size in zip(self.requests, sizes[1:]):
+                requests.put(batch[start:start + size].to('cpu'))
+                start += size
+            yield batch[:sizes[0]].to('cpu')
+
+    def distill(self, buffer, num_steps, batch_size, source):
+        for requests in self.requests:
+            requests.put((num_steps, source))
+        prev_threads = torch.get_num_threads()
+        torch.set_num_threads(self.num_threads)
+        try:
+            distill_steps(self.policy, self.shards(buffer, num_steps, batch_size, source), source)
+        finally:
+            torch.set_num_threads(prev_threads)
+
+    def close(self):
+        for requests in self.requests:
+            requests.put(None)
+        for process in self.processes:
+            process.join()
+        dist.destroy_process_group()
@@ -0,0 +1,104 @@
+import copy
+import math
+
+import torch
+from torch import nn
+
+from utils.dictlist import DictList
+
+
+class ActModule(nn.Module):
+    """
+    Tensor-only version of Agent.act, for tracing with torch.jit or exporting to ONNX.
+    Inputs are the fields the agent's obs preprocessor produces, plus the sampling noise (so the exported graph has no
+    random ops of its own):
+        obs: (batch, ...) float, preprocessed obs
+        instr: (batch, instr_len) float, instruction tokens (ignored if the agent doesn't use instructions)
+        advice: (batch, advice_size) float, teacher advice (ignored if the agent has no teacher, or is hierarchical
+            and predicts its own advice)
+        noise: (batch, action_dim) float, uniform in (0, 1) for discrete agents, standard normal for continuous ones
+    Returns (action, log_prob, argmax_action). Discrete actions are sampled with the Gumbel-max trick.
+    """
+
+    def __init__(self, agent, hierarchical=False):
+        super().__init__()
+        # Copies, so exporting doesn't touch the agent being trained
+        self.state_encoder = copy.deepcopy(agent.state_encoder)
+        if self.state_encoder is not None:
+            # The fused image embedding caches its gather maps per (height, width, device) and its conv table per
+            # weight version, and only rebuilds them on a cache miss, which tracing would not record
+            self.state_encoder.fused = False
+        self.task_encoder = copy.deepcopy(agent.task_encoder)
+        self.advice_embedding = copy.deepcopy(agent.advice_embedding)
+        self.actor = copy.deepcopy(agent.actor)
+        self.high_level = copy.deepcopy(agent.high_level) if hierarchical else None
+        self.discrete = agent.args.discrete
+        self.log_std_bounds = agent.actor.log_std_bounds
+
+    def encode(self, obs, instr):
+        obs = DictList({'obs': obs, 'instr': instr})
+        if self.state_encoder is not None:
+            obs = self.state_encoder(obs)
+        if self.task_encoder is not None:
+            obs = self.task_encoder(obs)
+        return obs.obs.flatten(1)
+
+    def forward(self, obs, instr, advice, noise):
+        embedding = self.encode(obs, instr)
+        if self.high_level is not None:
+            advice = self.high_level(embedding)
+        if self.advice_embedding is not None:
+            embedding = torch.cat([embedding, self.advice_embedding(advice)], dim=1)
+        out = self.actor.trunk(embedding)
+        if self.discrete:
+            log_probs = torch.log_softmax(out, dim=1)
+            gumbel = -torch.log(-torch.log(noise.clamp(1e-10, 1 - 1e-7)))
+            action = (log_probs + gumbel).argmax(dim=1, keepdim=True)
+            argmax_action = log_probs.argmax(dim=1, keepdim=True)
+            log_prob = log_probs.gather(1, action)[:, 0]
+        else:
+            mu, log_std = out.chunk(2, dim=-1)
+            log_std = torch.clamp(log_std, self.log_std_bounds[0], self.log_std_bounds[1])
+            action = mu + log_std.exp() * noise
+            argmax_action = mu
+            log_prob = (-.5 * noise.pow(2) - log_std - .5 * math.log(2 * math.pi)).sum(-1)
+        return action, log_prob, argmax_action
+
+
+def example_inputs(agent, hierarchical=False, batch_size=2):
+    """ Inputs for tracing, built by preprocessing copies of an observation from the agent's env. """
+    obs = agent.obs_preprocessor([agent.env.reset()] * batch_size, agent.teacher, show_instrs=True)
+    instr = obs.instr if 'instr' in obs else torch.zeros(batch_size, 1, device=agent.device)
+    if agent.advice_embedding is not None and not hierarchical:
+        advice = obs.advice
+    else:
+        advice = torch.zeros(batch_size, max(agent.advice_size, 1), device=agent.device)
+    if agent.args.discrete:
+        noise = torch.rand(batch_size, agent.action_dim, device=agent.device)
+    else:
+        noise = torch.randn(batch_size, agent.action_dim, device=agent.device)
+    return obs.obs, instr, advice, noise
+
+
+def export_policy(agent, path, onnx_path=None, hierarchical=False):
+    """
+    Trace the agent's act path and save it with torch.jit, so it can be loaded with torch.jit.load (without this
+    codebase) and called as module(obs, instr, advice, noise). See ActModule for the inputs and outputs.
+    :param onnx_path: also export to ONNX here, with a dynamic batch dimension
+    :return: the traced module
+    """
+    module = ActModule(agent, hierarchical=hierarchical).eval()
+    inputs = example_inputs(agent, hierarchical=hierarchical)
+    with torch.no_grad():
+        traced = torch.jit.trace(module, inputs)
+        expected, actual = module(*inputs), traced(*inputs)
+    for e, a in zip(expected, actual):
+        assert torch.allclose(e.float(), a.float(), atol=1e-5), "Traced module doesn't match the original"
+    traced.save(path)
+    if onnx_path is not None:
+        input_names = ['obs', 'instr', 'advice', 'noise']
+        output_names = ['action', 'log_prob', 'argmax_action']
+        torch.onnx.export(module, inputs, onnx_path, input_names=input_names, output_names=output_names,
+                          dynamic_axes={name: {0: 'batch'} for name in input_names + output_names},
+                          opset_version=11)
+    return traced
@@ -17,15 +17,13 @@ class HierarchicalPPOAgent(PPOAgent):
                  lr=1e-4, betas=(0.9, 0.999), actor_update_frequency=1, critic_lr=1e-4,
                  critic_betas=(0.9, 0.999),
                  batch_size=1024, control_penalty=0, repeat_advice=1):
-        super().__init__(args, obs_preprocessor, teacher, env, device=device, discount=discount, batch_size=batch_size,
-                         control_penalty=control_penalty, actor_update_frequency=actor_update_frequency, lr=lr,
-                         betas=betas, critic_lr=critic_lr, critic_betas=critic_betas)
+        super().__init__(args, obs_preprocessor, teacher, env, device=device)
 
         obs = env.reset()
         if args.image_obs:
-            no_advice_obs_dim = args.image_dim
+            no_advice_obs_dim = 128  # ImageEmbedding output, as in PPOAgent
         else:
-            no_advice_obs_dim = len(obs['obs'].flatten())
+            no_advice_obs_dim = self.flat_obs_dim(obs)
         self.high_level = utils.mlp(no_advice_obs_dim, args.hidden_dim, 2, 2).to(self.device)
 
         self.high_level_optimizer = torch.optim.Adam(self.high_level.parameters(),
@@ -33,108 +31,30 @@ class HierarchicalPPOAgent(PPOAgent):
                                                      betas=betas)
         self.train()
 
-    def update_critic(self, obs, next_obs, batch, train=True, step=1):
-        collected_value = batch.value
-        collected_return = batch.returnn
-        value = self.critic(obs)
-        value_clipped = collected_value + torch.clamp(value - collected_value, -self.args.clip_eps, self.args.clip_eps)
-        surr1 = (value - collected_return).pow(2)
-        surr2 = (value_clipped - collected_return).pow(2)
-        critic_loss = torch.max(surr1, surr2).mean()
-
-        if train:
-            logger.logkv('train_critic/loss', utils.to_np(critic_loss))
-
-            # Optimize the critic
-            self.critic_optimizer.zero_grad()
-            critic_loss.backward()
-            torch.nn.utils.clip_grad_norm_(self.critic.parameters(), .5)
-            for n, p in self.critic.named_parameters():
-                param_norm = p.grad.detach().data.norm(2).cpu().numpy()
-                logger.logkv(f'grads/{n}', param_norm)
-            self.critic_optimizer.step()
-        else:
-            logger.logkv('val/critic_loss', utils.to_np(critic_loss))
-            logger.logkv('val/V_mean', utils.to_np(value.mean()))
-            logger.logkv('val/V_std', utils.to_np(value.std()))
-            logger.logkv('val/obs_min', utils.to_np(obs.min()))
-            logger.logkv('val/obs_max', utils.to_np(obs.max()))
-
-    def update_actor(self, obs, batch):
-
-        # control penalty
-        dist = self.actor(obs)
-        entropy = -dist.log_prob(dist.rsample()).sum(-1).mean()
-        action = batch.action
-        if len(action.shape) == 1:
-            action = action.unsqueeze(1)
-        new_log_prob = dist.log_prob(action).sum(-1)
-        if new_log_prob.isnan().sum() > 0:
-            print("DIST")
-            print(dist.scale.min(), dist.scale.max(), dist.scale.isnan().sum())
-            print(dist.loc.min(), dist.loc.max(), dist.loc.isnan().sum())
-        ratio = torch.exp(new_log_prob - batch.log_prob)
-        surrr1 = ratio * batch.advantage
-        surrr2 = torch.clamp(ratio, 1.0 - self.args.clip_eps, 1.0 + self.args.clip_eps) * batch.advantage
-        control_penalty = dist.rsample().float().norm(2, dim=-1).mean()
-        policy_loss = -torch.min(surrr1, surrr2).mean()
-        if policy_loss.isnan():
-            print("DIST")
-            print(dist.scale.min(), dist.scale.max(), dist.scale.isnan().sum())
-            print(dist.loc.min(), dist.loc.max(), dist.loc.isnan().sum())
-
-            print("bad policy loss!")
-        if entropy.isnan():
-            print("bad entropy!")
-        if control_penalty.isnan():
-            print("bad control_penalty!")
-
-        actor_loss = policy_loss \
-                     - self.args.entropy_coef * entropy \
-                     + self.control_penalty * control_penalty
-
-        logger.logkv('train_actor/loss', utils.to_np(actor_loss))
-        logger.logkv('train_actor/target_entropy', self.target_entropy)
-        logger.logkv('train_actor/entropy', utils.to_np(entropy))
-        logger.logkv('train_actor/V', utils.to_np(batch.value.mean()))
-        logger.logkv('train_actor/policy_loss', utils.to_np(policy_loss))
-        logger.logkv('train_actor/control_penalty', utils.to_np(control_penalty))
-        if not self.args.discrete:
-            logger.logkv('train_actor/abs_mean', utils.to_np(torch.abs(dist.loc).mean()))
-            logger.logkv('train_actor/std', utils.to_np(dist.scale.mean()))
-        logger.logkv('train_actor/act_norm', utils.to_np(action.float().norm(2, dim=-1).mean()))
-
-        # optimize the actor
-        self.actor_optimizer.zero_grad()
-        for n, p in self.actor.named_parameters():
-            if p.isnan().sum() > 0:
-                print("NAN in actor before backprop!")
-        actor_loss.backward()
-        torch.nn.utils.clip_grad_norm_(self.actor.parameters(), .5)
-        for n, p in self.actor.named_parameters():
-            param_norm = p.grad.detach().data.norm(2).cpu().numpy()
-            logger.logkv(f'grads/{n}', param_norm)
-        for n, p in self.actor.named_parameters():
-            if p.isnan().sum() > 0:
-                print("NAN in actor after backprop!")
-        self.actor_optimizer.step()
+    def embed_advice(self, embedding, advice):
+        """ Low-level policy input: the shared obs embedding, conditioned on (true or predicted) advice. """
+        if self.advice_embedding is None:
+            return embedding
+        return torch.cat([embedding, self.advice_embedding(advice)], dim=1)
 
     def get_high_level(self, obs, preprocessed=False):
-        if not preprocessed:
-            no_advice_obs = self.obs_preprocessor(obs, 'none', show_instrs=True)
-        else:
-            no_advice_obs = obs
-        if self.state_encoder is not None:
-            no_advice_obs = self.state_encoder(no_advice_obs)
-        if self.task_encoder is not None:
-            no_advice_obs = self.task_encoder(no_advice_obs)
-        no_advice_obs = no_advice_obs.obs.flatten(1).to(self.device)
-        return self.high_level(no_advice_obs)
-
-    def update_high_level(self, obs):
-        ground_truth = torch.FloatTensor(np.stack([o['OffsetWaypoint'] for o in obs])).to(self.device)
+        embedding = self.encode(obs).obs.flatten(1).to(self.device)
+        return self.high_level(embedding)
+
+    def high_level_target(self, obs):
+        """ True OffsetWaypoints of a list of unpreprocessed obs. """
+        return torch.FloatTensor(np.stack([o['OffsetWaypoint'] for o in obs])).to(self.device)
+
+    def update_high_level(self, obs, embedding=None, ground_truth=None):
+        """
+        :param obs: obs to predict OffsetWaypoints for
+        :param embedding: encoded obs, if already computed (gradients aren't passed back into the encoders)
+        :param ground_truth: true OffsetWaypoints, if obs is already preprocessed (see high_level_target)
+        """
+        if ground_truth is None:
+            ground_truth = self.high_level_target(obs)
         assert len(ground_truth.shape) == 2 and ground_truth.shape[-1] == 2
-        pred_advice = self.get_high_level(obs)
+        pred_advice = self.get_high_level(obs) if embedding is None else self.high_level(embedding.detach())
         assert ground_truth.shape == pred_advice.shape
         assert ground_truth.dtype == pred_advice.dtype
         assert ground_truth.requires_grad == False
@@ -142,37 +62,57 @@ class HierarchicalPPOAgent(PPOAgent):
         loss = torch.abs(ground_truth - pred_advice).norm(2, dim=1).mean()
         self.high_level_optimizer.zero_grad()
         loss.backward()
-        torch.nn.utils.clip_grad_norm_(self.high_level.parameters(), .5)
-        for n, p in self.high_level.named_parameters():
-            param_norm = p.grad.detach().data.norm(2).cpu().numpy()
-            logger.logkv(f'grads/high_level{n}', param_norm)
+        utils.clip_grad_norm(self.high_level.parameters(), .5)
+        utils.log_grad_norms(logger, 'grads/high_level', self.high_level.named_parameters())
         self.high_level_optimizer.step()
-        logger.logkv('train_high_level/loss', utils.to_np(loss))
-        logger.logkv('train_high_level/gt_max_abs', utils.to_np(torch.abs(ground_truth).max()))
-        logger.logkv('train_high_level/x_diff', utils.to_np(torch.abs(ground_truth - pred_advice)[:, 0].mean()))
-        logger.logkv('train_high_level/y_diff', utils.to_np(torch.abs(ground_truth - pred_advice)[:, 1].mean()))
+        # The low-level optimizer doesn't own high_level, so clear its grads here rather than leaving them to be
+        # counted in the low-level update's clip_grad_norm(self.parameters())
+        self.high_level_optimizer.zero_grad()
+        logger.logkv('train_high_level/loss', loss)
+        logger.logkv('train_high_level/gt_max_abs', torch.abs(ground_truth).max())
+        logger.logkv('train_high_level/x_diff', torch.abs(ground_truth - pred_advice)[:, 0].mean())
+        logger.logkv('train_high_level/y_diff', torch.abs(ground_truth - pred_advice)[:, 1].mean())
+
+    def act_from_input(self, obs, sample=False):
+        """ Run the low-level actor and critic on an already embedded input (see embed_advice). """
+        dist = self.actor(obs)
+        argmax_action = dist.probs.argmax(dim=1) if self.args.discrete else dist.mean
+        action = dist.sample() if sample else argmax_action
+        value = self.critic(obs)
+        agent_info = {'argmax_action': argmax_action, 'dist': dist, 'value': value}
+        if len(action.shape) == 1:  # Make sure discrete envs still have an action_dim dimension
+            action = action.unsqueeze(1)
+        return action, agent_info
 
     def get_hierarchical_actions(self, obs):
-        offset_waypoint = self.get_high_level(obs)
-        obs = self.obs_preprocessor(obs, self.teacher, show_instrs=True)
-        obs.advice = offset_waypoint
-        action, agent_dict = self.act(obs, sample=True)
+        """ Act on advice predicted by the high-level head. Both heads share one pass through the encoders. """
+        embedding = self.encode(obs).obs.flatten(1).to(self.device)
+        offset_waypoint = self.high_level(embedding)
+        action, agent_dict = self.act_from_input(self.embed_advice(embedding, offset_waypoint), sample=True)
+        agent_dict['high_level'] = offset_waypoint
         return utils.to_np(action[0]), agent_dict
 
-
-    def act(self, obs, sample=False, ):
-        if (not 'advice' in obs):  # unpreprocessed
-            obs = self.obs_preprocessor(obs, self.teacher, show_instrs=True)
-        action, agent_dict = super().act(obs, sample)  # TODO: do we need deepcopy?
-        if self.state_encoder is not None:
-            obs = self.state_encoder(obs)
-        if self.task_encoder is not None:
-            obs = self.task_encoder(obs)
-        obs = torch.cat([obs.obs.flatten(1)] + [obs.advice] * self.repeat_advice, dim=1).to(self.device)
-        value = self.critic(obs)
-        agent_dict['value'] = value
+    def act(self, obs, sample=False, instr_dropout_prob=0):
+        """ Act on the advice in obs. The high-level prediction is computed from the same embedding. """
+        encoded = self.encode(obs, instr_dropout_prob=instr_dropout_prob)
+        embedding = encoded.obs.flatten(1).to(self.device)
+        action, agent_dict = self.act_from_input(self.embed_advice(embedding, encoded.advice), sample)
+        agent_dict['high_level'] = self.high_level(embedding)
+        agent_dict['addl_obs'] = (encoded.advice, embedding)
         return action, agent_dict
 
+    def preprocess_rollouts(self, batch):
+        rollouts = super().preprocess_rollouts(batch)
+        rollouts.high_level_target = self.high_level_target(batch.obs)
+        return rollouts
+
     def optimize_policy(self, batch, step):
-        self.update_high_level(batch.obs)
-        super().optimize_policy(batch, step)
\ No newline at end of file
+        """ One encoder pass feeds both the high-level regression and the PPO update. """
+        batch = self.to_device(batch)
+        logger.logkv('train/batch_reward', batch.reward.mean())
+        encoded = self.encode(batch.obs)
+        embedding = encoded.obs.flatten(1).to(self.device)
+        self.update_high_level(batch.obs, embedding, ground_truth=batch.get('high_level_target'))
+        obs = self.embed_advice(embedding, encoded.advice)
+        # On-policy PPO regresses on the collected returns, so it doesn't need the next obs.
+        self.update_actor(obs, batch, advice=encoded.advice, no_advice_obs=embedding, next_obs=obs)
@@ -1,7 +1,15 @@
+import copy
+
 import torch
 import numpy as np
 from logger import logger
 from envs.babyai.utils.buffer import Buffer
+from envs.babyai.utils.compressed_buffer import CompressedBuffer
+from envs.babyai.utils.prefetch_sampler import PrefetchSampler
+from envs.babyai.utils.buffer_relabeler import BufferRelabeler
+from utils.checkpoint import AsyncCheckpointer, cpu_state_dict, save_resume_info
+from algos.actor_learner import CollectorPool, copy_policy
+from algos.distributed_distill import DistillPool
 import time
 import psutil
 import os
@@ -20,6 +28,9 @@ class Trainer(object):
         obs_preprocessor=None,
         log_dict={},
         log_fn=lambda w, x: None,
+        env_fns=None,
+        quantized_policy=None,
+        resource_plan=None,
     ):
         self.args = args
         self.collect_policy = collect_policy
@@ -27,11 +38,19 @@ class Trainer(object):
         self.il_policy = il_policy
         self.relabel_policy = relabel_policy
         self.sampler = sampler
+        self.env_fns = env_fns
+        self.quantized_policy = quantized_policy
+        self.resource_plan = resource_plan
         self.env = env
         self.itr = args.start_itr
         self.obs_preprocessor = obs_preprocessor
         self.log_fn = log_fn
         self.buffer = None
+        self.prefetch_samplers = {}
+        self.buffer_relabeler = None
+        self.distill_pool = None
+        self.light_checkpoint = getattr(args, 'light_checkpoint', False)
+        self.checkpointer = AsyncCheckpointer() if self.light_checkpoint else None
 
         # Set run counters, or reinitialize if log_dict isn't empty (i.e. we're continuing a run).
         self.num_feedback_advice = log_dict.get('num_feedback_advice', 0)
@@ -43,9 +62,10 @@ class Trainer(object):
         self.num_train_skip_itrs = log_dict.get('num_train_skip_itrs', 5)
 
         # Counters to determine early stopping and saving
-        self.best_val_loss = float('inf')
-        self.best_success = 0
-        self.itrs_since_best = 0
+        trainer_state = log_dict.get('trainer_state', {})
+        self.best_val_loss = trainer_state.get('best_val_loss', float('inf'))
+        self.best_success = trainer_state.get('best_success', 0)
+        self.itrs_since_best = trainer_state.get('itrs_since_best', 0)
         self.current_success = 0  # TODO: store these
         self.current_val_loss = float('inf')
 
@@ -53,22 +73,50 @@ class Trainer(object):
         params = self.get_itr_snapshot(self.itr)
         if (self.rl_policy is not None) and (self.il_policy is not None):
             assert not self.rl_policy.teacher == self.il_policy.teacher, "will overwrite if policies have same teacher"
+        saves = []  # (policy, save_name)
         if self.rl_policy is not None:
-            self.rl_policy.save(self.args.exp_dir)
+            saves.append((self.rl_policy, None))
         if self.il_policy is not None:
-            self.il_policy.save(self.args.exp_dir)
+            saves.append((self.il_policy, None))
         if self.rl_policy is not None and self.current_success >= self.best_success:
-            self.rl_policy.save(self.args.exp_dir, save_name=f"best_{self.rl_policy.teacher}_model.pt")
+            saves.append((self.rl_policy, f"best_{self.rl_policy.teacher}_model.pt"))
         if self.il_policy is not None and self.current_val_loss <= self.best_val_loss:
-            self.il_policy.save(self.args.exp_dir, save_name=f"best_{self.il_policy.teacher}_model.pt")
-        logger.save_itr_params(self.itr, self.args.level, params)
-
-    def log_rollouts(self):
+            saves.append((self.il_policy, f"best_{self.il_policy.teacher}_model.pt"))
+        resume_args = (self.args.exp_dir, self.itr, self.args, params['log_dict'], self.get_trainer_state())
+        if not self.light_checkpoint:
+            for policy, save_name in saves:
+                policy.save(self.args.exp_dir, save_name=save_name)
+            logger.save_itr_params(self.itr, self.args.level, params)
+            save_resume_info(*resume_args)
+            return
+        # Snapshot the weights on the CPU now; everything is written in the background while training continues.
+        snapshots = {}
+        jobs = []
+        for policy, save_name in saves:
+            if id(policy) not in snapshots:
+                snapshots[id(policy)] = cpu_state_dict(policy)
+            jobs.append((policy.save, (self.args.exp_dir, save_name, snapshots[id(policy)])))
+        jobs.append((logger.save_itr_params, (self.itr, self.args.level, params)))
+        jobs.append((save_resume_info, resume_args))
+        self.checkpointer.submit(jobs)
+
+    def get_trainer_state(self):
+        return {
+            'best_val_loss': self.best_val_loss,
+            'best_success': self.best_success,
+            'itrs_since_best': self.itrs_since_best,
+        }
+
+    def log_rollouts(self, acting_policy=None):
+        """ :param acting_policy: acts in the evaluation rollouts in place of the logged policy (e.g. a server client) """
         if self.args.feedback_from_buffer:
             num_feedback = self.buffer.num_feedback
         else:
             num_feedback = self.num_feedback_advice + self.num_feedback_reward
-        self.log_fn(self.itr, num_feedback)
+        if acting_policy is None:
+            self.log_fn(self.itr, num_feedback)
+        else:
+            self.log_fn(self.itr, num_feedback, acting_policy)
 
     def init_logs(self):
         self.all_time_training = 0
@@ -120,9 +168,44 @@ class Trainer(object):
         logger.logkv('Time/All_Unaccounted', self.all_unaccounted_time / time_total)
 
     def make_buffer(self):
-        if not self.args.no_buffer:
+        if not self.args.no_buffer and getattr(self.args, 'compressed_buffer', False):
+            self.buffer = CompressedBuffer(self.args.buffer_name, self.args.buffer_capacity, val_prob=.1,
+                                           successful_only=self.args.distill_successful_only,
+                                           block_size=self.args.buffer_block_size,
+                                           cache_blocks=self.args.buffer_cache_blocks)
+        elif not self.args.no_buffer:
             self.buffer = Buffer(self.args.buffer_name, self.args.buffer_capacity, val_prob=.1,
                                  successful_only=self.args.distill_successful_only)
+            if not self.buffer.loaded:
+                logger.log("Resuming with a plain buffer, which loads in full on first use; "
+                           "--compressed_buffer loads only the blocks it needs")
+
+    def sample_batch(self, policy):
+        """ Sample a training batch for policy, from a background PrefetchSampler if --prefetch_batches is set. """
+        num_batches = getattr(self.args, 'prefetch_batches', 0)
+        if num_batches == 0:
+            return self.buffer.sample(total_num_samples=self.args.batch_size, split='train')
+        if policy not in self.prefetch_samplers:
+            self.prefetch_samplers[policy] = PrefetchSampler(self.buffer, self.args.batch_size, policy.preprocess_batch,
+                                                             split='train', num_batches=num_batches)
+        return self.prefetch_samplers[policy].sample()
+
+    def close_workers(self):
+        """
+        Stop background samplers and wait for any checkpoint which is still being written. Call this after the last
+        save_model(), since the checkpointer thread is a daemon and won't keep the process alive.
+        """
+        for sampler in self.prefetch_samplers.values():
+            sampler.close()
+        self.prefetch_samplers = {}
+        if self.buffer_relabeler is not None:
+            self.buffer_relabeler.close()
+            self.buffer_relabeler = None
+        if self.distill_pool is not None:
+            self.distill_pool.close()
+            self.distill_pool = None
+        if self.checkpointer is not None:
+            self.checkpointer.wait()
 
     def relabel(self, batch):
         action, agent_dict = self.relabel_policy.act(batch.obs, sample=True)
@@ -148,20 +231,48 @@ class Trainer(object):
         batch.log_prob = agent_dict['dist'].log_prob(action).sum(-1).to(batch.log_prob.dtype).detach()
         return batch
 
+    def relabel_buffer(self):
+        """
+        Every relabel_buffer_interval iterations, start relabeling the actions of everything in the buffer with the
+        relabel policy, so data collected before the relabel policy changed is relabeled too. Runs in the background;
+        a new pass only starts once the last one is done.
+        """
+        interval = getattr(self.args, 'relabel_buffer_interval', 0)
+        if self.relabel_policy is None or interval <= 0:
+            return
+        if self.buffer_relabeler is not None:
+            logger.logkv('Relabel/Relabeled', self.buffer_relabeler.num_relabeled)
+            logger.logkv('Relabel/Skipped', self.buffer_relabeler.num_skipped)
+            if not self.buffer_relabeler.done():
+                return
+        if self.itr % interval == 0:
+            # Label with an eval-mode snapshot, so the background thread neither races relabel() on the policy's
+            # BatchNorm stats nor updates them
+            snapshot = copy_policy(self.relabel_policy)
+            snapshot.train(False)
+            label_fn = lambda obs: snapshot.act(obs, sample=True)[0]
+            self.buffer_relabeler = BufferRelabeler(self.buffer, label_fn,
+                                                    chunk_size=getattr(self.args, 'relabel_chunk_size', 1024))
+
     def train(self):
+        if getattr(self.args, 'actor_learner', False):
+            return self.train_actor_learner()
         self.init_logs()
         self.make_buffer()
 
         for itr in range(self.itr, self.args.n_itr):
             self.itr = itr
 
+            # Save before close_workers, which waits for the (possibly asynchronous) checkpoint to be written
             if self.num_feedback_advice + self.num_feedback_reward >= self.args.n_advice:
                 self.log_rollouts()
                 self.save_model()
+                self.close_workers()
                 return
 
             if self.args.save_untrained:
                 self.save_model()
+                self.close_workers()
                 return
 
             if itr % self.args.log_interval == 0:
@@ -176,17 +287,23 @@ class Trainer(object):
             self.should_collect = self.args.collect_teacher is not None
             self.should_train_rl = self.args.rl_teacher is not None
             if self.should_collect:
+                if self.quantized_policy is not None:
+                    self.quantized_policy.refresh()
                 # Collect if we are distilling OR if we're not skipping
                 samples_data, episode_logs = self.sampler.collect_experiences(
                                                                            collect_with_oracle=self.args.collect_with_oracle,
                                                                            collect_reward=self.should_train_rl,
                                                                            train=self.should_train_rl)
+                if self.quantized_policy is not None and itr % self.args.log_interval == 0:
+                    for k, v in self.quantized_policy.check_accuracy(samples_data.obs[:256]).items():
+                        logger.logkv(k, v)
                 if self.relabel_policy is not None:
                     samples_data = self.relabel(samples_data)
                 buffer_start = time.time()
                 self.buffer.add_batch(samples_data, save=self.itr % 200  == 0)
                 buffer_time = time.time() - buffer_start
                 logger.logkv('Time/Buffer', buffer_time)
+                self.relabel_buffer()
             else:
                 episode_logs = None
                 samples_data = None
@@ -195,43 +312,12 @@ class Trainer(object):
 
             time_collection = time.time() - time_env_sampling_start
             time_training_start = time.time()
-            if self.should_train_rl and itr > self.args.min_itr_steps:
-                logger.log("RL Training...")
-                for _ in range(self.args.epochs):
-                    if self.args.on_policy:
-                        sampled_batch = samples_data
-                    else:
-                        sampled_batch = self.buffer.sample(total_num_samples=self.args.batch_size, split='train')
-                    summary_logs = self.rl_policy.optimize_policy(sampled_batch, itr)
-                if not self.args.on_policy:
-                    val_batch = self.buffer.sample(total_num_samples=self.args.batch_size, split='val')
-                    self.rl_policy.log_rl(val_batch)
-            else:
-                summary_logs = None
+            summary_logs = self.train_rl(samples_data)
             time_training = time.time() - time_training_start
             self._log(episode_logs, summary_logs, samples_data, tag="Train")
 
             """ ------------------ Distillation ---------------------"""
-            self.should_distill = self.args.distill_teacher is not None and self.itr >= self.args.min_itr_steps_distill
-            if self.args.no_distill or (self.buffer is not None and self.buffer.counts_train == 0):
-                self.should_distill = False
-            if self.should_distill:
-                logger.log("Distilling ...")
-                time_distill_start = time.time()
-                for dist_i in range(self.args.distillation_steps):
-                    sampled_batch = self.buffer.sample(total_num_samples=self.args.batch_size, split='train')
-                    self.total_distillation_frames += len(sampled_batch)
-                    self.distill(sampled_batch, is_training=True)
-                sampled_val_batch = self.buffer.sample(total_num_samples=self.args.batch_size, split='val')
-                distill_log_val = self.distill(sampled_val_batch, is_training=False)
-
-                val_loss = distill_log_val['Loss']
-                self.current_val_loss = val_loss
-                self.itrs_since_best = 0 if val_loss < self.best_val_loss else self.itrs_since_best + 1
-                self.best_val_loss = min(self.best_val_loss, val_loss)
-                distill_time = time.time() - time_distill_start
-            else:
-                distill_time = 0
+            distill_time = self.run_distillation()
 
             """ ------------------- Logging and Saving --------------------------"""
             logger.log(self.args.exp_dir)
@@ -241,9 +327,146 @@ class Trainer(object):
                 break
 
         # All done!
+        self.close_workers()
         self.log_rollouts()
         logger.log("Training finished")
 
+    def train_actor_learner(self):
+        """
+        Actor-learner variant of train(): collector processes (see CollectorPool) collect continuously while this
+        process adds their batches to the buffer and runs the off-policy RL and distillation updates.
+        The collect policy's weights are published to the collectors every weight_sync_interval iterations.
+        """
+        assert not self.args.on_policy, "Actor-learner training only supports off-policy RL"
+        assert self.args.collect_teacher is not None and not self.args.no_buffer
+        self.init_logs()
+        self.make_buffer()
+        self.should_collect = True
+        self.should_train_rl = self.args.rl_teacher is not None
+        collect_kwargs = {
+            'collect_with_oracle': self.args.collect_with_oracle,
+            'collect_reward': self.should_train_rl,
+            'train': self.should_train_rl,
+        }
+        server_kwargs = {'max_batch_size': getattr(self.args, 'server_batch_size', 256),
+                         'max_latency': getattr(self.args, 'server_latency', .005)}
+        pool = CollectorPool(self.collect_policy, self.env_fns, self.args, self.args.num_collectors, collect_kwargs,
+                             queue_size=self.args.actor_queue_size,
+                             use_server=getattr(self.args, 'inference_server', False), server_kwargs=server_kwargs,
+                             resources=None if self.resource_plan is None else self.resource_plan.collectors)
+        pool.publish(self.collect_policy)
+        # If the server serves the evaluated policy, evaluate through it as well (with the last published weights).
+        # Hierarchical rollouts need actions the server doesn't provide.
+        eval_client = None
+        if pool.server is not None and getattr(self.log_fn, 'policy', None) is self.collect_policy \
+                and self.args.algo != 'hppo':
+            eval_client = pool.server.connect()
+
+        for itr in range(self.itr, self.args.n_itr):
+            self.itr = itr
+            if self.num_feedback_advice + self.num_feedback_reward >= self.args.n_advice:
+                break
+            if itr % self.args.log_interval == 0:
+                self.log_rollouts(eval_client)
+
+            logger.log("\n ---------------- Iteration %d ----------------" % itr)
+
+            """ -------------------- Sampling --------------------------"""
+            # Take whatever the collectors produced since the last iteration (waiting only while the buffer is empty)
+            time_env_sampling_start = time.time()
+            batches = pool.get_batches(block=self.buffer.counts_train == 0)
+            policy_lags = []
+            for samples_data, episode_logs, version in batches:
+                if self.relabel_policy is not None:
+                    samples_data = self.relabel(samples_data)
+                # Collectors already trimmed the batch unless it needed relabeling
+                self.buffer.add_batch(samples_data, trim=self.relabel_policy is not None, save=self.itr % 200 == 0)
+                policy_lags.append(pool.version - version)
+                self._log(episode_logs, None, samples_data, tag="Train")
+            logger.logkv('ActorLearner/Batches', len(batches))
+            self.relabel_buffer()
+            if len(policy_lags) > 0:
+                logger.logkv('ActorLearner/PolicyLag', np.mean(policy_lags))
+                logger.logkv('ActorLearner/MaxPolicyLag', np.max(policy_lags))
+            if pool.server is not None:
+                for k, v in pool.server.stats().items():
+                    logger.logkv(k, v)
+            time_collection = time.time() - time_env_sampling_start
+
+            """ -------------------- Training --------------------------"""
+            time_training_start = time.time()
+            summary_logs = self.train_rl(None)
+            time_training = time.time() - time_training_start
+            self._log(None, summary_logs, None, tag="Train")
+
+            """ ------------------ Distillation ---------------------"""
+            distill_time = self.run_distillation()
+
+            if itr % self.args.weight_sync_interval == 0:
+                pool.publish(self.collect_policy)
+
+            """ ------------------- Logging and Saving --------------------------"""
+            logger.log(self.args.exp_dir)
+            self.update_logs(time_training, time_collection, distill_time, self.saving_time)
+            should_terminate = self.save_and_maybe_early_stop()
+            if should_terminate:
+                break
+
+        pool.close()
+        self.close_workers()
+        self.log_rollouts()
+        logger.log("Training finished")
+
+    def train_rl(self, samples_data):
+        """ Run the RL updates for this iteration. Returns the RL policy's summary logs (or None if it didn't train). """
+        if not (self.should_train_rl and self.itr > self.args.min_itr_steps):
+            return None
+        logger.log("RL Training...")
+        if self.args.on_policy:
+            # Tensorize the rollouts once; every epoch shuffles minibatches out of the same cached tensors
+            rollouts = self.rl_policy.preprocess_rollouts(samples_data)
+            minibatch_size = getattr(self.args, 'ppo_minibatch_size', None)
+        for _ in range(self.args.epochs):
+            if self.args.on_policy:
+                for minibatch in self.rl_policy.minibatches(rollouts, minibatch_size):
+                    summary_logs = self.rl_policy.optimize_policy(minibatch, self.itr)
+            else:
+                sampled_batch = self.sample_batch(self.rl_policy)
+                summary_logs = self.rl_policy.optimize_policy(sampled_batch, self.itr)
+        if not self.args.on_policy:
+            val_batch = self.buffer.sample(total_num_samples=self.args.batch_size, split='val')
+            self.rl_policy.log_rl(val_batch)
+        return summary_logs
+
+    def run_distillation(self):
+        """ Run this iteration's distillation steps and update the early stopping counters. Returns the time taken. """
+        self.should_distill = self.args.distill_teacher is not None and self.itr >= self.args.min_itr_steps_distill
+        if self.args.no_distill or (self.buffer is not None and self.buffer.counts_train == 0):
+            self.should_distill = False
+        if not self.should_distill:
+            return 0
+        logger.log("Distilling ...")
+        time_distill_start = time.time()
+        distill_procs = getattr(self.args, 'distill_procs', 1)
+        if distill_procs > 1:
+            if self.distill_pool is None:
+                self.distill_pool = DistillPool(self.il_policy, distill_procs)
+            self.distill_pool.distill(self.buffer, self.args.distillation_steps, self.args.batch_size, self.args.source)
+            self.total_distillation_frames += self.args.distillation_steps * self.args.batch_size
+        else:
+            for dist_i in range(self.args.distillation_steps):
+                sampled_batch = self.sample_batch(self.il_policy)
+                self.total_distillation_frames += len(sampled_batch.action)
+                self.distill(sampled_batch, is_training=True)
+        sampled_val_batch = self.buffer.sample(total_num_samples=self.args.batch_size, split='val')
+        distill_log_val = self.distill(sampled_val_batch, is_training=False)
+
+        val_loss = float(distill_log_val['Loss'])
+        self.current_val_loss = val_loss
+        self.itrs_since_best = 0 if val_loss < self.best_val_loss else self.itrs_since_best + 1
+        self.best_val_loss = min(self.best_val_loss, val_loss)
+        return time.time() - time_distill_start
+
     def save_and_maybe_early_stop(self):
         early_stopping = self.itrs_since_best > self.args.early_stop
         logger.logkv('Train/BestLoss', self.best_val_loss)
@@ -275,9 +498,9 @@ class Trainer(object):
             logger.logkv(f"{tag}/PathLength", avg_path_length)
 
             if self.args.discrete:
-                logger.logkv(f"{tag}/Accuracy", torch.eq(data.action, data.teacher_action).float().mean().item())
+                logger.logkv(f"{tag}/Accuracy", torch.eq(data.action, data.teacher_action).float().mean())
                 logger.logkv(f"{tag}/Argmax_Accuracy", torch.eq(data.action_probs.argmax(dim=1).unsqueeze(1),
-                                                                data.teacher_action).float().mean().item())
+                                                                data.teacher_action).float().mean())
 
             self.num_feedback_advice += episode_logs['num_feedback_advice']
             self.num_feedback_reward += episode_logs['num_feedback_reward']
@@ -314,7 +537,6 @@ class Trainer(object):
     def get_itr_snapshot(self, itr):
         """ Saves training args (models are saved elsewhere) """
         d = dict(itr=itr,
-                 env=self.env,
                  args=self.args,
                  log_dict={
                      'num_feedback_advice': self.num_feedback_advice,
@@ -324,4 +546,10 @@ class Trainer(object):
                      'gave_feedback': self.gave_feedback,
                       'followed_feedback': self.followed_feedback,
                  })
+        if self.light_checkpoint:
+            # Don't pickle the env itself, just a recipe to rebuild it from its config
+            d['env_factory'] = self.env.factory()
+            d['log_dict'] = copy.deepcopy(d['log_dict'])
+        else:
+            d['env'] = self.env
         return d
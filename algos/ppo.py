@@ -5,6 +5,7 @@ import torch
 from algos.agent import Agent
 from algos.utils import DiagGaussianActor
 from logger import logger
+from utils.dictlist import TensorBatch
 
 from algos import utils
 
@@ -22,7 +23,7 @@ class PPOAgent(Agent):
            device = 'cuda' if torch.cuda.is_available() else 'cpu'
         super().__init__(args, obs_preprocessor, teacher, env, device=device, advice_size=self.advice_size,
                          advice_dim=128)
-        obs_dim = (128 + self.advice_dim) if args.image_obs else (len(obs['obs'].flatten()) + self.advice_dim)
+        obs_dim = (128 + self.advice_dim) if args.image_obs else (self.flat_obs_dim(obs) + self.advice_dim)
         self.critic = utils.mlp(obs_dim, args.hidden_dim, 1, 2).to(self.device)
         self.actor = DiagGaussianActor(obs_dim, self.action_dim, discrete=args.discrete, hidden_dim=args.hidden_dim).to(
             self.device)
@@ -49,8 +50,7 @@ class PPOAgent(Agent):
             # Optimize the critic
             self.optimizer.zero_grad()
             critic_loss.backward()
-            grad_norm = sum(p.grad.data.norm(2) ** 2 for p in self.critic.parameters() if p.grad is not None) ** 0.5
-            torch.nn.utils.clip_grad_norm_(self.critic.parameters(), .5)
+            grad_norm = utils.clip_grad_norm(self.critic.parameters(), .5)
             self.optimizer.step()
         else:
             tag = 'Val'
@@ -59,37 +59,37 @@ class PPOAgent(Agent):
         self.log_critic(tag, critic_loss, value, collected_value, collected_return, obs, grad_norm, clip)
 
     def log_critic(self, tag, critic_loss, value, collected_value, collected_return, obs, grad_norm, clip):
-        logger.logkv(f'{tag}/Value_loss', utils.to_np(critic_loss))
-        logger.logkv(f'{tag}/V_mean', utils.to_np(value.mean()))
-        logger.logkv(f'{tag}/Return', utils.to_np(collected_return.mean()))
-        logger.logkv(f'{tag}/Collected_value', utils.to_np(collected_value.mean()))
-        logger.logkv(f'{tag}/V_std', utils.to_np(value.std()))
-        logger.logkv(f'{tag}/obs_min', utils.to_np(obs.min()))
-        logger.logkv(f'{tag}/obs_max', utils.to_np(obs.max()))
-        logger.logkv('Train/Grad_norm_critic', utils.to_np(grad_norm))
-        logger.logkv('Train/ValueClip', utils.to_np(clip.mean()))
+        logger.logkv(f'{tag}/Value_loss', critic_loss)
+        logger.logkv(f'{tag}/V_mean', value.mean())
+        logger.logkv(f'{tag}/Return', collected_return.mean())
+        logger.logkv(f'{tag}/Collected_value', collected_value.mean())
+        logger.logkv(f'{tag}/V_std', value.std())
+        logger.logkv(f'{tag}/obs_min', obs.min())
+        logger.logkv(f'{tag}/obs_max', obs.max())
+        logger.logkv('Train/Grad_norm_critic', grad_norm)
+        logger.logkv('Train/ValueClip', clip.mean())
 
     def log_actor(self, actor_loss, dist, value, policy_loss, control_penalty, action, log_prob, recon_loss,
                   grad_norm, clip, ratio):
-        logger.logkv('Train/LogProb', utils.to_np(log_prob).mean())
-        logger.logkv('Train/Loss', utils.to_np(actor_loss))
-        logger.logkv('Train/Entropy', utils.to_np(dist.entropy().mean()))
-        logger.logkv('Train/Entropy_Loss',  - self.args.entropy_coef * utils.to_np(dist.entropy().mean()))
-        logger.logkv('Train/Entropy_loss',  - self.args.entropy_coef * utils.to_np(dist.entropy().mean()))
-        logger.logkv('Train/V', utils.to_np(value.mean()))
-        logger.logkv('Train/policy_loss', utils.to_np(policy_loss))
-        logger.logkv('Train/Policy_loss', utils.to_np(policy_loss))
-        logger.logkv('Train/control_penalty', utils.to_np(control_penalty))
-        logger.logkv('Train/recon_loss', utils.to_np(recon_loss))
-        logger.logkv('Train/Grad_norm_actor', utils.to_np(grad_norm))
-        logger.logkv('Train/PolicyClip', utils.to_np(clip.mean()))
-        logger.logkv('Train/Ratio', utils.to_np(ratio.mean()))
+        logger.logkv('Train/LogProb', log_prob.mean())
+        logger.logkv('Train/Loss', actor_loss)
+        logger.logkv('Train/Entropy', dist.entropy().mean())
+        logger.logkv('Train/Entropy_Loss',  - self.args.entropy_coef * dist.entropy().mean())
+        logger.logkv('Train/Entropy_loss',  - self.args.entropy_coef * dist.entropy().mean())
+        logger.logkv('Train/V', value.mean())
+        logger.logkv('Train/policy_loss', policy_loss)
+        logger.logkv('Train/Policy_loss', policy_loss)
+        logger.logkv('Train/control_penalty', control_penalty)
+        logger.logkv('Train/recon_loss', recon_loss)
+        logger.logkv('Train/Grad_norm_actor', grad_norm)
+        logger.logkv('Train/PolicyClip', clip.mean())
+        logger.logkv('Train/Ratio', ratio.mean())
         if not self.args.discrete:
-            logger.logkv('Train/Action_abs_mean', utils.to_np(torch.abs(dist.loc).mean()))
-            logger.logkv('Train/Action_std', utils.to_np(dist.scale.mean()))
-        logger.logkv('Train/Action_magnitude', utils.to_np(action.float().norm(2, dim=-1).mean()))
-        logger.logkv('Train/Action_magnitude_L1', utils.to_np(action.float().norm(1, dim=-1).mean()))
-        logger.logkv('Train/Action_max', utils.to_np(action.float().max(dim=-1)[0].mean()))
+            logger.logkv('Train/Action_abs_mean', torch.abs(dist.loc).mean())
+            logger.logkv('Train/Action_std', dist.scale.mean())
+        logger.logkv('Train/Action_magnitude', action.float().norm(2, dim=-1).mean())
+        logger.logkv('Train/Action_magnitude_L1', action.float().norm(1, dim=-1).mean())
+        logger.logkv('Train/Action_max', action.float().max(dim=-1)[0].mean())
 
     def update_actor(self, obs, batch, advice=None, no_advice_obs=None, next_obs=None):
         assert len(obs.shape) == 2
@@ -155,12 +155,41 @@ class PPOAgent(Agent):
         self.optimizer.zero_grad()
         loss = actor_loss + .5 * critic_loss
         loss.backward()
-        grad_norm = sum(p.grad.data.norm(2) ** 2 for p in self.parameters() if p.grad is not None) ** 0.5
-        torch.nn.utils.clip_grad_norm_(self.parameters(), .5)
+        grad_norm = utils.clip_grad_norm(self.parameters(), .5)
         self.optimizer.step()
         clip = surr1 - surr2
         self.log_critic(tag, critic_loss, value, collected_value, collected_return, obs, grad_norm, clip)
 
+    def preprocess_rollouts(self, batch):
+        """
+        Tensorize an on-policy batch once per iteration, so that every PPO epoch (and minibatch) indexes into cached
+        device tensors rather than re-running the obs preprocessor.
+        """
+        obs = self.obs_preprocessor(batch.obs, self.teacher, show_instrs=True)
+        if len(obs.advice) == 0:  # No teacher; keep an empty advice field which can be indexed like the others
+            obs.advice = torch.zeros(len(obs.obs), 0, device=self.device)
+        rollouts = TensorBatch({'obs': TensorBatch(obs), 'action': batch.action, 'log_prob': batch.log_prob,
+                                'advantage': batch.advantage, 'value': batch.value, 'returnn': batch.returnn,
+                                'reward': batch.reward})
+        return self.to_device(rollouts)
+
+    def minibatches(self, batch, minibatch_size=None):
+        """ Shuffled minibatches which cover the batch, or just the whole batch if minibatch_size is None. """
+        if not minibatch_size or minibatch_size >= len(batch.action):
+            yield batch
+            return
+        indices = torch.randperm(len(batch.action), device=batch.action.device)
+        for start in range(0, len(indices), minibatch_size):
+            yield batch[indices[start:start + minibatch_size]]
+
+    def optimize_policy(self, batch, step):
+        batch = self.to_device(batch)
+        logger.logkv('train/batch_reward', batch.reward.mean())
+        if step % self.actor_update_frequency == 0:
+            obs, (advice, no_advice_obs) = self.format_obs(batch.obs)
+            # PPO regresses on the collected returns, so unlike the off-policy agents it doesn't need the next obs.
+            self.update_actor(obs, batch, advice=advice, no_advice_obs=no_advice_obs, next_obs=obs)
+
     def act(self, obs, sample=False, instr_dropout_prob=0):
         obs, addl_obs = self.format_obs(obs, instr_dropout_prob=instr_dropout_prob)
         dist = self.actor(obs)
@@ -0,0 +1,63 @@
+import copy
+from collections import OrderedDict
+
+import torch
+from torch import nn
+
+
+class QuantizedPolicy:
+    """
+    Int8 copy of an Agent for acting on the CPU (collection and evaluation).
+    The Linear layers (mlp heads, FiLM, advice embedding) and the instruction GRU are dynamically quantized: weights
+    are stored as int8 and activations are quantized on the fly. Training still happens on the fp32 policy; call
+    refresh() after its weights change.
+    Has the same act()/get_actions()/train() interface as an Agent, so it can stand in for one in DataCollector and
+    rollout.
+    """
+
+    def __init__(self, policy, dtype=torch.qint8):
+        assert policy.device.type == 'cpu', "Quantized inference only runs on the CPU"
+        self.fp32_policy = policy
+        self.dtype = dtype
+        # Shallow copy of the agent (sharing its env, preprocessor, etc.) whose submodules are replaced in refresh()
+        self.policy = copy.copy(policy)
+        self.policy._modules = OrderedDict()
+        self.policy._parameters = OrderedDict()
+        self.policy._buffers = OrderedDict()
+        self.refresh()
+
+    def refresh(self):
+        """ Re-quantize from the fp32 policy's current weights. """
+        for name, module in self.fp32_policy.named_children():
+            self.policy._modules[name] = torch.quantization.quantize_dynamic(module, {nn.Linear, nn.GRU},
+                                                                             dtype=self.dtype)
+        self.policy.train(self.fp32_policy.training)
+
+    def train(self, training=True):
+        self.policy.train(training)
+        return self
+
+    def act(self, obs, sample=False, instr_dropout_prob=0):
+        return self.policy.act(obs, sample=sample, instr_dropout_prob=instr_dropout_prob)
+
+    def get_actions(self, obs, training=False, instr_dropout_prob=0):
+        return self.policy.get_actions(obs, training=training, instr_dropout_prob=instr_dropout_prob)
+
+    def check_accuracy(self, obs):
+        """
+        Compare the quantized policy's deterministic actions to the fp32 policy's on a list of observations.
+        :return: dict of logging metrics
+        """
+        training = self.fp32_policy.training
+        self.fp32_policy.train(False)
+        self.policy.train(False)
+        with torch.no_grad():
+            _, fp32_dict = self.fp32_policy.act(obs, sample=False)
+            _, quantized_dict = self.policy.act(obs, sample=False)
+        self.fp32_policy.train(training)
+        self.policy.train(training)
+        fp32_action, quantized_action = fp32_dict['argmax_action'], quantized_dict['argmax_action']
+        if self.fp32_policy.args.discrete:
+            return {'Quantized/ActionAgreement': (fp32_action == quantized_action).float().mean().item()}
+        diff = (fp32_action - quantized_action).abs()
+        return {'Quantized/MeanActionDiff': diff.mean().item(), 'Quantized/MaxActionDiff': diff.max().item()}
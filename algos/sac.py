@@ -38,7 +38,7 @@ class SACAgent(Agent, nn.Module):
         if args.image_obs:
             obs_dim = args.image_dim + advice_dim
         else:
-            obs_dim = len(obs['obs'].flatten()) + advice_dim
+            obs_dim = self.flat_obs_dim(obs) + advice_dim
         self.critic = DoubleQCritic(obs_dim, action_dim, hidden_dim=args.hidden_dim).to(self.device)
         self.critic_target = DoubleQCritic(obs_dim, action_dim, hidden_dim=args.hidden_dim).to(self.device)
         self.critic_target.load_state_dict(self.critic.state_dict())
@@ -104,29 +104,29 @@ class SACAgent(Agent, nn.Module):
             current_Q2, target_Q)
 
         if train:
-            logger.logkv('train_critic/loss', utils.to_np(critic_loss))
+            logger.logkv('train_critic/loss', critic_loss)
 
             # Optimize the critic
             self.critic_optimizer.zero_grad()
             critic_loss.backward()
             self.critic_optimizer.step()
         else:
-            logger.logkv('val/critic_loss', utils.to_np(critic_loss))
-            logger.logkv('val/Q_mean', utils.to_np(current_Q1.mean()))
-            logger.logkv('val/Q_std', utils.to_np(current_Q1.std()))
-            logger.logkv('val/entropy', utils.to_np(-log_prob.mean()))
+            logger.logkv('val/critic_loss', critic_loss)
+            logger.logkv('val/Q_mean', current_Q1.mean())
+            logger.logkv('val/Q_std', current_Q1.std())
+            logger.logkv('val/entropy', -log_prob.mean())
             if self.args.discrete:
                 action = torch.argmax(next_action_hard, dim=1)
                 act_dim = next_action_hard.shape[-1]
                 for i in range(act_dim):
                     prop_i = (action == i).float().mean()
-                    logger.logkv(f'val/sampled_{i}', utils.to_np(prop_i))
+                    logger.logkv(f'val/sampled_{i}', prop_i)
             else:
-                logger.logkv('val/abs_mean', utils.to_np(torch.abs(dist.loc).mean()))
-                logger.logkv('val/mean_std', utils.to_np(dist.loc.std()))
-                logger.logkv('val/std', utils.to_np(dist.scale.mean()))
-            logger.logkv('val/obs_min', utils.to_np(obs.min()))
-            logger.logkv('val/obs_max', utils.to_np(obs.max()))
+                logger.logkv('val/abs_mean', torch.abs(dist.loc).mean())
+                logger.logkv('val/mean_std', dist.loc.std())
+                logger.logkv('val/std', dist.scale.mean())
+            logger.logkv('val/obs_min', obs.min())
+            logger.logkv('val/obs_max', obs.max())
 
         if step % self.critic_target_update_frequency == 0:
             utils.soft_update_params(self.critic, self.critic_target, self.critic_tau)
@@ -144,27 +144,27 @@ class SACAgent(Agent, nn.Module):
         actor_Q = torch.min(actor_Q1, actor_Q2)
         actor_loss = (self.alpha.detach() * log_prob - actor_Q + self.control_penalty * action.norm(2, dim=-1)).mean()
 
-        logger.logkv('train_actor/loss', utils.to_np(actor_loss))
+        logger.logkv('train_actor/loss', actor_loss)
         logger.logkv('train_actor/target_entropy', self.target_entropy)
-        logger.logkv('train_actor/entropy', utils.to_np(-log_prob.mean()))
-        logger.logkv('train_actor/Q', utils.to_np(actor_Q.mean()))
+        logger.logkv('train_actor/entropy', -log_prob.mean())
+        logger.logkv('train_actor/Q', actor_Q.mean())
         if not self.args.discrete:
-            logger.logkv('train_actor/abs_mean', utils.to_np(torch.abs(dist.loc).mean()))
-            logger.logkv('train_actor/std', utils.to_np(dist.scale.mean()))
-        logger.logkv('train_actor/act_norm', utils.to_np(action.norm(2, dim=-1).mean()))
+            logger.logkv('train_actor/abs_mean', torch.abs(dist.loc).mean())
+            logger.logkv('train_actor/std', dist.scale.mean())
+        logger.logkv('train_actor/act_norm', action.norm(2, dim=-1).mean())
 
         # optimize the actor
         self.actor_optimizer.zero_grad()
         actor_loss.backward()
-        torch.nn.utils.clip_grad_norm_(self.actor.parameters(), .5)
-        torch.nn.utils.clip_grad_norm_(self.critic.parameters(), .5)
+        utils.clip_grad_norm(self.actor.parameters(), .5)
+        utils.clip_grad_norm(self.critic.parameters(), .5)
         self.actor_optimizer.step()
 
         if self.learnable_temperature:
             self.log_alpha_optimizer.zero_grad()
             alpha_loss = (self.alpha *
                           (-log_prob - self.target_entropy).detach()).mean()
-            logger.logkv('train_alpha/loss', utils.to_np(alpha_loss))
-            logger.logkv('train_alpha/value', utils.to_np(self.alpha))
+            logger.logkv('train_alpha/loss', alpha_loss)
+            logger.logkv('train_alpha/value', self.alpha)
             alpha_loss.backward()
             self.log_alpha_optimizer.step()
\ No newline at end of file
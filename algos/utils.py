@@ -1,6 +1,7 @@
 import numpy as np
 import torch
 from torch import nn
+import torch.distributed as dist
 import os
 import random
 from torch import distributions
@@ -11,9 +12,88 @@ from torch.distributions import Normal, Categorical
 
 
 def soft_update_params(net, target_net, tau):
-    for param, target_param in zip(net.parameters(), target_net.parameters()):
-        target_param.data.copy_(tau * param.data +
-                                (1 - tau) * target_param.data)
+    """ target = tau * net + (1 - tau) * target, as two multi-tensor (foreach) ops where torch supports them. """
+    params = [p.data for p in net.parameters()]
+    target_params = [p.data for p in target_net.parameters()]
+    if hasattr(torch, '_foreach_mul_'):
+        torch._foreach_mul_(target_params, 1 - tau)
+        torch._foreach_add_(target_params, params, alpha=tau)
+    else:
+        for param, target_param in zip(params, target_params):
+            target_param.mul_(1 - tau).add_(param, alpha=tau)
+
+
+def grad_norms(parameters):
+    """
+    L2 norm of each parameter's gradient (skipping parameters without one), as a single tensor, so the norms can be
+    logged or reduced without a host sync per parameter.
+    """
+    grads = [p.grad.detach() for p in parameters if p.grad is not None]
+    if len(grads) == 0:
+        return torch.zeros(0)
+    if hasattr(torch, '_foreach_norm'):
+        return torch.stack(torch._foreach_norm(grads))
+    return torch.stack([g.norm(2) for g in grads])
+
+
+def grad_norm(parameters):
+    """ Total L2 norm of the gradients of parameters, as a tensor (without syncing with the device). """
+    return grad_norms(parameters).norm(2)
+
+
+def clip_grad_norm(parameters, max_norm):
+    """
+    Like torch.nn.utils.clip_grad_norm_, scaling all gradients with one foreach op where torch supports it.
+    :return: the total gradient norm before clipping, as a tensor
+    """
+    parameters = [p for p in parameters if p.grad is not None]
+    total_norm = grad_norm(parameters)
+    if len(parameters) == 0:
+        return total_norm
+    grads = [p.grad.detach() for p in parameters]
+    # Scale by min(1, max_norm / total_norm) on the device, rather than checking total_norm on the host
+    scale = torch.clamp(max_norm / (total_norm + 1e-6), max=1.0)
+    try:
+        torch._foreach_mul_(grads, scale)
+    except (AttributeError, TypeError, RuntimeError):  # Older torch only takes python scalars
+        for g in grads:
+            g.mul_(scale)
+    return total_norm
+
+
+def has_nan(tensors):
+    """ Whether any of the tensors contains a NaN, with a single host sync. """
+    return bool(torch.stack([t.detach().isnan().any() for t in tensors]).any())
+
+
+def log_grad_norms(logger, prefix, named_parameters):
+    """ Log each parameter's gradient norm as <prefix><name>, computed together in grad_norms. """
+    named_parameters = [(n, p) for n, p in named_parameters if p.grad is not None]
+    norms = grad_norms([p for _, p in named_parameters])
+    for (n, _), norm in zip(named_parameters, norms.unbind()):
+        logger.logkv(f'{prefix}{n}', norm)
+
+
+def all_reduce_gradients(parameters, group=None, num_samples=None):
+    """
+    Average gradients across the processes of a torch.distributed group (no-op if group is None).
+    All gradients go through a single flattened all-reduce.
+    :param num_samples: number of samples this process's gradients were averaged over. If given, processes are
+    weighted by it, so uneven shards give the same result as one process with the whole batch.
+    """
+    if group is None:
+        return
+    grads = [p.grad for p in parameters if p.grad is not None]
+    if len(grads) == 0:
+        return
+    weight = 1 if num_samples is None else num_samples
+    flat = torch.cat([g.flatten() * weight for g in grads] + [torch.tensor([float(weight)], device=grads[0].device)])
+    dist.all_reduce(flat, group=group)
+    flat = flat[:-1] / flat[-1]
+    offset = 0
+    for g in grads:
+        g.copy_(flat[offset:offset + g.numel()].view_as(g))
+        offset += g.numel()
 
 
 def set_seed_everywhere(seed):
@@ -141,19 +221,95 @@ class FiLM(nn.Module):
         return F.relu(self.bn2(out))
 
 
+def conv_gather_map(height, width, conv, device):
+    """
+    For every output position and kernel position of conv on a height x width input, the flat index of the input
+    cell it reads, or -1 where it reads padding.
+    :return: (long tensor of shape (out_h * out_w, kernel_h * kernel_w), out_h, out_w)
+    """
+    assert conv.dilation == (1, 1) and conv.groups == 1
+    (kernel_h, kernel_w), (stride_h, stride_w), (pad_h, pad_w) = conv.kernel_size, conv.stride, conv.padding
+    out_h = (height + 2 * pad_h - kernel_h) // stride_h + 1
+    out_w = (width + 2 * pad_w - kernel_w) // stride_w + 1
+    rows = (torch.arange(out_h) * stride_h - pad_h)[:, None, None, None] + torch.arange(kernel_h)[None, None, :, None]
+    cols = (torch.arange(out_w) * stride_w - pad_w)[None, :, None, None] + torch.arange(kernel_w)[None, None, None, :]
+    valid = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+    index = (rows * width + cols).masked_fill(~valid, -1)
+    return index.reshape(out_h * out_w, kernel_h * kernel_w).to(device), out_h, out_w
+
+
 class ImageBOWEmbedding(nn.Module):
     def __init__(self, max_value, embedding_dim):
         super().__init__()
         self.max_value = max_value
         self.embedding_dim = embedding_dim
         self.embedding = nn.Embedding(3 * max_value, embedding_dim)
+        self.register_buffer('offsets', torch.LongTensor([0, max_value, 2 * max_value]), persistent=False)
+        self.gather_maps = {}
+        self.table_cache = None
         self.apply(weight_init)
 
     def forward(self, inputs):
-        offsets = torch.Tensor([0, self.max_value, 2 * self.max_value]).to(inputs.device)
-        inputs = (inputs + offsets[None, :, None, None]).long()
+        inputs = inputs.long() + self.offsets[None, :, None, None]
         return self.embedding(inputs).sum(1).permute(0, 3, 1, 2)
 
+    def conv_table(self, conv, skip_empty):
+        """
+        The first conv is linear in the embeddings, so its contribution from a cell holding embedding row r at kernel
+        position k is the fixed vector table[r * K + k]. The table has an extra zero row at the end for padding.
+        With skip_empty, each channel's row for value 0 (empty cell) is subtracted from that channel's rows, and the
+        contribution of an all-empty input (plus the conv bias) is returned separately, per output position.
+        Cached under no_grad until the weights change (e.g. after an optimizer step).
+        """
+        params = [self.embedding.weight, conv.weight, conv.bias]
+        key = (tuple(p._version for p in params), self.embedding.weight.device, skip_empty)
+        cacheable = not (torch.is_grad_enabled() and any(p.requires_grad for p in params))
+        if cacheable and self.table_cache is not None and self.table_cache[0] == key:
+            return self.table_cache[1]
+        num_kernel = conv.weight.shape[2] * conv.weight.shape[3]
+        table = torch.einsum('rc,ockl->rklo', self.embedding.weight, conv.weight).reshape(
+            3 * self.max_value, num_kernel, -1)
+        empty = None
+        if skip_empty:
+            table = table.view(3, self.max_value, num_kernel, -1)
+            empty = table[:, 0].sum(0)  # (num_kernel, out_channels)
+            table = (table - table[:, :1]).view(3 * self.max_value, num_kernel, -1)
+        table = table.reshape(3 * self.max_value * num_kernel, -1)
+        table = torch.cat([table, torch.zeros_like(table[:1])])
+        if cacheable:
+            self.table_cache = (key, (table, empty))
+        return table, empty
+
+    def forward_conv(self, inputs, conv, skip_empty=False):
+        """
+        Equivalent to conv(self(inputs)), but sums precomputed (value, kernel position) entries of conv_table with
+        F.embedding_bag instead of materializing the embedded image.
+        :param skip_empty: only gather the cells which aren't entirely 0 (the padding around egocentric grids)
+        """
+        batch_size, _, height, width = inputs.shape
+        key = (height, width, inputs.device)
+        if key not in self.gather_maps:
+            self.gather_maps[key] = conv_gather_map(height, width, conv, inputs.device)
+        index, out_h, out_w = self.gather_maps[key]
+        num_positions, num_kernel = index.shape
+        table, empty = self.conv_table(conv, skip_empty)
+        rows = (inputs.long() + self.offsets[None, :, None, None]).flatten(2)
+        cells = rows[:, :, index.clamp(min=0)]  # (batch, 3, positions, kernel)
+        entries = cells * num_kernel + torch.arange(num_kernel, device=inputs.device)
+        if not skip_empty:
+            entries = entries.masked_fill(index < 0, len(table) - 1)
+            entries = entries.permute(0, 2, 1, 3).reshape(batch_size * num_positions, 3 * num_kernel)
+            out = F.embedding_bag(entries, table, mode='sum').view(batch_size, num_positions, -1) + conv.bias
+        else:
+            occupied = (inputs != 0).any(1).flatten(1)[:, index.clamp(min=0)] & (index >= 0)
+            entries = entries.permute(0, 2, 3, 1)[occupied].reshape(-1)
+            counts = occupied.view(batch_size * num_positions, num_kernel).sum(1) * 3
+            offsets = counts.cumsum(0) - counts
+            out = F.embedding_bag(entries, table, offsets, mode='sum').view(batch_size, num_positions, -1)
+            base = ((index >= 0).float() @ empty) + conv.bias
+            out = out + base
+        return out.permute(0, 2, 1).reshape(batch_size, -1, out_h, out_w)
+
 
 class TanhTransform(pyd.transforms.Transform):
     domain = pyd.constraints.real
@@ -302,13 +458,22 @@ class InstrEmbedding(nn.Module):
     def _get_instr_embedding(self, instr):
         lengths = (instr != 0).sum(1).long()
         out, _ = self.instr_rnn(self.word_embedding(instr))
-        hidden = out[range(len(lengths)), lengths - 1, :]
+        # Output at each instruction's last token. (A gather rather than indexing with range(batch), so that traced
+        # modules aren't tied to one batch size.)
+        index = (lengths - 1).view(-1, 1, 1).expand(-1, 1, out.shape[2])
+        hidden = out.gather(1, index)[:, 0]
         return hidden
 
 
 class ImageEmbedding(nn.Module):
-    def __init__(self):
+    def __init__(self, fused=False, skip_empty=False):
+        """
+        :param fused: compute the embedding and first conv together with ImageBOWEmbedding.forward_conv
+        :param skip_empty: (fused only) skip empty cells
+        """
         super().__init__()
+        self.fused = fused
+        self.skip_empty = skip_empty
         self.image_conv = nn.Sequential(*[
             ImageBOWEmbedding(147, 128),
             nn.Conv2d(
@@ -328,6 +493,10 @@ class ImageEmbedding(nn.Module):
 
     def forward(self, obs):
         inputs = torch.transpose(torch.transpose(obs.obs, 1, 3), 2, 3)
-        obs.obs = self.image_conv(inputs)
+        if self.fused:
+            x = self.image_conv[0].forward_conv(inputs, self.image_conv[1], skip_empty=self.skip_empty)
+            obs.obs = self.image_conv[2:](x)
+        else:
+            obs.obs = self.image_conv(inputs)
         return obs
 
@@ -1,7 +1,19 @@
-from collections import OrderedDict
+# Level modules are imported lazily (see level_registry) so that importing this package stays cheap.
+# Their gym ids are registered the first time a module is imported.
+import importlib
 
-from . import iclr19_levels
-from . import bonus_levels
-from . import test_levels
+_LAZY_MODULES = ['iclr19_levels', 'bonus_levels', 'test_levels']
 
-from .levelgen import test, level_dict
+
+def __getattr__(name):
+    if name in _LAZY_MODULES:
+        return importlib.import_module('.' + name, __name__)
+    if name == 'level_dict':
+        from .level_registry import load_all_levels
+        return load_all_levels()
+    if name == 'test':
+        from .level_registry import load_all_levels
+        load_all_levels()
+        from .levelgen import test
+        return test
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,188 @@
+"""
+Lazy registry of the levels used by EnvDist.
+Maps level indices (and names) to import paths, so that a level's module (and, for D4RL, MuJoCo) is only imported,
+and its gym ids only registered, the first time the level is actually built.
+"""
+import importlib
+
+ICLR19_LEVELS = 'envs.babyai.levels.iclr19_levels'
+BONUS_LEVELS = 'envs.babyai.levels.bonus_levels'
+TEST_LEVELS = 'envs.babyai.levels.test_levels'
+LEVEL_MODULES = [ICLR19_LEVELS, BONUS_LEVELS, TEST_LEVELS]
+
+# Index --> (module, class name) for env == 'babyai'
+BABYAI_LEVELS = [
+    # Easy levels
+    (ICLR19_LEVELS, 'Level_GoToRedBallNoDists'),  # 0 --> intro L, R, Forward PreAction, Explore and GoNextTo subgoals
+    (ICLR19_LEVELS, 'Level_GoToRedBallGrey'),  # 1 --> first level with distractors
+    (ICLR19_LEVELS, 'Level_GoToRedBall'),  # 2 --> first level with colored distractors
+    (ICLR19_LEVELS, 'Level_GoToObjS5'),  # 3 --> first level where the goal is something other than a red ball
+    (ICLR19_LEVELS, 'Level_GoToLocalS5N2'),  # 4 --> first level where the task means something
+    (ICLR19_LEVELS, 'Level_PickupLocalS5N2'),  # 5 --> intro Pickup subgoal and pickup PreAction
+    (ICLR19_LEVELS, 'Level_PutNextLocalS5N2'),  # 6 --> intro Drop subgoal and drop PreAction
+    (ICLR19_LEVELS, 'Level_OpenLocalS5N2'),  # 7 --> intro Open subgoal and open PreAction
+    # Medium levels (here we introduce the harder teacher; no new tasks, just larger sizes)
+    (ICLR19_LEVELS, 'Level_GoToObjS7'),  # 8
+    (ICLR19_LEVELS, 'Level_GoToLocalS7N4'),  # 9
+    (ICLR19_LEVELS, 'Level_PickupLocalS7N4'),  # 10
+    (ICLR19_LEVELS, 'Level_PutNextLocalS7N4'),  # 11
+    (ICLR19_LEVELS, 'Level_OpenLocalS7N4'),  # 12
+    # Hard levels (bigger sizes, some new tasks)
+    (ICLR19_LEVELS, 'Level_GoToObj'),  # 13
+    (ICLR19_LEVELS, 'Level_GoToLocal'),  # 14
+    (ICLR19_LEVELS, 'Level_PickupLocal'),  # 15
+    (ICLR19_LEVELS, 'Level_PutNextLocal'),  # 16
+    (ICLR19_LEVELS, 'Level_OpenLocal'),  # 17
+    # Biggest levels (larger grid)
+    (ICLR19_LEVELS, 'Level_GoToObjMazeOpen'),  # 18
+    (ICLR19_LEVELS, 'Level_GoToOpen'),  # 19
+    (ICLR19_LEVELS, 'Level_GoToObjMazeS4R2'),  # 20
+    (ICLR19_LEVELS, 'Level_GoToObjMazeS5'),  # 21
+    (ICLR19_LEVELS, 'Level_Open'),  # 22
+    (ICLR19_LEVELS, 'Level_GoTo'),  # 23
+    (ICLR19_LEVELS, 'Level_Pickup'),  # 24
+    (ICLR19_LEVELS, 'Level_PutNext'),  # 25
+    (ICLR19_LEVELS, 'Level_PickupObjBigger'),  # 26 test0 (larger sizes than we've seen before)
+    (ICLR19_LEVELS, 'Level_GoToObjDistractors'),  # 27 test1 (more distractors than we've seen before)
+    (ICLR19_LEVELS, 'Level_GoToHeldout'),  # 28 test2 (new object)
+    (ICLR19_LEVELS, 'Level_GoToGreenBox'),  # 29 test3 (task we've seen before, but new instructions)
+    (ICLR19_LEVELS, 'Level_PutNextSameColor'),  # 30 test4
+    (ICLR19_LEVELS, 'Level_Unlock'),  # 31 test5 ("unlock" is a completely new instruction)
+    (ICLR19_LEVELS, 'Level_GoToImpUnlock'),  # 32 test6
+    (ICLR19_LEVELS, 'Level_UnblockPickup'),  # 33 test7 (known task, but now there's the extra step of unblocking)
+    (ICLR19_LEVELS, 'Level_Seek'),  # 34 test8
+    # Easier heldout levels
+    (ICLR19_LEVELS, 'Level_GoToGreenBoxLocal'),  # 35 test9
+    (ICLR19_LEVELS, 'Level_PutNextSameColorLocal'),  # 36 test10
+    (ICLR19_LEVELS, 'Level_UnlockLocal'),  # 37 test11 ("unlock" is a completely new instruction)
+    (ICLR19_LEVELS, 'Level_GoToImpUnlockLocal'),  # 38 test12
+    (ICLR19_LEVELS, 'Level_SeekLocal'),  # 39 test13
+    (ICLR19_LEVELS, 'Level_GoToObjDistractorsLocal'),  # 40 test14
+    (ICLR19_LEVELS, 'Level_GoToSmall2by2'),  # 41 test15
+    (ICLR19_LEVELS, 'Level_GoToSmall3by3'),  # 42 test16
+    (ICLR19_LEVELS, 'Level_SeekSmall2by2'),  # 43 test17
+    (ICLR19_LEVELS, 'Level_SeekSmall3by3'),  # 44 test18
+    (ICLR19_LEVELS, 'Level_GoToObjDistractorsLocalBig'),  # 45 test19
+    (ICLR19_LEVELS, 'Level_OpenSmall2by2'),  # 46 test20
+    (ICLR19_LEVELS, 'Level_OpenSmall3by3'),  # 47 test21
+    (ICLR19_LEVELS, 'Level_SeekL0'),  # 48 test22
+    (ICLR19_LEVELS, 'Level_UnlockTopLeft'),  # 49 UnlockTopLeft
+    (ICLR19_LEVELS, 'Level_UnlockTopLeftRed'),  # 50 UnlockTopLeft, only red door/key
+    (ICLR19_LEVELS, 'Level_UnlockTopLeftFixedStart'),  # 51 Agent always starts in same place
+    (ICLR19_LEVELS, 'Level_UnlockTopLeftFixedDoor'),  # 52 Agent always ends in same place
+    (ICLR19_LEVELS, 'Level_UnlockTopLeftFixedKey'),  # 53 Key is always in same place
+    (ICLR19_LEVELS, 'Level_UnlockTopLeftFixedKeyDoor'),  # 54 Key and door are always in same place
+    (ICLR19_LEVELS, 'Level_UnlockTopLeftFixedAll'),  # 55 Agent, key and door are always in same place
+    (ICLR19_LEVELS, 'Level_GoToRed'),  # 56 GoTo, but target is always red ball
+    (ICLR19_LEVELS, 'Level_GoToObjDistractorsRed'),  # 57 Like L27 (bigger, more dists) but red only
+    (ICLR19_LEVELS, 'Level_UnlockFixedKeyMedium'),  # 58 Key is always in same place, grid is bigger
+    (ICLR19_LEVELS, 'Level_PutNextSameColorRed'),  # 59 Like 30, but always same target
+    (ICLR19_LEVELS, 'Level_UnlockRed'),  # 60 Like 31, but always same target
+]
+
+# Index --> (gym env name, extra constructor kwargs). '{reward_env_name}' is filled in by EnvDist.
+POINT_MASS_LEVELS = [
+    ('maze2d-open{reward_env_name}-v0', {}),  # 0
+    ('maze2d-umaze{reward_env_name}-v1', {}),  # 1
+    ('maze2d-medium{reward_env_name}-v1', {}),  # 2
+    ('maze2d-large{reward_env_name}-v1', {}),  # 3
+    ('maze2d-randommaze-v0', {}),  # 4
+    ('maze2d-umaze{reward_env_name}-v1', {'reset_target': False}),  # 5
+    ('maze2d-medium{reward_env_name}-v1', {'reset_target': False}),  # 6
+    ('maze2d-large{reward_env_name}-v1', {'reset_target': False}),  # 7
+    ('maze2d-umaze{reward_env_name}-v1', {'reset_target': False, 'reset_start': False}),  # 8
+    ('maze2d-medium{reward_env_name}-v1', {'reset_target': False, 'reset_start': False}),  # 9
+    ('maze2d-large{reward_env_name}-v1', {'reset_target': False, 'reset_start': False}),  # 10
+    ('maze2d-randommaze-7x7-v0', {}),  # 11
+    ('maze2d-randommaze-8x8-v0', {}),  # 12
+    ('maze2d-12x12-v0', {}),  # 13
+    ('maze2d-15x15-v0', {}),  # 14
+]
+
+ANT_LEVELS = [
+    ('antmaze-umaze-v0', {}),  # 0
+    ('antmaze-umaze-diverse-v0', {}),  # 1
+    ('antmaze-medium-diverse-v0', {}),  # 2
+    ('antmaze-large-diverse-v0', {}),  # 3
+    ('antmaze-open-v0', {}),  # 4
+    ('antmaze-umaze-easy-v0', {}),  # 5
+    ('antmaze-randommaze-v0', {}),  # 6
+    ('antmaze-randommaze-small-v0', {}),  # 7
+    ('antmaze-randommaze-medium-v0', {}),  # 8
+    ('antmaze-randommaze-large-v0', {}),  # 9
+    ('antmaze-randommaze-huge-v0', {}),  # 10
+    ('antmaze-6x6-v0', {}),  # 11
+] + [(f'antmaze-fixed{i}-6x6-v0', {}) for i in range(10)]  # 12-21
+
+# env type --> (modules to import first, e.g. for gym registration, (module, class name) of the env)
+ENV_CLASSES = {
+    'dummy': ([], ('envs.dummy_envs', 'PointMassEnvSimple')),
+    'dummy_discrete': ([], ('envs.dummy_envs', 'DummyDiscrete')),
+    'point_mass': (['envs.d4rl.d4rl_content.pointmaze'], ('envs.d4rl_envs', 'PointMassEnv')),
+    'ant': (['envs.d4rl.d4rl_content.locomotion'], ('envs.d4rl_envs', 'AntEnv')),
+}
+
+NUM_LEVELS = {
+    'dummy': 1,
+    'dummy_discrete': 1,
+    'point_mass': len(POINT_MASS_LEVELS),
+    'ant': len(ANT_LEVELS),
+    'babyai': len(BABYAI_LEVELS),
+}
+
+_class_cache = {}
+
+
+def import_class(module_name, class_name):
+    """ Import (and cache) a class given its module path. Importing a level module registers its gym ids. """
+    key = (module_name, class_name)
+    if key not in _class_cache:
+        _class_cache[key] = getattr(importlib.import_module(module_name), class_name)
+    return _class_cache[key]
+
+
+def get_babyai_level(index):
+    """
+    :param index: EnvDist index of a BabyAI level
+    :return: the level class, importing its module if necessary
+    """
+    if not 0 <= index < len(BABYAI_LEVELS):
+        raise NotImplementedError(index)
+    return import_class(*BABYAI_LEVELS[index])
+
+
+def get_level_by_name(level_name):
+    """
+    Look up a BabyAI level class by name (with or without the 'Level_' prefix).
+    Indexed levels resolve directly; other names import the level modules one at a time until the class is found.
+    """
+    class_name = level_name if level_name.startswith('Level_') else 'Level_' + level_name
+    for module_name, name in BABYAI_LEVELS:
+        if name == class_name:
+            return import_class(module_name, name)
+    for module_name in LEVEL_MODULES:
+        module = importlib.import_module(module_name)
+        if hasattr(module, class_name):
+            return import_class(module_name, class_name)
+    raise KeyError(level_name)
+
+
+def get_env_class(env):
+    """
+    :param env: env type (one of the keys of ENV_CLASSES)
+    :return: the env class, after importing any modules it needs (e.g. to register D4RL gym ids)
+    """
+    if env not in ENV_CLASSES:
+        raise NotImplementedError(env)
+    modules, (module_name, class_name) = ENV_CLASSES[env]
+    for module_name_to_import in modules:
+        importlib.import_module(module_name_to_import)
+    return import_class(module_name, class_name)
+
+
+def load_all_levels():
+    """ Eagerly import every level module, registering all BabyAI gym ids and filling levelgen.level_dict. """
+    for module_name in LEVEL_MODULES:
+        importlib.import_module(module_name)
+    from envs.babyai.levels.levelgen import level_dict
+    return level_dict
@@ -17,6 +17,7 @@ from envs.babyai.oracle.xy_corrections import XYCorrections
 from envs.babyai.oracle.batch_teacher import BatchTeacher
 from envs.babyai.oracle.dummy_advice import DummyAdvice
 from envs.babyai.bot import Bot
+from envs.obs_schema import BABYAI_OBS_SCHEMA
 
 
 class Level_TeachableRobot(RoomGridLevel):
@@ -305,22 +306,11 @@ class Level_TeachableRobot(RoomGridLevel):
         :return: np array of the agent's observation
         """
         if self.padding:
+            # Only the room-sized grid is stored; centering on the agent and rotating into its frame happens at
+            # batch time (see pad_egocentric in the obs preprocessor).
             image = self.get_full_observation()
-            h, w, c = image.shape
-            image = np.rot90(image, k=self.agent_dir)
-            if self.agent_dir == 0:
-                x = self.agent_pos[0]
-                y = self.agent_pos[1]
-            elif self.agent_dir == 1:
-                x = w - self.agent_pos[1] - 1
-                y = self.agent_pos[0]
-            elif self.agent_dir == 2:
-                x = w - self.agent_pos[0] - 1
-                y = h - self.agent_pos[1] - 1
-            elif self.agent_dir == 3:
-                x = self.agent_pos[1]
-                y = h - self.agent_pos[0] - 1
-            image = (image, x, y)
+            x, y = self.agent_pos
+            image = (image, int(x), int(y), int(self.agent_dir))
         elif self.fully_observed:
             image = self.get_full_observation()
         else:
@@ -332,7 +322,7 @@ class Level_TeachableRobot(RoomGridLevel):
 
         goal = self.to_vocab_index(self.mission, pad_length=15)
         obs_dict = {}
-        additional = deepcopy(np.concatenate([[self.agent_dir], self.agent_pos]))
+        additional = np.concatenate([[self.agent_dir], self.agent_pos])
         obs_dict["obs"] = image
         obs_dict['instr'] = goal
         obs_dict['extra'] = additional
@@ -343,7 +333,7 @@ class Level_TeachableRobot(RoomGridLevel):
                 past_action = self.get_teacher_action()
             correction = self.compute_teacher_advice(image, past_action, oracle)
             obs_dict.update(correction)
-        return obs_dict
+        return BABYAI_OBS_SCHEMA.cast(obs_dict)
 
     def compute_teacher_advice(self, obs, next_action, oracle):
         if self.reset_yet is False:
@@ -398,7 +388,6 @@ class Level_TeachableRobot(RoomGridLevel):
             original_oracle = None
             info['teacher_action'] = np.array(self.action_space.n, dtype=np.int32)
         obs = self.gen_obs(oracle=original_oracle, generate_feedback=True, past_action=action)
-        info['next_obs'] = obs
         # Reward at the end scaled by 1000
         if self.args.reward_type == 'dense':
             provided_reward = True
@@ -1,4 +1,5 @@
 import random
+import threading
 import uuid
 
 import numpy as np
@@ -6,14 +7,15 @@ import pathlib
 import pickle as pkl
 import torch
 
-from utils.dictlist import merge_dictlists, DictList
+from utils.dictlist import TensorBatch
+from envs.babyai.utils.obs_preprocessor import MAX_MAZES, MAZES, register_maze
 
 
 def trim_batch(batch):
     # Remove keys which aren't useful for distillation
     batch_info = {
         "obs": batch.obs,
-        "next_obs": batch.next_obs,
+        "terminal_obs": batch.terminal_obs,
         "action": batch.action,
         "full_done": batch.full_done,
         "success": batch.env_infos.success,
@@ -29,7 +31,20 @@ def trim_batch(batch):
     if 'reward' in batch:
         batch_info['reward'] = batch.reward
 
-    return DictList(batch_info)
+    return TensorBatch(batch_info)
+
+
+def reconstruct_next_obs(obs, terminal_obs, indices=None):
+    """
+    Recover next observations from a sequence of stored observations.
+    next_obs[i] is obs[i + 1] (wrapping around, since the buffer is a ring), except at the end of a trajectory,
+    where the final observation is stored in terminal_obs[i].
+    :param indices: positions to reconstruct (default: all of them)
+    """
+    n = len(obs)
+    if indices is None:
+        indices = range(n)
+    return [obs[(i + 1) % n] if terminal_obs[i] is None else terminal_obs[i] for i in indices]
 
 
 class Buffer:
@@ -38,21 +53,75 @@ class Buffer:
         # We don't need that many val samples
         self.val_buffer_capacity = max(1, int(buffer_capacity * val_prob))
         self.counts_train, self.index_train, self.counts_val, self.index_val = 0, 0, 0, 0
+        self.loaded = True
         self.trajs_train, self.trajs_val = None, None
         self.buffer_path = pathlib.Path(path).joinpath(buffer_name)
         self.successful_only = successful_only
         self.num_feedback = 0
-        # If the buffer already exists, load it
+        # Incremented on every write, so samplers running in the background can tell when their batches are stale
+        self.version = 0
+        # Incremented only when trajectories are added (so rows may have been overwritten)
+        self.num_batches_added = 0
+        self.lock = threading.RLock()
+        # D4RL maze grids the stored obs refer to, by maze id. Obs only carry their maze's id (except on reset), so the
+        # table is saved with the data and shipped to whichever process samples from the buffer.
+        self.mazes = {}
+        # If the buffer already exists, restore its counters now and load the data once it's first used. The first
+        # add_batch or sample still reads the whole pickle; CompressedBuffer reads its data block by block instead.
         if self.buffer_path.exists():
-            self.load_buffer()
+            self.load_mazes()
+            if not self.load_stats():
+                self.load_buffer()
         else:
             self.buffer_path.mkdir()
         self.val_prob = val_prob
         self.added_count = 0
         self.total_count = 0
 
+    @property
+    def trajs_train(self):
+        if not self.loaded:
+            self.load_buffer()
+        return self._trajs_train
+
+    @trajs_train.setter
+    def trajs_train(self, value):
+        self._trajs_train = value
+
+    @property
+    def trajs_val(self):
+        if not self.loaded:
+            self.load_buffer()
+        return self._trajs_val
+
+    @trajs_val.setter
+    def trajs_val(self, value):
+        self._trajs_val = value
+
+    def load_stats(self):
+        """
+        Restore the counters saved by update_stats, deferring loading the data itself until it's accessed.
+        For this class that only moves the full load to the first add_batch or sample; CompressedBuffer only loads the
+        blocks which are touched.
+        :return: whether there were stats to restore
+        """
+        stats_path = self.buffer_path.joinpath('buffer_stats.pkl')
+        if not stats_path.exists():
+            return False
+        with open(stats_path, 'rb') as f:
+            counts_train, index_train, counts_val, index_val, self.num_feedback = pkl.load(f)
+        # Trimmed the same way as in load_buffer
+        self.counts_train = min(counts_train, self.train_buffer_capacity)
+        self.index_train = min(index_train, self.train_buffer_capacity - 1)
+        self.counts_val = min(counts_val, self.val_buffer_capacity)
+        self.index_val = min(index_val, self.val_buffer_capacity - 1)
+        self.loaded = False
+        print("restored buffer counters", self.buffer_path.resolve(), self.counts_train, self.counts_val)
+        return True
+
     def load_buffer(self):
         """ Load buffer from pkl file. """
+        self.loaded = True
         train_path = self.buffer_path.joinpath(f'train_buffer.pkl')
         if train_path.exists():
             with open(train_path, 'rb') as f:
@@ -60,7 +129,8 @@ class Buffer:
             # if buffers are too big, trim them
             self.counts_train = min(self.counts_train, self.train_buffer_capacity)
             self.index_train = min(self.index_train, self.train_buffer_capacity - 1)
-            self.trajs_train = self.trajs_train[:self.train_buffer_capacity]
+            self.trajs_train = TensorBatch(self.trajs_train)[:self.train_buffer_capacity]
+            self.convert_next_obs(self.trajs_train)
 
         val_path = self.buffer_path.joinpath(f'val_buffer.pkl')
         if val_path.exists():
@@ -69,9 +139,47 @@ class Buffer:
             # if buffers are too big, trim them
             self.counts_val = min(self.counts_val, self.val_buffer_capacity)
             self.index_val = min(self.index_val, self.val_buffer_capacity - 1)
-            self.trajs_val = self.trajs_val[:self.val_buffer_capacity]
+            self.trajs_val = TensorBatch(self.trajs_val)[:self.val_buffer_capacity]
+            self.convert_next_obs(self.trajs_val)
         print("loaded buffer", train_path.resolve(), self.counts_train, self.counts_val)
 
+    def load_mazes(self):
+        mazes_path = self.buffer_path.joinpath('mazes.pkl')
+        if mazes_path.exists():
+            with open(mazes_path, 'rb') as f:
+                self.mazes = pkl.load(f)
+
+    def add_mazes(self, obs):
+        """ Add the grids carried by a batch's (reset) obs to the maze table. """
+        for o in obs:
+            if o is not None and 'maze' in o:
+                self.mazes[int(o['maze_id'])] = o['maze']
+
+    def prune_mazes(self):
+        """ Drop mazes which no stored obs refers to any more (e.g. on random-maze levels). """
+        used = set()
+        for split in ['train', 'val']:
+            for _, chunk, _ in self.iter_chunks(split, keys=['obs', 'terminal_obs']):
+                used.update(int(o['maze_id']) for o in chunk.obs + chunk.terminal_obs
+                            if o is not None and 'maze_id' in o)
+        self.mazes = {maze_id: maze for maze_id, maze in self.mazes.items() if maze_id in used}
+
+    def provide_mazes(self, obs):
+        """ Make sure this process can expand the mazes a sampled batch refers to (see expand_maze_obs). """
+        if not self.mazes:
+            return
+        for maze_id in {int(o['maze_id']) for o in obs if o is not None and 'maze_id' in o}:
+            if maze_id not in MAZES and maze_id in self.mazes:
+                register_maze(maze_id, self.mazes[maze_id])
+
+    def convert_next_obs(self, trajs):
+        """ Older buffers stored a full next_obs column. Keep only the final obs of each traj (as terminal_obs). """
+        if 'next_obs' not in trajs:
+            return
+        next_obs = trajs.next_obs
+        trajs.terminal_obs = [next_o if done else None for next_o, done in zip(next_obs, trajs.full_done)]
+        del trajs['next_obs']
+
     def create_blank_buffer(self, batch):
         """ Create blank buffer with all keys. (We don't do this at startup b/c we don't know all the batch keys.) """
         batch = trim_batch(batch)
@@ -84,11 +192,12 @@ class Buffer:
                     train_dict[key] = [None] * self.train_buffer_capacity
                     val_dict[key] = [None] * self.val_buffer_capacity
                 elif type(value) is torch.Tensor:
+                    # Keep the collected dtype (e.g. int32 actions, float16 action probs) rather than upcasting
                     shape = value.shape
-                    tensor_class = torch.IntTensor if value.dtype is torch.int32 else torch.FloatTensor
+                    dtype = value.dtype
                     device = value.device
-                    train_dict[key] = tensor_class(size=(self.train_buffer_capacity, *shape[1:])).to(device)
-                    val_dict[key] = tensor_class(size=(self.val_buffer_capacity, *shape[1:])).to(device)
+                    train_dict[key] = torch.zeros((self.train_buffer_capacity, *shape[1:]), dtype=dtype, device=device)
+                    val_dict[key] = torch.zeros((self.val_buffer_capacity, *shape[1:]), dtype=dtype, device=device)
                 elif type(value) is np.ndarray:
                     shape = value.shape
                     dtype = value.dtype
@@ -98,8 +207,8 @@ class Buffer:
                     raise NotImplementedError((key, type(value)))
             except:
                 print("?", key)
-        self.trajs_train = DictList(train_dict)
-        self.trajs_val = DictList(val_dict)
+        self.trajs_train = TensorBatch(train_dict)
+        self.trajs_val = TensorBatch(val_dict)
 
         pass
 
@@ -123,6 +232,11 @@ class Buffer:
     def save_traj(self, traj, index, split):
         """ Insert a trajectory into the buffer """
         value = self.trajs_train if split == 'train' else self.trajs_val
+        # If the slot before this one holds the middle of an older traj, its next obs (obs[index]) is about to be
+        # overwritten. Keep it around as a terminal obs.
+        prev = (index - 1) % len(value.obs)
+        if value.terminal_obs[prev] is None and value.obs[index] is not None and value.obs[prev] is not None:
+            value.terminal_obs[prev] = value.obs[index]
         max_val = min(len(traj), len(value) - index)
         # We can fit the entire traj in
         for k in value:
@@ -175,12 +289,61 @@ class Buffer:
     def add_batch(self, batch, trim=True, only_val=False, save=True):
         """ Save a batch of data and update counters. Data is a Dictlist of timesteps of sequential trajs.
          This is the function which is called externally. """
-        if self.trajs_train is None:
-            self.create_blank_buffer(batch)
-        self.add_trajs(batch, trim, only_val)
-        if save:
-            self.save_buffer()
-            self.update_stats(batch)
+        with self.lock:
+            if self.trajs_train is None:
+                self.create_blank_buffer(batch)
+            self.add_mazes(batch.obs)
+            self.add_trajs(batch, trim, only_val)
+            if len(self.mazes) > MAX_MAZES:
+                self.prune_mazes()
+            self.version += 1
+            self.num_batches_added += 1
+            if save:
+                self.save_buffer()
+                self.update_stats(batch)
+
+    def iter_chunks(self, split='train', chunk_size=1024, keys=None):
+        """
+        Iterate over the filled part of a split in chunks, e.g. to rewrite a column with write_column.
+        Each chunk is read under the lock, but the buffer may change between chunks.
+        :return: generator of (start index, TensorBatch of rows start:start + chunk_size, num_batches_added at read time)
+        """
+        trajs = self.trajs_train if split == 'train' else self.trajs_val
+        counts = self.counts_train if split == 'train' else self.counts_val
+        keys = list(trajs.keys()) if keys is None else keys
+        for start in range(0, counts, chunk_size):
+            with self.lock:
+                trajs = self.trajs_train if split == 'train' else self.trajs_val
+                chunk = TensorBatch({k: getattr(trajs, k) for k in keys})[start:start + chunk_size]
+                num_batches_added = self.num_batches_added
+            yield start, chunk, num_batches_added
+
+    def write_column(self, split, key, start, values, num_batches_added=None, bump_version=True):
+        """
+        Overwrite rows start:start + len(values) of one column.
+        :param num_batches_added: if given, skip the write if trajectories were added since then (since the rows may
+        hold different transitions now)
+        :param bump_version: whether to invalidate batches sampled before the write. A caller making many writes (e.g.
+        a relabeling pass) can pass False and call mark_changed once it's done.
+        :return: whether the values were written
+        """
+        with self.lock:
+            if num_batches_added is not None and num_batches_added != self.num_batches_added:
+                return False
+            column = getattr(self.trajs_train if split == 'train' else self.trajs_val, key)
+            if type(column) is torch.Tensor:
+                values = torch.as_tensor(values).to(device=column.device, dtype=column.dtype)
+                column[start:start + len(values)] = values.reshape(-1, *column.shape[1:])
+            else:
+                column[start:start + len(values)] = values
+            if bump_version:
+                self.version += 1
+            return True
+
+    def mark_changed(self):
+        """ Invalidate batches sampled before now, e.g. after a series of write_column(..., bump_version=False). """
+        with self.lock:
+            self.version += 1
 
     def update_stats(self, batch):
         """ Save pointers to our current index in the buffer and some counts. """
@@ -190,16 +353,22 @@ class Buffer:
         buffer_stats = self.counts_train, self.index_train, self.counts_val, self.index_val, self.num_feedback
         with open(self.buffer_path.joinpath('buffer_stats.pkl'), 'wb') as f:
             pkl.dump(buffer_stats, f)
+        if self.mazes:
+            self.safe_save(self.mazes, self.buffer_path.joinpath('mazes.pkl'))
 
     def sample(self, total_num_samples=None, split='train'):
         """ Sample a batch. """
         if split == 'train' or self.counts_val == 0:  # Early in training we may not have any val trajs yet
+            trajs = self.trajs_train  # Loads the buffer (and its counters) if it hasn't been yet
             counts = self.counts_train
-            trajs = self.trajs_train
         else:
-            counts = self.counts_val
             trajs = self.trajs_val
+            counts = self.counts_val
 
-        indices = np.random.randint(0, counts, size=total_num_samples)
-        data = merge_dictlists([trajs[i:i + 1] for i in indices])
+        with self.lock:
+            indices = np.random.randint(0, counts, size=total_num_samples)
+            data = trajs[indices]
+            data.next_obs = reconstruct_next_obs(trajs.obs, trajs.terminal_obs, indices)
+        del data['terminal_obs']
+        self.provide_mazes(data.obs + data.next_obs)
         return data
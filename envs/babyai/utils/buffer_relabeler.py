@@ -0,0 +1,64 @@
+import threading
+
+import torch
+
+
+class BufferRelabeler:
+    """
+    Rewrites a column of a Buffer (e.g. the action labels used for distillation) in a background thread, one chunk at
+    a time, so peak memory depends only on the chunk size.
+    Each chunk is written back only if no trajectories were added to the buffer while it was being labeled; rows added
+    since then were labeled when they were collected.
+    The buffer's version is bumped once, when the pass ends, rather than per chunk, so a PrefetchSampler keeps serving
+    batches during the pass (which may mix old and new labels, as a synchronous sample taken mid-pass would).
+    """
+
+    def __init__(self, buffer, label_fn, key='action', chunk_size=1024, splits=('train', 'val')):
+        """
+        :param buffer: Buffer to relabel
+        :param label_fn: function which takes a list of obs and returns a tensor of labels, one row per obs
+        :param key: column to overwrite
+        :param chunk_size: number of transitions labeled at once
+        :param splits: buffer splits to relabel
+        """
+        self.buffer = buffer
+        self.label_fn = label_fn
+        self.key = key
+        self.chunk_size = chunk_size
+        self.splits = splits
+        self.num_relabeled = 0
+        self.num_skipped = 0
+        self.error = None
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        num_relabeled = self.num_relabeled
+        try:
+            for split in self.splits:
+                for start, chunk, num_batches_added in self.buffer.iter_chunks(split, self.chunk_size, keys=['obs']):
+                    if self.stop_event.is_set():
+                        return
+                    with torch.no_grad():
+                        self.buffer.provide_mazes(chunk.obs)
+                        labels = self.label_fn(chunk.obs)
+                    if self.buffer.write_column(split, self.key, start, labels, num_batches_added, bump_version=False):
+                        self.num_relabeled += len(labels)
+                    else:
+                        self.num_skipped += len(labels)
+        except Exception as e:
+            self.error = e
+        finally:
+            if self.num_relabeled > num_relabeled:
+                self.buffer.mark_changed()
+
+    def done(self):
+        """ Whether the pass is finished. Re-raises any error from the background thread. """
+        if self.error is not None:
+            raise self.error
+        return not self.thread.is_alive()
+
+    def close(self):
+        self.stop_event.set()
+        self.thread.join()
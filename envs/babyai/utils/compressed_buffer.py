@@ -0,0 +1,306 @@
+import pickle as pkl
+from collections import OrderedDict
+
+import blosc
+import numpy as np
+import torch
+
+from envs.babyai.utils.buffer import Buffer, trim_batch
+from utils.dictlist import TensorBatch
+
+
+class BlockStore:
+    """
+    Ring storage for one split of a CompressedBuffer.
+    Transitions are grouped into fixed-size blocks; each column of a block is blosc-compressed separately. A small LRU
+    cache holds decompressed blocks; blocks are only (re)compressed when they are evicted or flushed.
+    """
+
+    def __init__(self, capacity, block_size, columns, cache_blocks=8):
+        """
+        :param capacity: number of transitions
+        :param block_size: number of transitions per block
+        :param columns: dict of column name --> ('list', None, None) or ('tensor'/'ndarray', dtype, shape per row)
+        :param cache_blocks: number of decompressed blocks to keep around
+        """
+        self.capacity = capacity
+        self.block_size = block_size
+        self.columns = columns
+        self.cache_blocks = cache_blocks
+        self.num_blocks = (capacity + block_size - 1) // block_size
+        self.blocks = [None] * self.num_blocks  # block id --> dict of column name --> compressed bytes
+        self.cache = OrderedDict()  # block id --> dict of column name --> np array or list
+        self.dirty = set()  # cached blocks which differ from their compressed version
+        self.unsaved = set()  # blocks which changed since the last save
+        self.loader = None  # optional function block id --> compressed block (or None), to read blocks on first use
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    def block_len(self, block_id):
+        return min(self.block_size, self.capacity - block_id * self.block_size)
+
+    def blank_block(self, block_id):
+        n = self.block_len(block_id)
+        block = {}
+        for key, (kind, dtype, shape) in self.columns.items():
+            block[key] = [None] * n if kind == 'list' else np.zeros((n, *shape), dtype=dtype)
+        return block
+
+    def compress(self, block):
+        compressed = {}
+        for key, value in block.items():
+            if type(value) is list:
+                compressed[key] = blosc.compress(pkl.dumps(value, protocol=pkl.HIGHEST_PROTOCOL), typesize=1)
+            else:
+                compressed[key] = blosc.pack_array(value)
+        return compressed
+
+    def decompress(self, compressed):
+        block = {}
+        for key, value in compressed.items():
+            if self.columns[key][0] == 'list':
+                block[key] = pkl.loads(blosc.decompress(value))
+            else:
+                block[key] = blosc.unpack_array(value)
+        return block
+
+    def get_block(self, block_id):
+        """ Return the decompressed block, decompressing it (and evicting the least recently used block) if needed. """
+        if block_id in self.cache:
+            self.cache.move_to_end(block_id)
+            return self.cache[block_id]
+        compressed = self.blocks[block_id]
+        if compressed is None and self.loader is not None:
+            compressed = self.blocks[block_id] = self.loader(block_id)
+        block = self.blank_block(block_id) if compressed is None else self.decompress(compressed)
+        self.cache[block_id] = block
+        while len(self.cache) > self.cache_blocks:
+            old_id, old_block = self.cache.popitem(last=False)
+            if old_id in self.dirty:
+                self.blocks[old_id] = self.compress(old_block)
+                self.dirty.discard(old_id)
+        return block
+
+    def flush(self):
+        """ Compress every modified block in the cache. """
+        for block_id in self.dirty:
+            self.blocks[block_id] = self.compress(self.cache[block_id])
+        self.dirty = set()
+
+    def write(self, index, traj):
+        """ Write a trajectory starting at index, wrapping around the end of the ring. """
+        converted = {}
+        for key in self.columns:
+            value = getattr(traj, key)
+            converted[key] = value.detach().cpu().numpy() if type(value) is torch.Tensor else value
+        start = 0
+        while start < len(traj):
+            pos = (index + start) % self.capacity
+            block_id, offset = divmod(pos, self.block_size)
+            n = min(len(traj) - start, self.block_len(block_id) - offset)
+            block = self.get_block(block_id)
+            for key, value in converted.items():
+                block[key][offset:offset + n] = value[start:start + n]
+            self.dirty.add(block_id)
+            self.unsaved.add(block_id)
+            start += n
+
+    def write_column(self, key, index, values):
+        """ Overwrite one column of the rows starting at index (which must not wrap around). """
+        kind, dtype, shape = self.columns[key]
+        if type(values) is torch.Tensor:
+            values = values.detach().cpu().numpy()
+        if kind != 'list':
+            values = np.asarray(values, dtype=dtype).reshape(len(values), *shape)
+        start = 0
+        while start < len(values):
+            block_id, offset = divmod(index + start, self.block_size)
+            n = min(len(values) - start, self.block_len(block_id) - offset)
+            self.get_block(block_id)[key][offset:offset + n] = values[start:start + n]
+            self.dirty.add(block_id)
+            self.unsaved.add(block_id)
+            start += n
+
+    def get(self, key, index):
+        block_id, offset = divmod(index, self.block_size)
+        return self.get_block(block_id)[key][offset]
+
+    def set(self, key, index, value):
+        block_id, offset = divmod(index, self.block_size)
+        self.get_block(block_id)[key][offset] = value
+        self.dirty.add(block_id)
+        self.unsaved.add(block_id)
+
+    def read(self, indices, keys=None):
+        """ Gather the rows at indices, decompressing only the blocks they fall in. """
+        indices = np.asarray(indices)
+        keys = list(self.columns) if keys is None else keys
+        block_ids = indices // self.block_size
+        out = {}
+        for key in keys:
+            kind, dtype, shape = self.columns[key]
+            out[key] = [None] * len(indices) if kind == 'list' else np.zeros((len(indices), *shape), dtype=dtype)
+        for block_id in np.unique(block_ids):
+            positions = np.nonzero(block_ids == block_id)[0]
+            rows = indices[positions] - block_id * self.block_size
+            block = self.get_block(block_id)
+            for key in keys:
+                if type(out[key]) is list:
+                    for p, r in zip(positions, rows):
+                        out[key][p] = block[key][r]
+                else:
+                    out[key][positions] = block[key][rows]
+        for key in keys:
+            if self.columns[key][0] == 'tensor':
+                out[key] = torch.from_numpy(out[key]).to(self.device)
+        return TensorBatch(out)
+
+    def __getstate__(self):
+        self.flush()
+        state = self.__dict__.copy()
+        state['cache'] = OrderedDict()
+        state['device'] = None
+        state['loader'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+class CompressedBuffer(Buffer):
+    """
+    Buffer which keeps transitions in blosc-compressed blocks rather than as raw arrays and lists.
+    Each block is saved to its own file, so saving only rewrites the blocks which changed.
+    """
+
+    def __init__(self, path, buffer_capacity, val_prob, buffer_name='buffer', successful_only=False,
+                 block_size=1024, cache_blocks=8):
+        self.block_size = block_size
+        self.cache_blocks = cache_blocks
+        super().__init__(path, buffer_capacity, val_prob, buffer_name, successful_only)
+
+    def split_store(self, split):
+        return self.trajs_train if split == 'train' else self.trajs_val
+
+    def create_stores(self, batch):
+        """ Create empty block stores with a column for every key of the (trimmed) batch. """
+        columns = {}
+        for key, value in batch.items():
+            if type(value) is list:
+                columns[key] = ('list', None, None)
+            elif type(value) is torch.Tensor:
+                columns[key] = ('tensor', value[:1].detach().cpu().numpy().dtype, tuple(value.shape[1:]))
+            elif type(value) is np.ndarray:
+                columns[key] = ('ndarray', value.dtype, value.shape[1:])
+            else:
+                raise NotImplementedError((key, type(value)))
+        self.trajs_train = BlockStore(self.train_buffer_capacity, self.block_size, columns, self.cache_blocks)
+        self.trajs_val = BlockStore(self.val_buffer_capacity, self.block_size, columns, self.cache_blocks)
+
+    def create_blank_buffer(self, batch):
+        self.create_stores(trim_batch(batch))
+
+    def load_buffer(self):
+        """ Load the block stores. Uncompressed buffers saved by Buffer are converted. """
+        meta_path = self.buffer_path.joinpath('compressed_meta.pkl')
+        if not meta_path.exists():
+            super().load_buffer()
+            if self.trajs_train is not None:
+                trajs_train, trajs_val = self.trajs_train, self.trajs_val
+                self.create_stores(trajs_train)
+                self.trajs_train.write(0, trajs_train)
+                if trajs_val is not None:
+                    self.trajs_val.write(0, trajs_val)
+            return
+        self.loaded = True
+        with open(meta_path, 'rb') as f:
+            meta = pkl.load(f)
+        for split in ['train', 'val']:
+            # Blocks are read from disk the first time they're touched
+            store = meta[split]
+            store.loader = lambda block_id, split=split: self.load_block(split, block_id)
+            store.cache_blocks = self.cache_blocks
+        self.trajs_train, self.index_train, self.counts_train = meta['train'], *meta['train_pointers']
+        self.trajs_val, self.index_val, self.counts_val = meta['val'], *meta['val_pointers']
+        print("loaded compressed buffer", self.buffer_path.resolve(), self.counts_train, self.counts_val)
+
+    def block_path(self, split, block_id):
+        return self.buffer_path.joinpath(f'{split}_block_{block_id:05d}.pkl')
+
+    def load_block(self, split, block_id):
+        block_path = self.block_path(split, block_id)
+        if not block_path.exists():
+            return None
+        with open(block_path, 'rb') as f:
+            return pkl.load(f)
+
+    def save_traj(self, traj, index, split):
+        """ Insert a trajectory into the buffer """
+        store = self.split_store(split)
+        # As in Buffer.save_traj, keep the next obs of an older, partially overwritten traj as its terminal obs.
+        prev = (index - 1) % store.capacity
+        if store.get('terminal_obs', prev) is None and store.get('obs', prev) is not None:
+            next_obs = store.get('obs', index)
+            if next_obs is not None:
+                store.set('terminal_obs', prev, next_obs)
+        store.write(index, traj)
+
+    def save_buffer(self):
+        """ Save the blocks which changed since the last save, plus a small file with the store metadata. """
+        for split in ['train', 'val']:
+            store = self.split_store(split)
+            store.flush()
+            for block_id in sorted(store.unsaved):
+                self.safe_save(store.blocks[block_id], self.block_path(split, block_id))
+            store.unsaved = set()
+        blocks_train, blocks_val = self.trajs_train.blocks, self.trajs_val.blocks
+        self.trajs_train.blocks = [None] * self.trajs_train.num_blocks
+        self.trajs_val.blocks = [None] * self.trajs_val.num_blocks
+        try:
+            meta = {
+                'train': self.trajs_train,
+                'val': self.trajs_val,
+                'train_pointers': (self.index_train, self.counts_train),
+                'val_pointers': (self.index_val, self.counts_val),
+            }
+            self.safe_save(meta, self.buffer_path.joinpath('compressed_meta.pkl'))
+        finally:
+            self.trajs_train.blocks, self.trajs_val.blocks = blocks_train, blocks_val
+
+    def iter_chunks(self, split='train', chunk_size=1024, keys=None):
+        """ As in Buffer.iter_chunks. Chunks which fit in a block only decompress that block. """
+        store = self.split_store(split)
+        counts = self.counts_train if split == 'train' else self.counts_val
+        for start in range(0, counts, chunk_size):
+            with self.lock:
+                chunk = store.read(np.arange(start, min(start + chunk_size, counts)), keys=keys)
+                num_batches_added = self.num_batches_added
+            yield start, chunk, num_batches_added
+
+    def write_column(self, split, key, start, values, num_batches_added=None, bump_version=True):
+        """ As in Buffer.write_column. """
+        with self.lock:
+            if num_batches_added is not None and num_batches_added != self.num_batches_added:
+                return False
+            self.split_store(split).write_column(key, start, values)
+            if bump_version:
+                self.version += 1
+            return True
+
+    def sample(self, total_num_samples=None, split='train'):
+        """ Sample a batch. """
+        if split == 'train' or self.counts_val == 0:  # Early in training we may not have any val trajs yet
+            store = self.trajs_train  # Loads the buffer (and its counters) if it hasn't been yet
+            counts = self.counts_train
+        else:
+            store = self.trajs_val
+            counts = self.counts_val
+
+        with self.lock:
+            indices = np.random.randint(0, counts, size=total_num_samples)
+            data = store.read(indices)
+            next_obs = store.read((indices + 1) % store.capacity, keys=['obs']).obs
+        data.next_obs = [o if terminal is None else terminal for o, terminal in zip(next_obs, data.terminal_obs)]
+        del data['terminal_obs']
+        self.provide_mazes(data.obs + data.next_obs)
+        return data
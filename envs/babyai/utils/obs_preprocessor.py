@@ -1,9 +1,118 @@
+from collections import OrderedDict
+
 import torch
 import numpy as np
 from utils.dictlist import DictList
 
+
+def pad_egocentric(grids, device, pad_size=51):
+    """
+    Turn a list of unpadded (grid, agent_x, agent_y, agent_dir) observations into egocentric views: each grid is
+    rotated by agent_dir quarter turns (as np.rot90 would) and placed in a pad_size x pad_size frame with the agent at
+    the center. All samples are scattered into the frame together on the device.
+    Older (grid, x, y) observations were already rotated by the env, so they are treated as having agent_dir 0.
+    :return: float tensor of shape (len(grids), pad_size, pad_size, channels)
+    """
+    n = len(grids)
+    width = max(g[0].shape[0] for g in grids)
+    height = max(g[0].shape[1] for g in grids)
+    channels = grids[0][0].shape[2]
+    # Stack the (compact dtype) grids into one batch, zero-filling smaller rooms
+    stacked = np.zeros((n, width, height, channels), dtype=grids[0][0].dtype)
+    for i, g in enumerate(grids):
+        stacked[i, :g[0].shape[0], :g[0].shape[1]] = g[0]
+    stacked = torch.from_numpy(stacked).to(device)
+    agent = np.array([tuple(g[1:]) + (0,) * (4 - len(g)) for g in grids], dtype=np.int64)
+    agent = torch.from_numpy(agent).to(device)
+    x, y, direction = agent[:, 0, None, None], agent[:, 1, None, None], agent[:, 2, None, None]
+
+    # Offset of every cell from the agent, rotated into the agent's frame
+    dx = torch.arange(width, device=device)[None, :, None] - x
+    dy = torch.arange(height, device=device)[None, None, :] - y
+    cos = torch.tensor([1, 0, -1, 0], device=device)[direction]
+    sin = torch.tensor([0, 1, 0, -1], device=device)[direction]
+    middle = pad_size // 2
+    row = middle + cos * dx - sin * dy
+    col = middle + sin * dx + cos * dy
+    # Rotation is a bijection, so the zero-filled cells never collide with real ones; just drop anything off-frame.
+    valid = (row >= 0) & (row < pad_size) & (col >= 0) & (col < pad_size)
+    sample = torch.arange(n, device=device)[:, None, None].expand_as(row)
+    flat_index = ((sample * pad_size + row) * pad_size + col)[valid]
+
+    padded = torch.zeros(n * pad_size * pad_size, channels, device=device)
+    padded[flat_index] = stacked[valid].float()
+    return padded.view(n, pad_size, pad_size, channels)
+
+# Number of copies of the per-step D4RL state the model sees, so that it isn't drowned out by the maze grid
+REPEAT_STATE = 5
+# Padded D4RL maze grids this process has seen, by maze id (see D4RLEnv.update_maze), least recently used first.
+# Random-maze levels make a new maze every episode, so only the MAX_MAZES most recently used are kept. Buffers keep
+# their own table of the mazes their data refers to (see Buffer.mazes).
+MAX_MAZES = 4096
+MAZES = OrderedDict()
+
+
+def register_maze(maze_id, maze):
+    maze_id = int(maze_id)
+    MAZES[maze_id] = maze
+    MAZES.move_to_end(maze_id)
+    while len(MAZES) > MAX_MAZES:
+        MAZES.popitem(last=False)
+
+
+def register_mazes(obs):
+    """ Register the grids carried by any (reset) obs in a list of obs. """
+    for o in obs:
+        if o is not None and 'maze' in o:
+            register_maze(o['maze_id'], o['maze'])
+
+
+def get_maze(maze_id):
+    maze_id = int(maze_id)
+    if maze_id not in MAZES:
+        raise KeyError(f"Maze id {maze_id} hasn't been seen by this process (mazes are only sent on reset)")
+    MAZES.move_to_end(maze_id)
+    return MAZES[maze_id]
+
+
+def attach_mazes(obs):
+    """
+    Make a list of D4RL obs self-contained, so another process can expand it: the first obs referring to each maze
+    carries its grid (in a shallow copy of the obs dict, if it didn't already).
+    """
+    if len(obs) == 0 or 'maze_id' not in obs[0]:
+        return obs
+    seen = set()
+    out = []
+    for o in obs:
+        maze_id = int(o['maze_id'])
+        if maze_id not in seen:
+            seen.add(maze_id)
+            if 'maze' not in o:
+                o = dict(o, maze=get_maze(maze_id))
+        out.append(o)
+    return out
+
+
+def expand_maze_obs(obs, device, repeat_state=REPEAT_STATE):
+    """
+    Build the model input for D4RL observations, which carry their per-step state once and refer to the episode's
+    maze by id (the grid itself only comes with the first obs of each episode): the state repeated repeat_state times,
+    followed by the flattened maze. The repetition and the lookup of each sample's maze happen on the device.
+    :return: float tensor of shape (len(obs), repeat_state * state_size + maze_size)
+    """
+    register_mazes(obs)
+    maze_ids = [int(o['maze_id']) for o in obs]
+    unique_ids = list(dict.fromkeys(maze_ids))
+    mazes = torch.from_numpy(np.stack([get_maze(maze_id).reshape(-1) for maze_id in unique_ids])).to(device).float()
+    rows = {maze_id: i for i, maze_id in enumerate(unique_ids)}
+    rows = torch.as_tensor([rows[maze_id] for maze_id in maze_ids], device=device)
+    states = torch.from_numpy(np.stack([o['obs'] for o in obs])).to(device).float()
+    return torch.cat([states.repeat(1, repeat_state), mazes[rows]], dim=1)
+
+
 def make_obs_preprocessor(feedback_list, device=torch.device("cuda" if torch.cuda.is_available() else "cpu"),
-                          pad_size=51):
+                          pad_size=51, repeat_state=REPEAT_STATE):
     def obss_preprocessor(obs, teacher, show_instrs=True):
         obs_output = {}
         assert not 'advice' in obs[0].keys(), "Appears to already be preprocessed"
@@ -17,19 +126,19 @@ def make_obs_preprocessor(feedback_list, device=torch.device("cuda" if torch.cud
         obs_final = {}
         for k, v in obs_output.items():
             if k == 'obs' and type(v[0]) is tuple:  # Padding for egocentric view
-                obs_final[k] = np.zeros((len(v), pad_size, pad_size, 3))
-                middle = int(pad_size / 2)
-                for i, (img, x, y) in enumerate(v):
-                    y_start = middle - y
-                    x_start = middle - x
-                    obs_final[k][i][x_start:x_start + len(img), y_start:y_start + len(img[0])] = img
-                obs_final[k] = torch.FloatTensor(obs_final[k]).to(device)
-            else:
+                obs_final[k] = pad_egocentric(v, device, pad_size)
+            elif k == 'obs' and 'maze_id' in obs[0]:  # D4RL state + maze
+                obs_final[k] = expand_maze_obs(obs, device, repeat_state)
+            elif len(v) == 0:
                 obs_final[k] = torch.FloatTensor(v).to(device)
+            else:
+                obs_final[k] = torch.from_numpy(np.stack(v)).to(device).float()
             if k == 'instr':
                 obs_final[k] = obs_final[k] * instr_mask
         return DictList(obs_final)
 
+    # The same preprocessor, outputting tensors on another device (e.g. for a CPU copy of a policy)
+    obss_preprocessor.for_device = lambda device: make_obs_preprocessor(feedback_list, device, pad_size, repeat_state)
     return obss_preprocessor
 
 
@@ -0,0 +1,66 @@
+import queue
+import threading
+import time
+
+import torch
+
+
+class PrefetchSampler:
+    """
+    Samples and preprocesses batches from a Buffer in a background thread, so that the next batches are ready by the
+    time the optimizer step finishes.
+    Batches are tagged with the buffer version they were sampled at. Batches sampled before a buffer write are
+    dropped, so training never sees data which is staler than a synchronous buffer.sample() would give.
+    """
+
+    def __init__(self, buffer, batch_size, preprocess, split='train', num_batches=2):
+        """
+        :param buffer: Buffer to sample from
+        :param batch_size: number of transitions per batch
+        :param preprocess: function which takes a sampled batch and returns it with its obs preprocessed
+        :param split: buffer split to sample from
+        :param num_batches: number of batches to prepare ahead of time
+        """
+        self.buffer = buffer
+        self.batch_size = batch_size
+        self.preprocess = preprocess
+        self.split = split
+        self.queue = queue.Queue(maxsize=num_batches)
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            while not self.stop_event.is_set():
+                with self.buffer.lock:
+                    version = self.buffer.version
+                    # Wait for data in this sampler's own split (Buffer.sample would fall back to train for val)
+                    empty = (self.buffer.counts_train if self.split == 'train' else self.buffer.counts_val) == 0
+                    batch = None if empty else self.buffer.sample(total_num_samples=self.batch_size, split=self.split)
+                if batch is None:
+                    time.sleep(.01)
+                    continue
+                with torch.no_grad():
+                    batch = self.preprocess(batch)
+                while not self.stop_event.is_set():
+                    try:
+                        self.queue.put((version, batch), timeout=.1)
+                        break
+                    except queue.Full:
+                        continue
+        except Exception as e:
+            self.queue.put((None, e))
+
+    def sample(self):
+        """ Return the next batch which was sampled from the current contents of the buffer. """
+        while True:
+            version, batch = self.queue.get()
+            if version is None:
+                raise batch
+            if version == self.buffer.version:
+                return batch
+
+    def close(self):
+        self.stop_event.set()
+        self.thread.join()
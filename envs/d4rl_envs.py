@@ -1,4 +1,6 @@
 # Allow us to interact wth the D4RLEnv the same way we interact with the TeachableRobotLevels class.
+import zlib
+
 import numpy as np
 import gym
 from gym.spaces import Box
@@ -9,6 +11,8 @@ from envs.d4rl.oracle.direction_teacher import DirectionCorrections
 from envs.d4rl.oracle.waypoint_teacher import WaypointCorrections
 from envs.d4rl.oracle.offset_waypoint_teacher import OffsetWaypointCorrections
 from envs.d4rl.oracle.dummy_advice import DummyAdvice
+from envs.obs_schema import D4RL_OBS_SCHEMA
+from envs.babyai.utils.obs_preprocessor import REPEAT_STATE, get_maze, register_maze
 
 
 class D4RLEnv:
@@ -36,7 +40,6 @@ class D4RLEnv:
             om = np.array([0, 0])
         self.waypoint_controller = WaypointController(self.get_maze(), offset_mapping=om)
         self.scale_factor = 5
-        self.repeat_input = 5
         teachers = {}
         for ft in feedback_type:
             if ft == 'none': teachers[ft] = DummyAdvice()
@@ -62,11 +65,8 @@ class D4RLEnv:
         raise NotImplementedError
 
     def state_to_waypoint_controller(self, state):
-        grid = state['obs']
-        state_len = int(len(grid) - (self.max_grid_size ** 2) / self.repeat_input)
-        state = grid[:state_len]
-        grid = grid[- (self.max_grid_size ** 2):]
-        grid = grid.reshape(self.max_grid_size, self.max_grid_size)
+        grid = state['maze'] if 'maze' in state else get_maze(state['maze_id'])
+        state = state['obs']
         # Assume the current d4rl_env is the same size as the new maze
         h, w = self.waypoint_controller.env.gs.spec_no_start.shape
         grid = grid[: h, :w]
@@ -80,6 +80,7 @@ class D4RLEnv:
             om = np.array([0, 0])
         waypoint_controller = WaypointController(grid, offset_mapping=om)
         waypoint_controller.new_target(pos, target)
+        return waypoint_controller
 
     def wall_distance(self):
         agent_pos = self.get_pos() + np.array(self.waypoint_controller.offset_mapping)
@@ -106,22 +107,31 @@ class D4RLEnv:
             dist_to_wall_3 = 1
         return np.array([dist_to_wall_0, dist_to_wall_1, dist_to_wall_2, dist_to_wall_3])
 
-    def update_obs(self, obs_dict):
+    def update_maze(self):
+        """
+        Pad the current maze to max_grid_size x max_grid_size and register it under an id derived from its contents.
+        Observations refer to the maze by id; the grid itself is only sent with the first obs of each episode.
+        """
         state = self.waypoint_controller.env.gs.spec_no_start
-        max_grid = np.zeros((self.max_grid_size, self.max_grid_size))
+        maze = np.zeros((self.max_grid_size, self.max_grid_size), dtype=D4RL_OBS_SCHEMA.dtype('maze'))
         h, w = state.shape
-        max_grid[:h, :w] = state
-        state_obs = obs_dict['obs']
-        if self.args.env == 'ant':
-            # Agent position
-            state_obs[:2] = self.get_pos() / self.scale_factor
-            goal = (self.get_target() - self.get_pos()) / self.scale_factor
-            state_obs = np.concatenate([state_obs, goal])
-        obs_dict['obs'] = np.concatenate([state_obs] * self.repeat_input + [max_grid.flatten()])
+        maze[:h, :w] = state
+        self.maze = maze
+        self.maze_id = zlib.crc32(maze.tobytes())
+        register_maze(self.maze_id, maze)
+
+    def state_obs(self, obs):
+        """ Per-step part of the observation. """
+        return obs
+
+    def update_obs(self, obs_dict):
+        # The model sees the state repeated and the maze appended; that's done in the obs preprocessor.
+        obs_dict['obs'] = self.state_obs(obs_dict['obs'])
+        obs_dict['maze_id'] = self.maze_id
         if self.teacher is not None and not 'None' in self.teacher.teachers:
             advice = self.teacher.give_feedback(self)
             obs_dict.update(advice)
-        return obs_dict
+        return D4RL_OBS_SCHEMA.cast(obs_dict)
 
     def get_success(self):
         target = self.get_target()
@@ -252,7 +262,6 @@ class D4RLEnv:
         info['gave_reward'] = gave_reward
         info['teacher_action'] = np.array(-1)
         info['episode_length'] = self._wrapped_env._elapsed_steps
-        info['next_obs'] = obs_dict
 
         if hasattr(self, 'teacher') and self.teacher is not None:
             # Even if we use multiple teachers, presumably they all relate to one underlying path.
@@ -297,11 +306,17 @@ class D4RLEnv:
         if hasattr(self, 'teacher') and self.teacher is not None:
             self.teacher.reset(self)
         self.teacher_action = self.get_teacher_action()
+        self.update_maze()
         obs_dict = self.update_obs(obs_dict)
+        obs_dict['maze'] = self.maze
         self.past_positions = []
         self.past_imgs = []
         return obs_dict
 
+    def flat_obs(self, obs_dict):
+        """ The model's view of an observation as one vector (for code which uses the env without a preprocessor). """
+        return np.concatenate([obs_dict['obs']] * REPEAT_STATE + [self.maze.flatten()])
+
     def vocab(self):  # We don't have vocab
         return [0]
 
@@ -336,8 +351,8 @@ class D4RLEnv:
 class PointMassEnv(D4RLEnv):
     def __init__(self, *args, **kwargs):
         super(PointMassEnv, self).__init__(*args, offset_mapping=np.array([0, 0]), **kwargs)
-        # Adding goal
-        self.observation_space = Box(low=-float('inf'), high=float('inf'), shape=(6 * self.repeat_input + self.max_grid_size ** 2,))
+        # Position, velocity and goal
+        self.observation_space = Box(low=-float('inf'), high=float('inf'), shape=(6,))
 
     def get_target(self):
         return self._wrapped_env.get_target()
@@ -351,10 +366,12 @@ class PointMassEnv(D4RLEnv):
     def get_vel(self):
         return self._wrapped_env.get_sim().data.qvel
 
+    def state_obs(self, obs):
+        target = (self.get_target() / self.scale_factor).astype(np.float32)
+        return np.concatenate([obs, target])
+
     def step(self, action):
         obs_dict, rew, done, info = super().step(action)
-        target = self.get_target() / self.scale_factor
-        obs_dict['obs'] = np.concatenate([obs_dict['obs']] + [target] * self.repeat_input)
         if self.reward_type == 'dense':
             rew = rew / 10 - .01
         # done = done or info['success']
@@ -362,23 +379,16 @@ class PointMassEnv(D4RLEnv):
             rew += 1
         return obs_dict, rew, done, info
 
-    def reset(self):
-        obs_dict = super().reset()
-        # fake_target = np.random.randint(low=1, high=4, size=2)
-        # target = fake_target / self.scale_factor
-        target = self.get_target() / self.scale_factor
-        obs_dict['obs'] = np.concatenate([obs_dict['obs']] + [target] * self.repeat_input)
-        return obs_dict
 
 
 class PointMassSACEnv(PointMassEnv):
     def step(self, action):
         obs_dict, rew, done, info = super().step(action)
-        return obs_dict['obs'], rew, done, info
+        return self.flat_obs(obs_dict), rew, done, info
 
     def reset(self):
         obs_dict = super().reset()
-        return obs_dict['obs']
+        return self.flat_obs(obs_dict)
 
 
 
@@ -386,8 +396,8 @@ class AntEnv(D4RLEnv):
     def __init__(self, *args, **kwargs):
         super(AntEnv, self).__init__(*args, offset_mapping=np.array([1, 1]), **kwargs)
         size = len(self._wrapped_env.observation_space.low)
-        self.observation_space = Box(low=-float('inf'), high=float('inf'), shape=(size * self.repeat_input
-                                                                                  + self.max_grid_size ** 2,))
+        # State and goal
+        self.observation_space = Box(low=-float('inf'), high=float('inf'), shape=(size + 2,))
 
     def get_target(self):
         return np.array(self._wrapped_env.xy_to_rowcolcontinuous(self._wrapped_env.get_target()))
@@ -414,6 +424,12 @@ class AntEnv(D4RLEnv):
             rew = rew / 100 + .1
         return obs_dict, rew, done, info
 
+    def state_obs(self, obs):
+        # Agent position
+        obs[:2] = self.get_pos() / self.scale_factor
+        goal = (self.get_target() - self.get_pos()) / self.scale_factor
+        return np.concatenate([obs, goal])
+
     def scale_obs(self, obs):
         scale = 5
         obs[22] /= scale
@@ -425,8 +441,8 @@ class AntEnv(D4RLEnv):
 class AntSACEnv(AntEnv):
     def step(self, action):
         obs_dict, rew, done, info = super().step(action)
-        return obs_dict['obs'], rew, done, info
+        return self.flat_obs(obs_dict), rew, done, info
 
     def reset(self):
         obs_dict = super().reset()
-        return obs_dict['obs']
+        return self.flat_obs(obs_dict)
@@ -48,7 +48,6 @@ class DummyDiscrete:
         info['gave_reward'] = True
         info['teacher_action'] = np.array(-1)
         info['episode_length'] = self.timesteps
-        info['next_obs'] = obs_dict
         return obs_dict, rew, done, info
 
     def reset(self):
@@ -113,7 +112,6 @@ class PointMassEnvSimple:
         info['gave_reward'] = True
         info['teacher_action'] = np.array(-1)
         info['episode_length'] = self.timesteps
-        info['next_obs'] = obs_dict
         return obs_dict, rew, done, info
 
     def reset(self):
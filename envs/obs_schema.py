@@ -0,0 +1,47 @@
+import numpy as np
+
+
+class ObsSchema:
+    """
+    Declared dtypes for the fields of an observation dict.  Envs cast their observations with it as they are
+    generated, so compact arrays (rather than python lists and float64 arrays) flow through IPC, the buffer and
+    preprocessing.
+    Fields not listed explicitly are either feedback flags ('gave_<teacher>') or teacher advice.
+    """
+
+    def __init__(self, fields, advice_dtype=np.float32, flag_dtype=np.bool_, flag_prefix='gave_'):
+        """
+        :param fields: dict of field name --> numpy dtype
+        :param advice_dtype: dtype used for any other (advice) field
+        :param flag_dtype: dtype used for the 'gave_*' feedback flags
+        """
+        self.fields = fields
+        self.advice_dtype = advice_dtype
+        self.flag_dtype = flag_dtype
+        self.flag_prefix = flag_prefix
+
+    def dtype(self, key):
+        if key in self.fields:
+            return self.fields[key]
+        if key.startswith(self.flag_prefix):
+            return self.flag_dtype
+        return self.advice_dtype
+
+    def cast_value(self, key, value):
+        dtype = self.dtype(key)
+        # Padded egocentric images are passed around as (grid, *offsets). Only the grid needs casting.
+        if type(value) is tuple:
+            return (np.asarray(value[0], dtype=dtype),) + value[1:]
+        if dtype is np.bool_:
+            return bool(value)
+        return np.asarray(value, dtype=dtype)
+
+    def cast(self, obs_dict):
+        """ Cast every field of obs_dict (in place) to its declared dtype. """
+        for k, v in obs_dict.items():
+            obs_dict[k] = self.cast_value(k, v)
+        return obs_dict
+
+
+BABYAI_OBS_SCHEMA = ObsSchema({'obs': np.uint8, 'instr': np.int16, 'extra': np.float32})
+D4RL_OBS_SCHEMA = ObsSchema({'obs': np.float32, 'maze_id': np.int64, 'maze': np.int8})
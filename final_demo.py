@@ -142,7 +142,7 @@ class HumanFeedback:
         exp_path = os.path.join(path, 'latest.pkl')
         exp_data = joblib.load(exp_path)
         obs_preprocessor = make_obs_preprocessor([self.args.feedback_type])
-        env = exp_data['env']
+        env = exp_data['env'] if 'env' in exp_data else exp_data['env_factory']()
         args = exp_data['args']
         policy = create_policy(path, self.args.feedback_type, env, args, obs_preprocessor)
         set_seed(self.args.seed)
@@ -481,7 +481,7 @@ class HumanFeedback:
             device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
             traj_dict = {
                 'obs': self.obs_list,
-                'next_obs': self.obs_list[1:] + [final_obs],
+                'terminal_obs': [None] * (len(self.obs_list) - 1) + [final_obs],
                 'action': torch.FloatTensor(np.concatenate(self.action_list)).to(device),
                 # 'action_probs': self.action_probs,
                 'teacher_action': torch.FloatTensor(self.teacher_action),
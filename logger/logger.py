@@ -6,6 +6,10 @@ Copyright (c) 2017 OpenAI (http://openai.com)
 import os
 import sys
 import shutil
+import csv
+import atexit
+import queue
+import threading
 import os.path as osp
 import json
 import time
@@ -159,6 +163,86 @@ class CSVOutputFormat(KVWriter):
         self.file.close()
 
 
+class CSVAppendOutputFormat(KVWriter):
+    """
+    Append-only alternative to CSVOutputFormat, which never rewrites the file when new keys appear.
+    Each row is written as '<schema id>,<values...>' to progress_rows.csv (quoted by the csv module, since values
+    such as lists contain commas). Whenever new keys show up, a new schema
+    (all keys so far, in column order) is appended to progress_schema.jsonl. Rows are buffered and written every
+    flush_every dumps. Use compact_progress() to build the usual wide progress.csv.
+    """
+    def __init__(self, rows_filename, schema_filename, flush_every=10):
+        self.keys = []
+        self.schema_id = -1
+        self.flush_every = flush_every
+        self.pending_schemas = []
+        self.pending_rows = []
+        if os.path.exists(schema_filename):
+            with open(schema_filename, 'r') as f:
+                for line in f:
+                    schema = json.loads(line)
+                    self.schema_id, self.keys = schema['id'], schema['keys']
+        self.rows_file = open(rows_filename, 'at', newline='')
+        self.rows_writer = csv.writer(self.rows_file)
+        self.schema_file = open(schema_filename, 'at')
+        atexit.register(self.close)
+
+    def writekvs(self, kvs):
+        extra_keys = kvs.keys() - set(self.keys)
+        if extra_keys:
+            self.keys = self.keys + sorted(extra_keys)
+            self.schema_id += 1
+            self.pending_schemas.append(json.dumps({'id': self.schema_id, 'keys': self.keys}) + '\n')
+        values = [str(self.schema_id)]
+        for k in self.keys:
+            v = kvs.get(k)
+            values.append('' if v is None else str(v))
+        self.pending_rows.append(values)
+        if len(self.pending_rows) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        # Schemas go first, so every row on disk refers to a schema which is also on disk
+        if self.pending_schemas:
+            self.schema_file.writelines(self.pending_schemas)
+            self.schema_file.flush()
+            self.pending_schemas = []
+        if self.pending_rows:
+            self.rows_writer.writerows(self.pending_rows)
+            self.rows_file.flush()
+            self.pending_rows = []
+
+    def close(self):
+        if self.rows_file.closed:
+            return
+        self.flush()
+        self.rows_file.close()
+        self.schema_file.close()
+
+
+def compact_progress(dir, log_suffix=''):
+    """
+    Turn the progress_rows.csv and progress_schema.jsonl written by CSVAppendOutputFormat into a wide progress.csv
+    (the same layout CSVOutputFormat writes), with one column for every key ever logged.
+    """
+    with open(osp.join(dir, 'progress_schema%s.jsonl' % log_suffix), 'r') as f:
+        schemas = {}
+        for line in f:
+            schema = json.loads(line)
+            schemas[schema['id']] = schema['keys']
+    if len(schemas) == 0:
+        return
+    all_keys = schemas[max(schemas)]
+    with open(osp.join(dir, 'progress_rows%s.csv' % log_suffix), 'r', newline='') as rows_file, \
+            open(osp.join(dir, 'progress%s.csv' % log_suffix), 'w', newline='') as out_file:
+        writer = csv.writer(out_file)
+        writer.writerow(all_keys)
+        for values in csv.reader(rows_file):
+            keys = schemas[int(values[0])]
+            # Keys are only ever appended, so older rows just miss the trailing columns
+            writer.writerow(values[1:] + [''] * (len(all_keys) - len(keys)))
+
+
 class TensorBoardOutputFormat(KVWriter):
     """
     Dumps key/value pairs into TensorBoard's numeric format.
@@ -236,6 +320,9 @@ def make_output_format(format, ev_dir, log_suffix='', step=0, name="", config={}
         return JSONOutputFormat(osp.join(ev_dir, 'progress%s.json' % log_suffix))
     elif format == 'csv':
         return CSVOutputFormat(osp.join(ev_dir, 'progress%s.csv' % log_suffix))
+    elif format == 'csv_append':
+        return CSVAppendOutputFormat(osp.join(ev_dir, 'progress_rows%s.csv' % log_suffix),
+                                     osp.join(ev_dir, 'progress_schema%s.jsonl' % log_suffix))
     elif format == 'tensorboard':
         return TensorBoardOutputFormat(osp.join(ev_dir, 'tb%s' % log_suffix), step)
     elif format == 'wandb':
@@ -264,6 +351,17 @@ def logkv_mean(key, val):
     Logger.CURRENT.logkv_mean(key, val)
 
 
+def logkv_grouped(key_format, groups, values, num_groups):
+    """
+    Log the mean of values within each group, e.g. per-action accuracy, without leaving the device.
+    Only groups which occur are written, as key_format.format(group).
+    If called many times, last value will be used.
+    groups: integer tensor of group ids in [0, num_groups)
+    values: tensor of the same length as groups
+    """
+    Logger.CURRENT.logkv_grouped(key_format, groups, values, num_groups)
+
+
 def logkvs(d):
     """
     Log a dictionary of key-value pairs
@@ -362,44 +460,109 @@ def profile(n):
 # Backend
 # ================================================================
 
+def materialize_kvs(name2val, name2grouped):
+    """
+    Replace the tensors in name2val with python numbers, and expand grouped (sums, counts) into per-group means.
+    Everything is copied to the host in a single transfer.
+    """
+    tensor_keys = [k for k, v in name2val.items() if hasattr(v, 'detach')]
+    grouped = list(name2grouped.items())
+    if len(tensor_keys) == 0 and len(grouped) == 0:
+        return
+    import torch  # Only needed once tensors have been logged
+    flat = [name2val[k].float().reshape(-1) for k in tensor_keys]
+    for _, (sums, counts) in grouped:
+        flat += [sums, counts.float()]
+    device = flat[0].device
+    sizes = [len(v) for v in flat]
+    values = torch.cat([v.to(device) for v in flat]).cpu().tolist()
+    pieces, start = [], 0
+    for size in sizes:
+        pieces.append(values[start:start + size])
+        start += size
+    for k, piece in zip(tensor_keys, pieces):
+        name2val[k] = piece[0] if len(piece) == 1 else piece
+    for i, (key_format, _) in enumerate(grouped):
+        sums, counts = pieces[len(tensor_keys) + 2 * i], pieces[len(tensor_keys) + 2 * i + 1]
+        for group, (total, count) in enumerate(zip(sums, counts)):
+            if count > 0:
+                name2val[key_format.format(group)] = total / count
+    name2grouped.clear()
+
+
 class Logger(object):
     DEFAULT = None  # A logger with no output files. (See right below class definition)
                     # So that you can still log to the terminal without setting up any output files
     CURRENT = None  # Current logger being used by the free functions above
 
-    def __init__(self, dir, output_formats, snapshot_mode='last', snapshot_gap=1):
+    def __init__(self, dir, output_formats, snapshot_mode='last', snapshot_gap=1, async_write=False, max_queue=8):
         self.name2val = defaultdict(float)  # values this iteration
         self.name2cnt = defaultdict(int)
+        self.name2grouped = {}  # key format --> (per-group sums, per-group counts) this iteration
         self.level = INFO
         self.dir = dir
         self.output_formats = output_formats
         self.snapshot_mode = snapshot_mode
         self.snapshot_gap = snapshot_gap
+        self.closed = False
+        # In async mode, dumps and log lines are handed (in order) to a writer thread through a bounded queue
+        self.write_queue = None
+        if async_write:
+            self.write_queue = queue.Queue(maxsize=max_queue)
+            self.writer_thread = threading.Thread(target=self._write_loop, daemon=True)
+            self.writer_thread.start()
+            atexit.register(self.close)
 
     # Logging API, forwarded
     # ----------------------------------------
     def logkv(self, key, val):
+        # Tensors are kept (on their device) until dumpkvs, so logging doesn't force a sync
+        if hasattr(val, 'detach'):
+            val = val.detach()
         self.name2val[key] = val
 
     def logkv_mean(self, key, val):
         if val is None:
             self.name2val[key] = None
             return
+        if hasattr(val, 'detach'):
+            val = val.detach()
         oldval, cnt = self.name2val[key], self.name2cnt[key]
         self.name2val[key] = oldval*cnt/(cnt+1) + val/(cnt+1)
         self.name2cnt[key] = cnt + 1
 
+    def logkv_grouped(self, key_format, groups, values, num_groups):
+        groups = groups.detach().long().flatten()
+        values = values.detach().float().flatten()
+        sums = groups.new_zeros(num_groups, dtype=values.dtype).index_add_(0, groups, values)
+        counts = groups.bincount(minlength=num_groups)
+        self.name2grouped[key_format] = (sums, counts)
+
+    def materialize(self):
+        """
+        Replace the tensors logged this iteration with python numbers.
+        All of them (and the grouped sums/counts) are copied to the host in a single transfer.
+        """
+        materialize_kvs(self.name2val, self.name2grouped)
+
     def dumpkvs(self):
         if self.level == DISABLED: return
-        for fmt in self.output_formats:
-            if isinstance(fmt, KVWriter):
-                fmt.writekvs(self.name2val)
+        if self.write_queue is not None:
+            # Snapshot this iteration's values; the writer thread materializes and writes them
+            self.write_queue.put(('kvs', dict(self.name2val), dict(self.name2grouped)))
+        else:
+            self.materialize()
+            self._write_kvs(self.name2val)
         self.name2val.clear()
         self.name2cnt.clear()
+        self.name2grouped.clear()
 
     def log(self, *args, level=INFO):
         if self.level <= level:
-            self._do_log(args)
+            if self.write_queue is not None:
+                self.write_queue.put(('seq', args))
+            else:
+                self._do_log(args)
 
     # Configuration
     # ----------------------------------------
@@ -410,6 +573,13 @@ class Logger(object):
         return self.dir
 
     def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.write_queue is not None:
+            # Write out everything which is still queued
+            self.write_queue.put(None)
+            self.writer_thread.join()
         for fmt in self.output_formats:
             fmt.close()
 
@@ -420,6 +590,26 @@ class Logger(object):
             if isinstance(fmt, SeqWriter):
                 fmt.writeseq(map(str, args))
 
+    def _write_kvs(self, kvs):
+        for fmt in self.output_formats:
+            if isinstance(fmt, KVWriter):
+                fmt.writekvs(kvs)
+
+    def _write_loop(self):
+        while True:
+            item = self.write_queue.get()
+            if item is None:
+                return
+            try:
+                if item[0] == 'kvs':
+                    _, kvs, grouped = item
+                    materialize_kvs(kvs, grouped)
+                    self._write_kvs(kvs)
+                else:
+                    self._do_log(item[1])
+            except Exception as e:
+                print("Logger writer thread failed to write:", e)
+
     def save_itr_params(self, itr, step, params):
         if self.dir:
             if self.snapshot_mode == 'all':
@@ -450,7 +640,8 @@ class Logger(object):
 Logger.DEFAULT = Logger.CURRENT = Logger(dir=None, output_formats=[HumanOutputFormat(sys.stdout)])
 
 
-def configure(dir=None, format_strs=None, snapshot_mode='last', snapshot_gap=1, step=0, name="", config={}):
+def configure(dir=None, format_strs=None, snapshot_mode='last', snapshot_gap=1, step=0, name="", config={},
+              async_write=False):
     if dir is None:
         dir = os.getenv('OPENAI_LOGDIR')
     if dir is None:
@@ -481,7 +672,8 @@ def configure(dir=None, format_strs=None, snapshot_mode='last', snapshot_gap=1,
 
     output_formats = [make_output_format(f, dir, log_suffix, step, config=config, name=name) for f in format_strs]
 
-    Logger.CURRENT = Logger(dir=dir, output_formats=output_formats, snapshot_mode=snapshot_mode, snapshot_gap=snapshot_gap)
+    Logger.CURRENT = Logger(dir=dir, output_formats=output_formats, snapshot_mode=snapshot_mode, snapshot_gap=snapshot_gap,
+                            async_write=async_write)
     log('Logging to %s' % dir)
 
 
@@ -67,26 +67,63 @@ class ArgumentParser(argparse.ArgumentParser):
         self.add_argument('--num_rollouts', type=int, default=5)
         self.add_argument('--hide_instrs', action='store_true')
         self.add_argument('--padding', action='store_true')
+        self.add_argument('--quantize_collection', action='store_true',
+                          help="collect with a dynamically quantized (int8) copy of the collect policy (CPU "
+                               "policies only, except in actor-learner mode, where collectors quantize CPU copies)")
+        self.add_argument('--fused_image_embedding', action='store_true',
+                          help="compute the image embedding and first conv from a precomputed lookup table")
+        self.add_argument('--skip_empty_cells', action='store_true',
+                          help="with --fused_image_embedding, skip the empty cells of the (padded) image")
         self.add_argument('--feedback_from_buffer', action='store_true')
         self.add_argument('--hidden_dim', type=int, default=128)
         self.add_argument('--instr_dim', type=int, default=128)
         self.add_argument('--sequential', action='store_true')
+        self.add_argument('--actor_learner', action='store_true',
+                          help="collect in separate processes while training (off-policy RL and distillation only)")
+        self.add_argument('--num_collectors', type=int, default=2,
+                          help="number of collector processes in actor-learner mode; envs are split between them")
+        self.add_argument('--weight_sync_interval', type=int, default=1,
+                          help="iterations between publishing the collect policy's weights to the collectors")
+        self.add_argument('--actor_queue_size', type=int, default=4,
+                          help="max number of collected batches waiting for the learner")
+        self.add_argument('--plan_resources', action='store_true',
+                          help="split the CPU cores between the learner and env worker/collector processes")
+        self.add_argument('--learner_threads', type=int, default=None,
+                          help="with --plan_resources, torch threads for the learner (default: all cores left over)")
+        self.add_argument('--pin_cores', action='store_true',
+                          help="with --plan_resources, also pin each process to its cores")
+        self.add_argument('--inference_server', action='store_true',
+                          help="in actor-learner mode, collectors (and evaluation of the collect policy) act through one "
+                               "batched inference server")
+        self.add_argument('--server_batch_size', type=int, default=256,
+                          help="max number of observations per inference server forward pass")
+        self.add_argument('--server_latency', type=float, default=.005,
+                          help="max seconds an inference request waits to be batched with others")
         self.add_argument('--clip_eps', type=float, default=.2)
+        self.add_argument('--ppo_minibatch_size', type=int, default=None,
+                          help="PPO minibatch size (default: one update per epoch on the whole batch)")
 
         # Saving/loading/logging
         self.add_argument('--prefix', type=str, default='DEBUG')
         self.add_argument('--save_option', type=str, default='level',
                           choices=['all', 'level', 'latest', 'none', 'gap'])
         self.add_argument('--save_untrained', action='store_true')
+        self.add_argument('--light_checkpoint', action='store_true',
+                          help="save checkpoints in the background, without pickling the env")
         self.add_argument("--log_interval", type=int, default=20)
         self.add_argument("--eval_interval", type=int, default=20)
         self.add_argument('--no_video', action='store_true')
         self.add_argument('--no_tb', action='store_true')
+        self.add_argument('--csv_append', action='store_true',
+                          help="log to an append-only csv (see logger.compact_progress) instead of progress.csv")
+        self.add_argument('--async_log', action='store_true',
+                          help="write logs from a background thread")
 
         # Teacher
         self.add_argument('--feedback_freq', nargs='+', type=int, default=[1])
         self.add_argument('--collect_with_oracle', action='store_true')
-        self.add_argument('--reload_exp_path', type=str, default=None)
+        self.add_argument('--reload_exp_path', type=str, default=None,
+                          help="experiment to resume (use --compressed_buffer to avoid loading its whole buffer)")
 
         # Policies
         self.add_argument('--collect_policy', default=None, help='path to collection policy')
@@ -100,12 +137,26 @@ class ArgumentParser(argparse.ArgumentParser):
         self.add_argument('--collect_with_distill_policy', action='store_true')
         self.add_argument('--relabel_policy', default=None, help='path to relabel policy')
         self.add_argument('--relabel_teacher', default=None)
+        self.add_argument('--relabel_buffer_interval', type=int, default=0,
+                          help="iterations between background passes relabeling the whole buffer (0: never)")
+        self.add_argument('--relabel_chunk_size', type=int, default=1024,
+                          help="transitions relabeled at once by the background relabeling pass")
         self.add_argument('--noise', action='store_true')
 
         # Distillations
         self.add_argument('--distillation_steps', type=int, default=100)
         self.add_argument('--buffer_capacity', type=int, default=1)
         self.add_argument('--buffer_path', type=str, default=None)
+        self.add_argument('--compressed_buffer', action='store_true',
+                          help="store the buffer in blosc-compressed blocks, which are loaded as they're used; "
+                               "recommended when resuming runs with large buffers, since the plain buffer loads "
+                               "in full on first use (existing plain buffers are converted)")
+        self.add_argument('--buffer_block_size', type=int, default=1024,
+                          help="transitions per compressed buffer block")
+        self.add_argument('--buffer_cache_blocks', type=int, default=8,
+                          help="number of decompressed buffer blocks to keep in memory")
+        self.add_argument('--prefetch_batches', type=int, default=0,
+                          help="number of batches to sample and preprocess in the background (0 to sample inline)")
         self.add_argument('--distill_dropout_prob', type=float, default=0.)
         self.add_argument('--collect_dropout_prob', type=float, default=0.)
         self.add_argument('--distill_successful_only', action='store_true')
@@ -117,6 +168,8 @@ class ArgumentParser(argparse.ArgumentParser):
         self.add_argument('--source', type=str, default='agent', choices=['agent', 'teacher', 'agent_argmax',
                                                                                 'agent_probs'])
         self.add_argument('--no_distill', action='store_true')
+        self.add_argument('--distill_procs', type=int, default=1,
+                          help="number of CPU processes for data-parallel (gloo) distillation; needs a CPU policy")
         self.add_argument('--train_level', action='store_true')
 
     def parse_args(self, arg=None):
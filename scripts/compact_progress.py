@@ -0,0 +1,14 @@
+import argparse
+
+from logger import logger
+
+# Build progress.csv for runs logged with --csv_append
+
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--folders', nargs='+', required=True, type=str)
+args = parser.parse_args()
+
+for folder in args.folders:
+    logger.compact_progress(folder)
+    print("compacted", folder)
@@ -0,0 +1,30 @@
+import argparse
+import os
+
+import joblib
+
+from algos.export import export_policy
+from envs.babyai.utils.obs_preprocessor import make_obs_preprocessor
+from scripts.train_model import create_policy
+
+# Export a trained policy's act path with torch.jit (and optionally ONNX), for inference without the training code
+
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--model', type=str, required=True, help="experiment directory containing latest.pkl")
+parser.add_argument('--teacher', type=str, default='none', help="teacher the policy was trained with")
+parser.add_argument('--output', type=str, default=None, help="defaults to <model>/<teacher>_act.pt")
+parser.add_argument('--onnx', action='store_true', help="also export <output without extension>.onnx")
+args = parser.parse_args()
+
+path = os.path.join(os.getcwd(), args.model)
+exp_data = joblib.load(os.path.join(path, 'latest.pkl'))
+env = exp_data['env'] if 'env' in exp_data else exp_data['env_factory']()
+train_args = exp_data['args']
+policy = create_policy(path, args.teacher, env, train_args, make_obs_preprocessor([args.teacher]))
+policy.train(False)
+
+output = os.path.join(path, f'{args.teacher}_act.pt') if args.output is None else args.output
+onnx_path = os.path.splitext(output)[0] + '.onnx' if args.onnx else None
+export_policy(policy, output, onnx_path=onnx_path, hierarchical=train_args.algo == 'hppo')
+print("exported", output, "" if onnx_path is None else onnx_path)
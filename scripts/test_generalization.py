@@ -38,12 +38,13 @@ def make_log_fn(env, args, start_num_feedback, save_dir, policy, hide_instrs, se
     start = time.time()
     save_dir = pathlib.Path(save_dir)
 
-    def log_fn_vidrollout(itr, num_save):
-        return test_success_checkpoint(env, save_dir, num_rollouts, policy=policy, policy_name=policy_name,
+    def log_fn_vidrollout(itr, num_save, acting_policy):
+        return test_success_checkpoint(env, save_dir, num_rollouts, policy=acting_policy, policy_name=policy_name,
                                        env_name=env_name, hide_instrs=hide_instrs, stochastic=stochastic,
                                        args=args, seed=seed, num_save=num_save)
 
-    def log_fn(itr, num_feedback):
+    def log_fn(itr, num_feedback, acting_policy=None):
+        """ :param acting_policy: acts in place of policy, e.g. an InferenceClient serving it """
         policy_env_name = f'Policy{policy_name}-{env_name}'
         full_save_dir = save_dir
         if itr == 0:
@@ -54,7 +55,8 @@ def make_log_fn(env, args, start_num_feedback, save_dir, policy, hide_instrs, se
                 with open(file_name, 'w') as f:
                     f.write('policy_env,policy,env,success_rate,stoch_accuracy,itr,num_feedback,time,reward\n')
         num_save = 0 if args.no_video else 10
-        avg_success, avg_accuracy, det_accuracy, reward = log_fn_vidrollout(itr, num_save)
+        avg_success, avg_accuracy, det_accuracy, reward = log_fn_vidrollout(
+            itr, num_save, policy if acting_policy is None else acting_policy)
         print(f"Finetuning achieved success: {avg_success}, stoch acc: {avg_accuracy}")
         with open(full_save_dir.joinpath('results.csv'), 'a') as f:
             f.write(
@@ -62,6 +64,7 @@ def make_log_fn(env, args, start_num_feedback, save_dir, policy, hide_instrs, se
                 f'{num_feedback + start_num_feedback},{time.time() - start},{reward} \n')
         return avg_success, avg_accuracy
 
+    log_fn.policy = policy
     return log_fn
 
 def test_success_checkpoint(env, save_dir, num_rollouts, policy=None,
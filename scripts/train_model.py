@@ -6,13 +6,17 @@ from scripts.arguments import ArgumentParser
 from envs.babyai.utils.obs_preprocessor import make_obs_preprocessor
 from scripts.test_generalization import make_log_fn
 from algos.data_collector import DataCollector
+from algos.quantized import QuantizedPolicy
+from utils.resources import plan_resources, apply_resources
 from utils.rollout import rollout
 
 import shutil
 from logger import logger
 from utils.utils import set_seed
-from envs.babyai.levels.iclr19_levels import *
+from utils.checkpoint import load_resume_info
 from envs.babyai.levels.envdist import EnvDist
+from copy import deepcopy
+import numpy as np
 import pathlib
 import joblib
 import os
@@ -36,7 +40,12 @@ def load_experiment(args):
         log_dict = {}
     else:
         reload_path = args.reload_exp_path
-        saved_model = joblib.load(reload_path + '/latest.pkl')
+        # resume.pkl only holds args and counters; the env is rebuilt from args below, and the buffer loads lazily.
+        saved_model = load_resume_info(reload_path)
+        if saved_model is None:
+            saved_model = joblib.load(reload_path + '/latest.pkl')
+        else:
+            saved_model['log_dict'] = dict(saved_model['log_dict'], trainer_state=saved_model['trainer_state'])
         args = saved_model['args']
         args.start_itr = saved_model['itr']
         args.buffer_path = args.exp_dir
@@ -153,13 +162,14 @@ def configure_logger(args, exp_dir, start_itr, is_debug):
     if args.reload_exp_path is None:
         if os.path.isdir(exp_dir):
             shutil.rmtree(exp_dir)
-    log_formats = ['stdout', 'log', 'csv']
+    log_formats = ['stdout', 'log', 'csv_append' if getattr(args, 'csv_append', False) else 'csv']
 
     if not (args.no_tb or is_debug):
         log_formats.append('tensorboard')
     logger.configure(dir=exp_dir, format_strs=log_formats,
                      snapshot_mode=args.save_option,
-                     snapshot_gap=50, step=start_itr, name=args.prefix + str(args.seed))
+                     snapshot_gap=50, step=start_itr, name=args.prefix + str(args.seed),
+                     async_write=getattr(args, 'async_log', False))
 
 
 def eval_policy(policy, env, args, exp_dir):
@@ -258,15 +268,31 @@ def run_experiment(args):
         eval_policy(log_policy, env, args, exp_dir)
         return
 
-    envs = [env.copy() for _ in range(args.num_envs)]
-    for i, new_env in enumerate(envs):
-        new_env.seed(i+100)
-        new_env.set_task()
-        new_env.reset()
+    resource_plan = None
+    if getattr(args, 'plan_resources', False):
+        actor_learner = getattr(args, 'actor_learner', False)
+        num_env_workers = 0 if (collect_policy is None or actor_learner or args.sequential) else args.num_envs - 1
+        resource_plan = plan_resources(num_env_workers=num_env_workers,
+                                       num_collectors=args.num_collectors if actor_learner else 0,
+                                       learner_threads=args.learner_threads, pin=args.pin_cores)
+        apply_resources(*resource_plan.learner)
+        resource_plan.log()
+
+    env_fns = None
+    quantized_policy = None
     if collect_policy is None:
         sampler = None
     else:
-        sampler = DataCollector(collect_policy, envs, args)
+        # Each env is rebuilt from its config inside the worker that owns it, rather than deep-copied here.
+        env_fns = [env.factory(seed=i + 100) for i in range(args.num_envs)]
+        # In actor-learner mode each collector process quantizes its own CPU copy instead (see collector_loop)
+        if getattr(args, 'quantize_collection', False) and not getattr(args, 'actor_learner', False):
+            # Collect with an int8 copy of the collect policy. Evaluation stays on the fp32 policy.
+            quantized_policy = QuantizedPolicy(collect_policy)
+        # In actor-learner mode, the collector processes build their own samplers from env_fns
+        sampler = None if getattr(args, 'actor_learner', False) else DataCollector(
+            collect_policy if quantized_policy is None else quantized_policy, env_fns, args,
+            worker_resources=None if resource_plan is None else resource_plan.env_workers)
 
     buffer_name = exp_dir if args.buffer_path is None else args.buffer_path
     args.buffer_name = buffer_name
@@ -287,6 +313,9 @@ def run_experiment(args):
         obs_preprocessor=obs_preprocessor,
         log_dict=log_dict,
         log_fn=log_fn,
+        env_fns=env_fns,
+        quantized_policy=quantized_policy,
+        resource_plan=resource_plan,
     )
     trainer.train()
 
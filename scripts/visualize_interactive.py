@@ -61,7 +61,7 @@ if True:
     else:
         agent = data['policy']
     # agent.eval()
-    env = data['env']
+    env = data['env'] if 'env' in data else data['env_factory']()
     if args.level is not None:
         env.set_level_distribution(args.level)
 
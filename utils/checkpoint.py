@@ -0,0 +1,79 @@
+import pathlib
+import pickle as pkl
+import queue
+import threading
+import uuid
+
+import torch
+
+
+def cpu_state_dict(module):
+    """ Snapshot of a module's state dict, copied to the CPU so it can be written while training continues. """
+    return {k: v.detach().to('cpu', copy=True) for k, v in module.state_dict().items()}
+
+
+def safe_pickle(data, filename):
+    """ Pickle data to a temporary file, then rename it, so readers never see a partially written file. """
+    filename = pathlib.Path(filename)
+    temp_name = filename.with_name(str(uuid.uuid4()))
+    with open(temp_name, 'wb') as f:
+        pkl.dump(data, f)
+    temp_name.rename(filename)
+
+
+def save_resume_info(exp_dir, itr, args, log_dict, trainer_state):
+    """
+    Write resume.pkl: everything needed to continue a run except models, the buffer and the env, which are
+    rebuilt from args.
+    """
+    safe_pickle({'itr': itr, 'args': args, 'log_dict': log_dict, 'trainer_state': trainer_state},
+                pathlib.Path(exp_dir).joinpath('resume.pkl'))
+
+
+def load_resume_info(exp_dir):
+    """ :return: the dict written by save_resume_info, or None if there isn't one """
+    path = pathlib.Path(exp_dir).joinpath('resume.pkl')
+    if not path.exists():
+        return None
+    with open(path, 'rb') as f:
+        return pkl.load(f)
+
+
+class AsyncCheckpointer:
+    """
+    Runs checkpoint writes in a background thread.
+    Each checkpoint is a list of (function, args) jobs, which must only reference data snapshotted at submit time
+    (e.g. with cpu_state_dict). Only one checkpoint is in flight at a time; submitting another waits for it.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            jobs = self.queue.get()
+            if jobs is None:
+                self.queue.task_done()
+                return
+            try:
+                for fn, args in jobs:
+                    fn(*args)
+            except Exception as e:
+                print("Checkpoint failed:", e)
+            self.queue.task_done()
+
+    def submit(self, jobs):
+        self.queue.join()
+        self.queue.put(jobs)
+
+    def wait(self):
+        """ Block until the last submitted checkpoint is on disk. """
+        self.queue.join()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.join()
+            self.queue.put(None)
+            self.thread.join()
@@ -35,23 +35,129 @@ class DictList(dict):
             setattr(self, index, d)
 
 
-def merge_dictlists(list_of_dictlists):
-    batch = list_of_dictlists[0]
-    for k in batch.keys():
-        try:
-            vec_type = type(getattr(list_of_dictlists[0], k))
-            if vec_type is list:
-                v = [step for dict_list in list_of_dictlists for step in getattr(dict_list, k)]
-            elif vec_type is torch.Tensor:
-                device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-                v = torch.cat([getattr(dict_list, k).to(device) for dict_list in list_of_dictlists])
-            elif vec_type is np.ndarray:
-                v = np.concatenate([getattr(dict_list, k) for dict_list in list_of_dictlists])
-            elif vec_type is DictList:
-                v = merge_dictlists([getattr(dict_list, k) for dict_list in list_of_dictlists])
+class TensorBatch(DictList):
+    """A DictList whose fields all hold one entry per sample along their first dimension. Fields may be tensors,
+    numpy arrays, lists or nested TensorBatches (e.g. preprocessed obs or env_infos).
+
+    - Integer indexing returns a DictList for that sample, as for a DictList.
+    - Slicing returns a TensorBatch of views (tensors and arrays aren't copied).
+    - Boolean masks and index arrays/tensors are converted to indices once, then each field is gathered with them (on
+      the field's own device, for tensors). Torch has no zero-copy masked view, so this copies the selected rows.
+    - pin_memory() and to() stage or move every tensor field (including nested ones) in one call.
+
+    Example:
+        >>> b = TensorBatch({"a": torch.arange(4), "b": ["w", "x", "y", "z"]})
+        >>> even = b[b.a % 2 == 0]
+        >>> even.a, even.b
+        (tensor([0, 2]), ['w', 'y'])
+    """
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            return DictList({key: value[index] for key, value in dict.items(self)})
+        if isinstance(index, slice):
+            return TensorBatch({key: TensorBatch(value)[index] if isinstance(value, DictList) else value[index]
+                                for key, value in dict.items(self)})
+        return self.gather(index)
+
+    def gather(self, index):
+        """ Select samples with a boolean mask or an array/tensor/list of indices. """
+        if isinstance(index, torch.Tensor):
+            if index.dtype == torch.bool:
+                index = index.nonzero()[:, 0]
+            # Only copied to the host if a list or array field needs it
+            host_index = None
+        else:
+            index = np.asarray(index)
+            if index.dtype == bool:
+                index = np.nonzero(index)[0]
+            index = host_index = index.astype(np.int64)
+        device_indices = {}
+        out = {}
+        for key, value in dict.items(self):
+            if isinstance(value, DictList):
+                out[key] = TensorBatch(value).gather(index)
+            elif isinstance(value, torch.Tensor):
+                if value.device not in device_indices:
+                    device_indices[value.device] = torch.as_tensor(index, dtype=torch.long, device=value.device)
+                out[key] = value[device_indices[value.device]]
+            else:
+                if host_index is None:
+                    host_index = index.cpu().numpy()
+                if isinstance(value, np.ndarray):
+                    out[key] = value[host_index]
+                elif isinstance(value, list):
+                    out[key] = [value[i] for i in host_index]
+                else:
+                    raise NotImplementedError((key, type(value)))
+        return TensorBatch(out)
+
+    def schema(self):
+        """ Per-field (kind, dtype, shape of one sample), nested for nested batches. """
+        schema = {}
+        for key, value in dict.items(self):
+            if isinstance(value, DictList):
+                schema[key] = TensorBatch(value).schema()
+            elif isinstance(value, torch.Tensor):
+                schema[key] = ('tensor', value.dtype, tuple(value.shape[1:]))
+            elif isinstance(value, np.ndarray):
+                schema[key] = ('ndarray', value.dtype, value.shape[1:])
+            elif isinstance(value, list):
+                schema[key] = ('list', None, None)
             else:
-                raise NotImplementedError(vec_type)
-            setattr(batch, k, v)
-        except Exception as e:
-            print(f"Error setting {k}, {e}")
-    return batch
+                raise NotImplementedError((key, type(value)))
+        return schema
+
+    def apply(self, fn):
+        """ New TensorBatch with fn applied to every tensor field (including nested ones). """
+        out = {}
+        for key, value in dict.items(self):
+            if isinstance(value, DictList):
+                value = TensorBatch(value).apply(fn)
+            elif isinstance(value, torch.Tensor):
+                value = fn(value)
+            out[key] = value
+        return TensorBatch(out)
+
+    def pin_memory(self):
+        """ Page-lock CPU tensors, so copying them to the GPU can be asynchronous. No-op without CUDA. """
+        if not torch.cuda.is_available():
+            return self
+        return self.apply(lambda t: t.pin_memory() if t.device.type == 'cpu' else t)
+
+    def to(self, device, non_blocking=False):
+        device = torch.device(device)
+        return self.apply(lambda t: t if t.device == device else t.to(device, non_blocking=non_blocking))
+
+    @staticmethod
+    def cat(batches):
+        """ Concatenate batches with the same schema. Tensors end up on the first batch's device. """
+        schema = batches[0].schema()
+        for batch in batches[1:]:
+            if batch.schema() != schema:
+                raise ValueError(f"Can't concatenate batches with different schemas: {schema} vs {batch.schema()}")
+        return TensorBatch(cat_fields(batches))
+
+
+def cat_fields(list_of_dictlists):
+    """ Concatenate each field of DictLists which have the same keys. """
+    out = {}
+    for k in list_of_dictlists[0].keys():
+        values = [dict.__getitem__(dict_list, k) for dict_list in list_of_dictlists]
+        if isinstance(values[0], DictList):
+            out[k] = type(values[0])(cat_fields(values))
+        elif isinstance(values[0], torch.Tensor):
+            device = values[0].device
+            out[k] = torch.cat([v.to(device) for v in values])
+        elif isinstance(values[0], np.ndarray):
+            out[k] = np.concatenate(values)
+        elif isinstance(values[0], list):
+            out[k] = [step for v in values for step in v]
+        else:
+            raise NotImplementedError((k, type(values[0])))
+    return out
+
+
+def merge_dictlists(list_of_dictlists):
+    """ Concatenate DictLists with the same keys into a new DictList (of the first one's type). """
+    return type(list_of_dictlists[0])(cat_fields(list_of_dictlists))
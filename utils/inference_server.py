@@ -0,0 +1,189 @@
+import copy
+import itertools
+import queue
+import threading
+import time
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from torch.distributions import Categorical
+
+
+class InferenceServer:
+    """
+    Serves a policy to any number of client processes, so they can share one copy of it.
+    Clients submit observations to a shared request queue. A thread in the server's process waits for requests until
+    max_batch_size observations are pending or the first request has waited max_latency seconds, then answers all of
+    them with one forward pass per distinct (sample, instr_dropout_prob) setting.
+    The server acts with its own copy of the policy, refreshed with update(), so training can continue on the original
+    while the server is answering requests.
+    Clients for other processes must be created (with client()) before those processes are forked. Clients for this
+    process (e.g. evaluation rollouts during training) can be created at any time with connect().
+    With --inference_server, the actor-learner collectors and the trainer's evaluation rollouts act through it.
+    HumanFeedback runs as its own script with its own copy of the policy, so there's no server for it to connect to.
+    """
+
+    def __init__(self, policy, max_batch_size=256, max_latency=.005, ctx=None):
+        """
+        :param policy: Agent to serve
+        :param max_batch_size: max number of observations per forward pass
+        :param max_latency: max time (in seconds) a request waits for others to batch with
+        :param ctx: multiprocessing context the clients' processes are created with (defaults to fork)
+        """
+        self.ctx = mp.get_context('fork') if ctx is None else ctx
+        self.policy = copy.deepcopy(policy)
+        self.policy.train(False)
+        self.discrete = policy.args.discrete
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.requests = self.ctx.Queue()
+        self.responses = []  # client id --> that client's response queue
+        self.version = 0
+        self.lock = threading.Lock()
+        self.num_batches = 0
+        self.num_requests = 0
+        self.num_obs = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def client(self, device=None):
+        """
+        Create a client. Each process should use its own.
+        :param device: device the client returns its outputs on (use the CPU in forked processes)
+        """
+        self.responses.append(self.ctx.Queue())
+        return InferenceClient(self.requests, self.responses[-1], len(self.responses) - 1, self.discrete, device)
+
+    def connect(self, device=None):
+        """
+        Create a client for use in the server's own process. Unlike client(), it can be created after the collectors
+        were forked, since its responses come back through a plain in-process queue. Each thread should use its own.
+        """
+        self.responses.append(queue.Queue())
+        return InferenceClient(self.requests, self.responses[-1], len(self.responses) - 1, self.discrete, device)
+
+    def update(self, policy):
+        """ Copy policy's current weights into the served policy. """
+        with self.lock:
+            self.policy.load_state_dict(policy.state_dict())
+            self.version += 1
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                pending = [self.requests.get(timeout=.1)]
+            except queue.Empty:
+                continue
+            num_obs = len(pending[0][2])
+            deadline = time.time() + self.max_latency
+            while num_obs < self.max_batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    pending.append(self.requests.get(timeout=timeout))
+                except queue.Empty:
+                    break
+                num_obs += len(pending[-1][2])
+            self.serve(pending)
+
+    def serve(self, pending):
+        """ Answer a list of (client id, request id, obs, sample, instr_dropout_prob) requests. """
+        groups = {}
+        for request in pending:
+            groups.setdefault(request[3:], []).append(request)
+        for (sample, instr_dropout_prob), requests in groups.items():
+            obs = list(itertools.chain.from_iterable(request[2] for request in requests))
+            try:
+                with self.lock, torch.no_grad():
+                    action, agent_dict = self.policy.act(obs, sample=sample, instr_dropout_prob=instr_dropout_prob)
+                    outputs = self.outputs(action, agent_dict)
+                    version = self.version
+            except Exception as e:
+                for client_id, request_id, *_ in requests:
+                    self.responses[client_id].put((request_id, None, e))
+                continue
+            self.num_batches += 1
+            self.num_requests += len(requests)
+            self.num_obs += len(obs)
+            start = 0
+            for client_id, request_id, request_obs, *_ in requests:
+                end = start + len(request_obs)
+                result = {k: v[start:end] for k, v in outputs.items()}
+                self.responses[client_id].put((request_id, (result, version), None))
+                start = end
+
+    def outputs(self, action, agent_dict):
+        """ Everything a caller of Agent.act needs, as numpy arrays with one row per observation. """
+        dist = agent_dict['dist']
+        outputs = {'action': action, 'argmax_action': agent_dict['argmax_action']}
+        if self.discrete:
+            outputs['probs'] = dist.probs
+            outputs['log_prob'] = dist.log_prob(action[:, 0])
+        else:
+            outputs['log_prob'] = dist.log_prob(action).sum(-1)
+        if 'value' in agent_dict:
+            outputs['value'] = agent_dict['value']
+        return {k: v.cpu().numpy() for k, v in outputs.items()}
+
+    def stats(self):
+        """ :return: dict of mean observations and requests per forward pass since the last call """
+        num_batches = max(self.num_batches, 1)
+        stats = {'InferenceServer/BatchSize': self.num_obs / num_batches,
+                 'InferenceServer/RequestsPerBatch': self.num_requests / num_batches,
+                 'InferenceServer/Batches': self.num_batches}
+        self.num_batches = self.num_requests = self.num_obs = 0
+        return stats
+
+    def close(self):
+        self.stop_event.set()
+        self.thread.join()
+
+
+class InferenceClient:
+    """
+    Stand-in for an Agent in code which only acts with it (DataCollector, rollout, interactive tools).
+    Every call is a blocking round trip to an InferenceServer.
+    """
+
+    def __init__(self, requests, responses, client_id, discrete, device=None):
+        self.requests = requests
+        self.responses = responses
+        self.client_id = client_id
+        self.discrete = discrete
+        self.request_id = 0
+        self.version = -1  # version of the server's weights which answered the last request
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = torch.device(device)
+
+    def train(self, training=True):
+        # The server always acts in eval mode
+        return self
+
+    def query(self, obs, sample, instr_dropout_prob):
+        self.request_id += 1
+        self.requests.put((self.client_id, self.request_id, list(obs), sample, instr_dropout_prob))
+        while True:
+            request_id, result, error = self.responses.get()
+            if request_id != self.request_id:  # Left over from a call which was interrupted
+                continue
+            if error is not None:
+                raise error
+            outputs, self.version = result
+            return outputs
+
+    def act(self, obs, sample=False, instr_dropout_prob=0):
+        """ Same interface as Agent.act. The returned agent_dict also contains each action's log prob. """
+        outputs = self.query(obs, sample, instr_dropout_prob)
+        outputs = {k: torch.from_numpy(v).to(self.device) for k, v in outputs.items()}
+        action = outputs.pop('action')
+        if self.discrete:
+            outputs['dist'] = Categorical(probs=outputs.pop('probs'))
+        return action, outputs
+
+    def get_actions(self, obs, training=False, instr_dropout_prob=0):
+        action, agent_dict = self.act(obs, sample=True, instr_dropout_prob=instr_dropout_prob)
+        return np.asarray(action[0].cpu()), agent_dict
@@ -1,12 +1,23 @@
 from multiprocessing import Process, Pipe
 import gym
 
-def worker(conn, env, seed):
+from utils.resources import apply_resources
+
+def make_env(env):
+    """ Envs may be passed in directly or as factories (e.g. EnvFactory) which are built by the process owning them. """
+    return env() if callable(env) else env
+
+
+def worker(conn, env, seed, resources=None):
+    if resources is not None:
+        apply_resources(*resources)
+    env = make_env(env)
     while True:
         cmd, data = conn.recv()
         if cmd == "step":
             obs, reward, done, info = env.step(data)
             if done:
+                info['terminal_obs'] = obs
                 if seed is not None:
                     env.seed(seed)
                 obs = env.reset()
@@ -31,10 +42,13 @@ def worker(conn, env, seed):
 class ParallelEnv(gym.Env):
     """A concurrent execution of environments in multiple processes."""
 
-    def __init__(self, envs, repeated_seed=None):
+    def __init__(self, envs, repeated_seed=None, worker_resources=None):
+        """ :param worker_resources: optional list of apply_resources args for each worker (see plan_resources) """
         assert len(envs) >= 1, "No environment given."
 
-        self.envs = envs
+        # Only the first env lives in this process; the rest are built inside their workers.
+        self.envs = [make_env(envs[0])] + list(envs[1:])
+        self.worker_resources = worker_resources
         self.observation_space = self.envs[0].observation_space
         self.action_space = self.envs[0].action_space
         self.locals = []
@@ -47,10 +61,11 @@ class ParallelEnv(gym.Env):
         self.locals = []
         self.processes = []
         repeated_seed = self.repeated_seed if self.repeated_seed is not None else [None] * len(self.envs)
-        for env, seed in zip(self.envs[1:], repeated_seed[1:]):
+        worker_resources = self.worker_resources or [None] * (len(self.envs) - 1)
+        for env, seed, resources in zip(self.envs[1:], repeated_seed[1:], worker_resources):
             local, remote = Pipe()
             self.locals.append(local)
-            p = Process(target=worker, args=(remote, env, seed))
+            p = Process(target=worker, args=(remote, env, seed, resources))
             p.daemon = True
             p.start()
             remote.close()
@@ -75,6 +90,7 @@ class ParallelEnv(gym.Env):
             local.send(("step", action))  # TODO: does this reset?
         obs, reward, done, info = self.envs[0].step(actions[0])
         if done:
+            info['terminal_obs'] = obs
             if self.repeated_seed is not None:
                 self.envs[0].seed(self.repeated_seed[0])
             obs = self.envs[0].reset()
@@ -108,7 +124,7 @@ class SequentialEnv(gym.Env):
     def __init__(self, envs, repeated_seed=None):
         assert len(envs) >= 1, "No environment given."
 
-        self.envs = envs
+        self.envs = [make_env(env) for env in envs]
         self.observation_space = self.envs[0].observation_space
         self.action_space = self.envs[0].action_space
         self.locals = []
@@ -135,6 +151,7 @@ class SequentialEnv(gym.Env):
         for i, (env, action) in enumerate(zip(self.envs, actions)):
             obs, reward, done, info = env.step(action)
             if done:
+                info['terminal_obs'] = obs
                 if self.repeated_seed is not None:
                     env.seed(self.repeated_seed[i])
                 obs = env.reset()
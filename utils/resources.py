@@ -0,0 +1,87 @@
+import os
+
+import torch
+
+from logger import logger
+
+
+def available_cores():
+    """ CPU cores this process may run on. """
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def apply_resources(cores, num_threads, pin=False):
+    """ Limit this process to num_threads torch threads and, if pin, to the given cores. """
+    torch.set_num_threads(num_threads)
+    if pin and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+
+
+class ResourcePlan:
+    """
+    Assignment of CPU cores to the learner (this process), env worker processes and collector processes.
+    Each slot is a (cores, num_threads, pin) tuple which the process it's meant for passes to apply_resources.
+    """
+
+    def __init__(self, learner, env_workers, collectors):
+        self.learner = learner
+        self.env_workers = env_workers
+        self.collectors = collectors
+
+    def log(self):
+        def describe(slot):
+            cores, num_threads, pin = slot
+            return f"{num_threads} threads on cores {compact(cores)}" + (" (pinned)" if pin else "")
+
+        logger.log("Resource plan:")
+        logger.log(f"  learner: {describe(self.learner)}")
+        for i, slot in enumerate(self.collectors):
+            logger.log(f"  collector {i}: {describe(slot)}")
+        for i, slot in enumerate(self.env_workers):
+            logger.log(f"  env worker {i}: {describe(slot)}")
+
+
+def compact(cores):
+    """ [0, 1, 2, 5] --> '0-2,5' """
+    ranges = []
+    for core in cores:
+        if ranges and core == ranges[-1][1] + 1:
+            ranges[-1][1] = core
+        else:
+            ranges.append([core, core])
+    return ','.join(str(a) if a == b else f'{a}-{b}' for a, b in ranges)
+
+
+def plan_resources(num_env_workers=0, num_collectors=0, learner_threads=None, collector_threads=1, pin=False):
+    """
+    Split the available cores between the learner, collector processes and env worker processes, so they don't
+    oversubscribe the machine.
+    Env workers only step envs, so each gets one core and one torch thread. Collectors get collector_threads cores
+    each for running the policy. The learner gets learner_threads cores, or by default whatever is left (at least one).
+    If there are more processes than cores, the workers share the cores not used by the learner round-robin (or all
+    cores, if the learner uses all of them).
+    """
+    cores = available_cores()
+    num_workers = num_env_workers + num_collectors * collector_threads
+    if learner_threads is None:
+        learner_threads = max(1, len(cores) - num_workers)
+    learner_threads = min(learner_threads, len(cores))
+    learner_cores = cores[:learner_threads]
+    worker_cores = cores[learner_threads:] or cores
+
+    position = 0
+
+    def take(n):
+        nonlocal position
+        taken = [worker_cores[(position + i) % len(worker_cores)] for i in range(n)]
+        position += n
+        return sorted(set(taken))
+
+    collectors = []
+    for _ in range(num_collectors):
+        collector_cores = take(collector_threads)
+        collectors.append((collector_cores, len(collector_cores), pin))
+    env_workers = [(take(1), 1, pin) for _ in range(num_env_workers)]
+    return ResourcePlan((learner_cores, learner_threads, pin), env_workers, collectors)